@@ -0,0 +1,764 @@
+import argparse
+import io
+import json
+import platform
+import random
+import re
+import os
+import string
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import main
+
+
+class LegacyToken:
+    __slots__ = ('type', 'value', 'line', 'col')
+
+    def __init__(self, type, value, line, col):
+        self.type = type
+        self.value = value
+        self.line = line
+        self.col = col
+
+
+def legacy_tokenize(s):
+    # Исходная реализация tokenize() — эталон для сравнения скорости
+    token_specs = [
+        ('COMMENT', r'%[^\n]*'),
+        ('WHITESPACE', r'[ \t\r\n]+'),
+        ('DICT_OPEN', r'\(\['),
+        ('DICT_CLOSE', r'\]\)'),
+        ('ARRAY_KEYWORD', r'array'),
+        ('DEF', r'def'),
+        ('CHR', r'chr'),
+        ('LEN', r'len'),
+        ('NUMBER', r'\d+'),
+        ('STRING', r'"(?:\\.|[^"\\])*"'),
+        ('NAME', r'[A-Za-z_][A-Za-z0-9_]*'),
+        ('LPAREN', r'\('),
+        ('RPAREN', r'\)'),
+        ('LBRACE', r'\{'),
+        ('RBRACE', r'\}'),
+        ('COLON', r':'),
+        ('COMMA', r','),
+        ('PLUS', r'\+'),
+        ('MINUS', r'-'),
+        ('TIMES', r'\*'),
+        ('DIV', r'/'),
+        ('SEMICOLON', r';'),
+        ('MISMATCH', r'.'),
+    ]
+    tok_regex = '|'.join('(?P<%s>%s)' % pair for pair in token_specs)
+    line = 1
+    col = 1
+    tokens = []
+    for mo in re.finditer(tok_regex, s):
+        kind = mo.lastgroup
+        value = mo.group()
+        if kind == 'COMMENT' or kind == 'WHITESPACE':
+            for char in value:
+                if char == '\n':
+                    line += 1
+                    col = 1
+                else:
+                    col += 1
+            continue
+        elif kind == 'MISMATCH':
+            raise main.ConfigError(f"Unexpected character '{value}'")
+        tokens.append(LegacyToken(kind, value, line, col))
+        for char in value:
+            if char == '\n':
+                line += 1
+                col = 1
+            else:
+                col += 1
+    return tokens
+
+
+def generate_config(entries):
+    lines = ['% Сгенерированная конфигурация для замеров']
+    for i in range(entries):
+        lines.append(f'(def CONST_{i} {{* {i} 3}});  % константа {i}')
+    lines.append('([')
+    for i in range(entries):
+        lines.append(f'    entry_{i}: ([')
+        lines.append(f'        id: {i},')
+        lines.append(f'        name: "entry number {i}",')
+        lines.append(f'        value: {{+ CONST_{i} 7}},')
+        lines.append(f'        tags: array("a", "b", {{chr {65 + i % 26}}}, {{len "tag"}})')
+        lines.append('    ]),')
+    lines.append('    last: 0')
+    lines.append('])')
+    return '\n'.join(lines)
+
+
+def best_time(func, arg, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(arg)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def bench_tokenize(source, repeat):
+    count = len(main.tokenize(source))
+    results = []
+    for label, func in (('legacy', legacy_tokenize), ('tokenize', main.tokenize)):
+        elapsed = best_time(func, source, repeat)
+        results.append((label, elapsed, count / elapsed))
+    return count, results
+
+
+def peak_memory(func, arg):
+    tracemalloc.start()
+    try:
+        result = func(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    del result
+    return peak
+
+
+def bench_token_memory(source):
+    return [(label, peak_memory(func, source)) for label, func in
+            (('legacy', legacy_tokenize), ('tokenize', main.tokenize))]
+
+
+def parse_in_memory(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return main.Parser(main.tokenize(f.read())).parse_program()
+
+
+def parse_streaming(path):
+    return main.Parser(main.tokenize_file(path)).parse_program()
+
+
+def bench_parse_memory(source):
+    fd, path = tempfile.mkstemp(suffix='.conf')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(source)
+        return [(label, peak_memory(func, path)) for label, func in
+                (('in-memory', parse_in_memory), ('streaming', parse_streaming))]
+    finally:
+        os.unlink(path)
+
+
+def bench_evaluate(source, repeat):
+    program = main.Parser(main.tokenize(source)).parse_program()
+    start = time.perf_counter()
+    compiled = main.compile_program(program)
+    compile_time = time.perf_counter() - start
+    optimized = main.optimize(program)
+    results = [
+        ('evaluator', best_time(lambda p: main.Evaluator().evaluate_program(p), program, repeat)),
+        ('optimized', best_time(lambda p: main.Evaluator().evaluate_program(p), optimized, repeat)),
+        ('compiled', best_time(lambda c: c.evaluate(), compiled, repeat)),
+    ]
+    return compile_time, results
+
+
+def bench_optimize_pass(source, repeat):
+    # Разбор и вычисление целиком: окупается ли optimize() за одно вычисление
+    def convert(optimized):
+        program = main.Parser(main.tokenize(source)).parse_program()
+        if optimized:
+            program = main.optimize(program)
+        return main.Evaluator().evaluate_program(program)
+    return [(label, best_time(convert, optimized, repeat)) for label, optimized in
+            (('plain', False), ('optimized', True))]
+
+
+class NullWriter:
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def dumps_to_null(value):
+    NullWriter().write(json.dumps(value, ensure_ascii=False, indent=2))
+
+
+def emit_to_null(value):
+    main.dump_json(value, NullWriter())
+
+
+def bench_output(source, repeat):
+    program = main.Parser(main.tokenize(source)).parse_program()
+    value = main.Evaluator().evaluate_program(program)
+    return [(label, best_time(func, value, repeat), peak_memory(func, value)) for label, func in
+            (('json.dumps', dumps_to_null), ('emitter', emit_to_null))]
+
+
+def generate_nested(depth):
+    return '(def X 1);\n' + '([a: ' * depth + '{+ 1 ' * depth + 'X' + '}' * depth + '])' * depth
+
+
+def bench_recursion(source, repeat):
+    tokens = main.tokenize(source)
+    program = main.Parser(tokens).parse_program()
+    return [
+        ('parse', best_time(lambda t: main.RecursiveParser(t).parse_program(), tokens, repeat),
+         best_time(lambda t: main.Parser(t).parse_program(), tokens, repeat)),
+        ('evaluate', best_time(lambda p: main.RecursiveEvaluator().evaluate_program(p), program, repeat),
+         best_time(lambda p: main.Evaluator().evaluate_program(p), program, repeat)),
+    ]
+
+
+def generate_prelude(definitions, used):
+    lines = [f'(def P{i} {{+ {{* {i} 3}} {{len "prelude"}}}});' for i in range(definitions)]
+    lines.append('array(' + ', '.join(f'P{i * (definitions // used)}' for i in range(used)) + ')')
+    return '\n'.join(lines)
+
+
+def eager_evaluate(program):
+    env = {}
+    evaluator = main.Evaluator(env)
+    for defn in program.definitions:
+        env[defn.name] = evaluator.evaluate(defn.value_expr)
+    return evaluator.evaluate(program.main_expr)
+
+
+def bench_definitions(source, repeat):
+    program = main.Parser(main.tokenize(source)).parse_program()
+    return [('eager', best_time(eager_evaluate, program, repeat)),
+            ('lazy', best_time(lambda p: main.Evaluator().evaluate_program(p), program, repeat))]
+
+
+def generate_repeated(entries):
+    block = '([ hp: 100, armor: {* 5 2}, loot: array("gold", "potion", ([ rare: 0, weight: 3 ])) ])'
+    return '([\n' + ',\n'.join(f'    enemy_{i}: {block}' for i in range(entries)) + '\n])'
+
+
+def evaluate_interned(program):
+    interner = main.Interner()
+    return main.Evaluator(interner=interner).evaluate_program(program), interner
+
+
+def bench_interning(source, repeat):
+    program = main.Parser(main.tokenize(source)).parse_program()
+    plain = main.Evaluator().evaluate_program(program)
+    interned, interner = evaluate_interned(program)
+    return [
+        ('plain', peak_memory(lambda p: main.Evaluator().evaluate_program(p), program),
+         best_time(lambda v: main.dump_json(v, NullWriter()), plain, repeat)),
+        ('interned', peak_memory(evaluate_interned, program),
+         best_time(lambda v: main.dump_json(v, NullWriter(), shared=interner.shared), interned, repeat)),
+    ]
+
+
+def bench_select(source, path, repeat):
+    program = main.Parser(main.tokenize(source)).parse_program()
+    return [('full', best_time(lambda p: main.Evaluator().evaluate_program(p), program, repeat)),
+            ('select', best_time(lambda p: main.Evaluator().evaluate_path(p, path), program, repeat))]
+
+
+def bench_watch(entries):
+    # Первое обновление - полное вычисление, второе - после изменения одной константы;
+    # для сравнения - обычное преобразование измененного текста. Второе время - только
+    # вычисление: разбор текста в режиме наблюдения тот же, что и без него
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'watched.conf')
+    watcher = main.Watcher(path, os.path.join(directory, 'watched.json'), log=NullWriter())
+    evaluate, stage = watcher._evaluate, []
+
+    def timed_evaluate(*args):
+        start = time.perf_counter()
+        result = evaluate(*args)
+        stage.append(time.perf_counter() - start)
+        return result
+
+    watcher._evaluate = timed_evaluate
+    results = []
+    try:
+        for label, source in (('full', generate_config(entries)),
+                              ('one edit', generate_config(entries).replace('(def CONST_1 {* 1 3})',
+                                                                            '(def CONST_1 {* 1 4})'))):
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(source)
+            os.utime(path, ns=(len(results) * 10 ** 9, len(results) * 10 ** 9))
+            start = time.perf_counter()
+            watcher.update()
+            results.append((label, time.perf_counter() - start, stage[-1], watcher.evaluated))
+        start = time.perf_counter()
+        program = main.Parser(main.tokenize(source), path).parse_program()
+        evaluated = time.perf_counter()
+        value = main.Evaluator().evaluate_program(program)
+        evaluated = time.perf_counter() - evaluated
+        main.dump_json(value, NullWriter())
+        results.append(('plain', time.perf_counter() - start, evaluated, len(program.definitions)))
+    finally:
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+    return results
+
+
+def generate_synthetic(seed=0, entries=1000, depth=3, definitions=100, string_length=16, op_density=0.3):
+    # Воспроизводимая конфигурация: при одних и тех же параметрах текст совпадает
+    rng = random.Random(seed)
+    names = []
+    alphabet = string.ascii_letters + string.digits + ' '
+
+    def text():
+        chars = ''.join(rng.choice(alphabet) for _ in range(string_length))
+        return '"' + (chars + '\\n' if rng.random() < 0.1 else chars) + '"'
+
+    def int_expr(level):
+        if level > 0 and rng.random() < op_density:
+            op = rng.choice('+-*/')
+            right = str(rng.randint(1, 9)) if op == '/' else int_expr(level - 1)
+            return f'{{{op} {int_expr(level - 1)} {right}}}'
+        if names and rng.random() < 0.3:
+            return rng.choice(names)
+        return str(rng.randint(0, 999))
+
+    def leaf():
+        r = rng.random()
+        if r < op_density:
+            kind = rng.randrange(3)
+            if kind == 0:
+                return f'{{chr {rng.randint(65, 90)}}}'
+            elif kind == 1:
+                return f'{{len {text()}}}'
+            return int_expr(2)
+        elif r < 0.6:
+            return text()
+        return int_expr(0)
+
+    def value(level, indent):
+        if level == 0:
+            return leaf()
+        pad = '    ' * (indent + 1)
+        count = rng.randint(1, 3)
+        if rng.random() < 0.5:
+            items = [f'{pad}k{i}: {value(level - 1, indent + 1)}' for i in range(count)]
+            return '([\n' + ',\n'.join(items) + '\n' + '    ' * indent + '])'
+        return 'array(' + ', '.join(value(level - 1, indent + 1) for _ in range(count)) + ')'
+
+    lines = [f'% seed={seed} entries={entries} depth={depth} definitions={definitions}']
+    for i in range(definitions):
+        lines.append(f'(def D{i} {int_expr(2)});')
+        names.append(f'D{i}')
+    lines.append('([')
+    lines.append(',\n'.join(f'    e{i}: {value(depth, 1)}' for i in range(entries)))
+    lines.append('])')
+    return '\n'.join(lines)
+
+
+SUITE_STAGES = ('tokenize', 'parse', 'optimize', 'evaluate', 'json')
+
+
+def bench_stages(source, repeat):
+    # Этапы те же, что в main(), каждый замеряется отдельно на результате
+    # предыдущего; optimize() выполняется только в compile() и замеряется отдельно
+    tokens = main.tokenize(source)
+    program = main.Parser(tokens).parse_program()
+    value = main.Evaluator().evaluate_program(program)
+    return len(tokens), {
+        'tokenize': best_time(main.tokenize, source, repeat),
+        'parse': best_time(lambda t: main.Parser(t).parse_program(), tokens, repeat),
+        'optimize': best_time(main.optimize, program, repeat),
+        'evaluate': best_time(lambda p: main.Evaluator().evaluate_program(p), program, repeat),
+        'json': best_time(lambda v: main.dump_json(v, NullWriter()), value, repeat),
+    }
+
+
+def run_suite(sizes, repeat, **params):
+    results = {
+        'version': main.__version__,
+        'python': platform.python_version(),
+        'repeat': repeat,
+        'cases': {},
+    }
+    for entries in sizes:
+        case = dict(params, entries=entries)
+        source = generate_synthetic(**case)
+        tokens, stages = bench_stages(source, repeat)
+        results['cases'][f'entries={entries}'] = {
+            'params': case,
+            'chars': len(source),
+            'tokens': tokens,
+            'stages': stages,
+        }
+    return results
+
+
+def compare_results(current, baseline, threshold):
+    # Этапы, которые стали медленнее базовых более чем на threshold (доля);
+    # сравниваются только случаи с одинаковыми параметрами генератора
+    regressions = []
+    for name, case in current['cases'].items():
+        base = baseline.get('cases', {}).get(name)
+        if base is None or base['params'] != case['params']:
+            continue
+        for stage, elapsed in case['stages'].items():
+            old = base['stages'].get(stage)
+            if old and elapsed > old * (1 + threshold):
+                regressions.append((name, stage, old, elapsed))
+    return regressions
+
+
+def print_suite(results, baseline=None):
+    for name, case in results['cases'].items():
+        print(f"{name}: {case['chars']} chars, {case['tokens']} tokens")
+        base = (baseline or {}).get('cases', {}).get(name)
+        for stage in SUITE_STAGES:
+            elapsed = case['stages'][stage]
+            line = f"  {stage:<10} {elapsed * 1000:10.1f} ms"
+            if base and base['params'] == case['params'] and base['stages'].get(stage):
+                line += f" {(elapsed / base['stages'][stage] - 1) * 100:+8.1f}%"
+            print(line)
+
+
+def suite(args):
+    results = run_suite(args.sizes, args.repeat, seed=args.seed, depth=args.nesting,
+                        definitions=args.definitions, string_length=args.string_length,
+                        op_density=args.op_density)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_suite(results, baseline)
+    if args.save:
+        with open(args.save, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if baseline is None:
+        return 0
+    regressions = compare_results(results, baseline, args.threshold)
+    for name, stage, old, new in regressions:
+        print(f"REGRESSION {name} {stage}: {old * 1000:.1f} ms -> {new * 1000:.1f} ms")
+    return 1 if regressions else 0
+
+
+def bench_binary_lookup(source, path, repeat):
+    # Чтение одного значения из готового результата: JSON целиком или двоичный файл по пути
+    value = main.Evaluator().evaluate_program(main.Parser(main.tokenize(source)).parse_program())
+    directory = tempfile.mkdtemp()
+    json_path = os.path.join(directory, 'result.json')
+    binary_path = os.path.join(directory, 'result.cfgb')
+    try:
+        with open(json_path, 'w', encoding='utf-8') as f:
+            main.dump_json(value, f)
+        with open(binary_path, 'wb') as f:
+            main.dump_binary(value, f)
+        steps = main.parse_path(path)
+
+        def json_lookup(file_path):
+            with open(file_path, encoding='utf-8') as f:
+                return main._select_value(json.load(f), steps, 0)
+
+        def binary_lookup(file_path):
+            with main.BinaryReader(file_path) as reader:
+                return reader.get(steps)
+
+        return [('json', os.path.getsize(json_path), best_time(json_lookup, json_path, repeat)),
+                ('binary', os.path.getsize(binary_path), best_time(binary_lookup, binary_path, repeat))]
+    finally:
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def retained_memory(func, arg):
+    tracemalloc.start()
+    try:
+        result = func(arg)
+        retained = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    del result
+    return retained
+
+
+def bench_vector(entries, repeat):
+    # Таблица из entries чисел, умноженная на K: выражение на каждый элемент
+    # против одного поэлементного оператора с результатом в списке и в array('q')
+    items = ', '.join(map(str, range(entries)))
+    per_element = main.compile('array(' + ', '.join(f'{{* {i} K}}' for i in range(entries)) + ')', cache=False)
+    vector = main.compile(f'{{* array({items}) K}}', cache=False)
+    env = {'K': 3}
+    results = []
+
+    def measure(label, program):
+        results.append((label, best_time(program.evaluate, env, repeat), retained_memory(program.evaluate, env)))
+
+    measure('per-item', per_element)
+    pack_min_length = main.PACK_MIN_LENGTH
+    try:
+        main.PACK_MIN_LENGTH = sys.maxsize
+        measure('list', vector)
+    finally:
+        main.PACK_MIN_LENGTH = pack_min_length
+    measure('packed', vector)
+    return results
+
+
+def bench_range(entries, repeat):
+    # Последовательные id: записанные литералом против {range 0 entries}, весь путь от текста до JSON
+    def convert(source):
+        value = main.Evaluator().evaluate_program(main.Parser(main.tokenize(source)).parse_program())
+        main.dump_json(value, NullWriter())
+
+    literal = '([ ids: array(' + ', '.join(map(str, range(entries))) + ') ])'
+    lazy = f'([ ids: {{range 0 {entries}}} ])'
+    return [(label, best_time(convert, source, repeat), peak_memory(convert, source))
+            for label, source in (('literal', literal), ('range', lazy))]
+
+
+def bench_include(definitions, configs, repeat):
+    # configs файлов с общей прелюдией: склеенные с ней тексты против (include "prelude.conf")
+    directory = tempfile.mkdtemp()
+    prelude = generate_prelude(definitions, 5).rsplit('\n', 1)[0]
+    body = 'array(' + ', '.join(f'P{i}' for i in range(0, definitions, max(1, definitions // 5))) + ')'
+    try:
+        with open(os.path.join(directory, 'prelude.conf'), 'w', encoding='utf-8') as f:
+            f.write(prelude)
+        paths = {'concat': [], 'include': []}
+        for i in range(configs):
+            for label, text in (('concat', prelude + '\n' + body), ('include', '(include "prelude.conf");\n' + body)):
+                path = os.path.join(directory, f'{label}_{i}.conf')
+                with open(path, 'w', encoding='utf-8') as f:
+                    f.write(text)
+                paths[label].append(path)
+
+        def convert_all(label):
+            modules = main.ModuleCache()
+            for path in paths[label]:
+                program = main.Parser(main.tokenize_file(path), path, modules).parse_program()
+                main.Evaluator().evaluate_program(program)
+
+        return [(label, best_time(convert_all, label, repeat)) for label in ('concat', 'include')]
+    finally:
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def bench_diff(entries, repeat):
+    # Две версии конфигурации, отличающиеся одной константой: сравнение
+    # текстов JSON, diff_values по обычным значениям (как в diff_files) и
+    # по значениям с общим Interner
+    import difflib
+    k = entries // 2
+    old_source = generate_config(entries)
+    new_source = old_source.replace(f'(def CONST_{k} {{* {k} 3}})', f'(def CONST_{k} {{* {k} 4}})')
+    programs = [main.optimize(main.Parser(main.tokenize(source)).parse_program()) for source in (old_source, new_source)]
+
+    def json_text(programs):
+        texts = []
+        for program in programs:
+            out = io.StringIO()
+            main.dump_json(main.Evaluator().evaluate_program(program), out)
+            texts.append(out.getvalue().splitlines())
+        return list(difflib.unified_diff(*texts, lineterm='', n=0))
+
+    def plain(programs):
+        return main.diff_values(*[main.Evaluator().evaluate_program(program) for program in programs])
+
+    def interned(programs):
+        interner = main.Interner()
+        return main.diff_values(*[main.Evaluator(interner=interner).evaluate_program(program) for program in programs])
+
+    return [(label, best_time(func, programs, repeat))
+            for label, func in (('json text', json_text), ('plain', plain), ('interned', interned))]
+
+
+def generate_common(entries):
+    # Одни и те же операции над неконстантными определениями в каждой записи
+    lines = ['(def TAGS array("common", "rare", "epic"));', '(def STATS array(10, 20, 30, 40));',
+             '(def BASE {+ {len TAGS} 7});',
+             '([']
+    for i in range(entries):
+        lines.append(f'    entry_{i}: ([ id: {i}, tags: {{len TAGS}}, damage: {{* BASE 3}}, '
+                     f'stats: {{* STATS 2}}, bonus: {{+ {{* BASE 3}} {{len TAGS}}}} ]),')
+    lines.append('    last: 0')
+    lines.append('])')
+    return '\n'.join(lines)
+
+
+class _NoReuseParser(main.Parser):
+    # Разбор без поиска повторяющихся операций - для сравнения
+    def _brace(self, op, args, token):
+        return main.BraceNode(op, args, token)
+
+
+def bench_common(source, repeat):
+    # Разбор и вычисление без повторного использования операций, с поиском
+    # повторов при разборе и с optimize() (его время входит в вычисление)
+    tokens = main.tokenize(source)
+    evaluator = main.Evaluator()
+    evaluator.evaluate_program(main.Parser(tokens).parse_program())
+    saved = evaluator.definitions.saved
+    results = []
+    for label, parser, prepare in (('no reuse', _NoReuseParser, lambda p: p),
+                                   ('parsed', main.Parser, lambda p: p),
+                                   ('optimized', main.Parser, main.optimize)):
+        program = parser(tokens).parse_program()
+        results.append((label, best_time(lambda t: parser(t).parse_program(), tokens, repeat),
+                        best_time(lambda p: main.Evaluator().evaluate_program(prepare(p)), program, repeat)))
+    return saved, results
+
+
+def bench_stream(documents, repeat):
+    # Поток небольших документов через convert_stream в одном процессе и на
+    # всех ядрах, плюс задержка ответа на одиночный документ у запущенного
+    # процесса --stream
+    import subprocess
+    data = b''.join(b'([ id: %d, name: "doc%d", weight: {* %d 3}, tags: array("a", "b") ])\x1e' % (i, i, i)
+                    for i in range(documents))
+    results = []
+    for jobs in sorted({1, os.cpu_count() or 1}):
+        elapsed = best_time(lambda d: main.convert_stream(io.BytesIO(d), io.StringIO(), jobs=jobs), data, repeat)
+        results.append((f'jobs={jobs}', elapsed, documents / elapsed))
+    process = subprocess.Popen([sys.executable, main.__file__, '--stream', '--jobs', '1'],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    latencies = []
+    for i in range(200):
+        start = time.perf_counter()
+        process.stdin.write(b'([ id: %d ])\x1e' % i)
+        process.stdin.flush()
+        process.stdout.readline()
+        latencies.append(time.perf_counter() - start)
+    process.stdin.close()
+    process.wait()
+    latencies.sort()
+    return results, latencies[len(latencies) // 2], latencies[len(latencies) * 99 // 100]
+
+
+def generate_amplified(levels):
+    # Каждое определение - массив из десяти ссылок на предыдущее: текст
+    # линеен по levels, а размер значения растет как 10 ** levels
+    lines = ['(def L0 array(%s));' % ', '.join(map(str, range(10)))]
+    for i in range(1, levels + 1):
+        lines.append('(def L%d array(%s));' % (i, ', '.join([f'L{i - 1}'] * 10)))
+    lines.append(f'([ data: L{levels} ])')
+    return '\n'.join(lines)
+
+
+def bench_limits(source, repeat, levels=5):
+    # Цена проверок на обычной конфигурации и время, за которое отклоняется
+    # конфигурация с размножением значения (без ограничений - вывод JSON)
+    program = main.optimize(main.Parser(main.tokenize(source)).parse_program())
+    results = []
+    for label, limits in (('none', None), ('bits+time', main.Limits(max_int_bits=64, timeout=60)),
+                          ('all', main.Limits(64, 10 ** 9, 10 ** 12, 100, 60))):
+        results.append((label, best_time(lambda p: main.Evaluator(limits=limits).evaluate_program(p), program, repeat)))
+    amplified = main.Parser(main.tokenize(generate_amplified(levels))).parse_program()
+
+    def unlimited(program):
+        main.dump_json(main.Evaluator().evaluate_program(program), io.StringIO(), compact=True)
+
+    def rejected(program):
+        try:
+            main.Evaluator(limits=main.Limits(max_nodes=10 ** 6)).evaluate_program(program)
+        except main.LimitError:
+            pass
+
+    return results, [(label, best_time(func, amplified, 1)) for label, func in (('unlimited', unlimited),
+                                                                               ('rejected', rejected))]
+
+
+def run(argv=None):
+    parser = argparse.ArgumentParser(description='Config converter benchmarks')
+    parser.add_argument('--entries', type=int, default=20000, help='Number of generated entries')
+    parser.add_argument('--depth', type=int, default=150, help='Nesting depth for the nested config')
+    parser.add_argument('--repeat', type=int, default=5, help='Repetitions per measurement')
+    parser.add_argument('--suite', action='store_true',
+                        help='Time each pipeline stage on synthetic configs instead of the comparisons')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic config generator')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000], help='Entries per synthetic config')
+    parser.add_argument('--nesting', type=int, default=3, help='Nesting depth of each synthetic entry')
+    parser.add_argument('--definitions', type=int, default=200, help='Definitions per synthetic config')
+    parser.add_argument('--string-length', type=int, default=16, help='Length of generated strings')
+    parser.add_argument('--op-density', type=float, default=0.3, help='Share of values computed by operators')
+    parser.add_argument('--save', help='Write suite results as JSON')
+    parser.add_argument('--baseline', help='Suite results JSON to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='Slowdown against the baseline reported as a regression (0.1 = 10%%)')
+    args = parser.parse_args(argv)
+    if args.suite:
+        return suite(args)
+
+    source = generate_config(args.entries)
+    count, results = bench_tokenize(source, args.repeat)
+    print(f"tokenize: {len(source)} chars, {count} tokens")
+    for label, elapsed, rate in results:
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms {rate:14,.0f} tokens/sec")
+    print("token stream peak memory:")
+    for label, peak in bench_token_memory(source):
+        print(f"  {label:<10} {peak / 2 ** 20:10.1f} MiB")
+    compile_time, results = bench_evaluate(source, args.repeat)
+    print(f"evaluate (compile step {compile_time * 1000:.1f} ms):")
+    for label, elapsed in results:
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms")
+    print("parse and evaluate with and without optimize():")
+    for label, elapsed in bench_optimize_pass(source, args.repeat):
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms")
+    for label, text in (('flat', source), ('nested', generate_nested(args.depth))):
+        print(f"recursive vs explicit stack ({label}):")
+        for stage, recursive, iterative in bench_recursion(text, args.repeat):
+            print(f"  {stage:<10} {recursive * 1000:10.1f} ms {iterative * 1000:10.1f} ms")
+    print(f"definitions (prelude of {args.entries}, 5 used):")
+    for label, elapsed in bench_definitions(generate_prelude(args.entries, 5), args.repeat):
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms")
+    print(f"20 configs sharing a prelude of {args.entries // 10} definitions, parse and evaluate:")
+    for label, elapsed in bench_include(args.entries // 10, 20, args.repeat):
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms")
+    saved, results = bench_common(generate_common(args.entries), args.repeat)
+    print(f"repeated brace expressions ({saved} evaluations saved): parse, evaluate")
+    for label, parsed, evaluated in results:
+        print(f"  {label:<10} {parsed * 1000:10.1f} ms {evaluated * 1000:10.1f} ms")
+    print(f"repeated blocks ({args.entries} copies): evaluate peak memory, JSON output time")
+    for label, peak, elapsed in bench_interning(generate_repeated(args.entries), args.repeat):
+        print(f"  {label:<10} {peak / 2 ** 20:10.1f} MiB {elapsed * 1000:10.1f} ms")
+    path = f'entry_{args.entries // 2}.tags[2]'
+    print(f"evaluate full vs --select {path}:")
+    for label, elapsed in bench_select(source, path, args.repeat):
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms")
+    print(f"read {path} from the result file:")
+    for label, size, elapsed in bench_binary_lookup(source, path, args.repeat):
+        print(f"  {label:<10} {elapsed * 1000:10.3f} ms {size / 2 ** 20:10.1f} MiB file")
+    print(f"array of {args.entries} numbers times K: evaluate time, result memory")
+    for label, elapsed, peak in bench_vector(args.entries, args.repeat):
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms {peak / 2 ** 20:10.1f} MiB")
+    print(f"{args.entries * 10} sequential ids to JSON: time, peak memory")
+    for label, elapsed, peak in bench_range(args.entries * 10, args.repeat):
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms {peak / 2 ** 20:10.1f} MiB")
+    print(f"diff of two {args.entries}-entry configs with one changed constant:")
+    for label, elapsed in bench_diff(args.entries, args.repeat):
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms")
+    results, median, p99 = bench_stream(args.entries, args.repeat)
+    print(f"--stream of {args.entries} small documents (round trip median {median * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms):")
+    for label, elapsed, rate in results:
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms {rate:14,.0f} docs/sec")
+    results, amplified = bench_limits(source, args.repeat)
+    print("evaluate with resource limits:")
+    for label, elapsed in results:
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms")
+    print("10 ** 6 numbers from 6 definitions, JSON output vs rejection by --max-nodes 1000000:")
+    for label, elapsed in amplified:
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms")
+    print("watch mode update:")
+    for label, elapsed, evaluation, evaluated in bench_watch(args.entries):
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms, evaluation {evaluation * 1000:10.1f} ms "
+              f"{evaluated:10} definitions evaluated")
+    print("JSON output:")
+    for label, elapsed, peak in bench_output(source, args.repeat):
+        print(f"  {label:<10} {elapsed * 1000:10.1f} ms {peak / 2 ** 20:10.1f} MiB peak")
+    print("parse peak memory (file -> AST):")
+    for label, peak in bench_parse_memory(source):
+        print(f"  {label:<10} {peak / 2 ** 20:10.1f} MiB")
+
+
+if __name__ == '__main__':
+    sys.exit(run())
@@ -1,24 +1,88 @@
+import _thread
 import sys
-import json
-import argparse
 import re
+import codecs
+import gc
+import operator
+import os
+import stat
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import islice, repeat
+
+# argparse, json, concurrent.futures, hashlib, mmap, struct, tempfile, shutil,
+# glob, socket и socketserver нужны только командной строке, серверу, кэшам,
+# двоичному формату и пакетному режиму и импортируются там, чтобы модуль
+# быстро загружался как библиотека (блокировки - из _thread, без threading).
+# Кодирование строк берем прямо из ускорителя модуля json.
+try:
+    from _json import encode_basestring
+except ImportError:
+    from json.encoder import encode_basestring
+
+__version__ = '1.1.0'
+
+
+# Строка и столбец вычисляются только при ошибке: смещения переводов строк
+# собираются при первом обращении или в release(), после которого текст
+# больше не нужен.
+class LineIndex:
+    __slots__ = ('source', 'line', 'col', 'path', '_newlines')
+
+    def __init__(self, source, line=1, col=1, path=None):
+        self.source = source
+        self.line = line  # позиция начала source (для фрагментов потока)
+        self.col = col
+        self.path = path  # подключенный файл, из которого взят source
+        self._newlines = None
+
+    def _offsets(self):
+        newlines = self._newlines
+        if newlines is None:
+            newlines = self._newlines = array('i', (m.start() for m in _NEWLINE_RE.finditer(self.source)))
+        return newlines
+
+    def release(self):
+        # Токены в узлах AST ссылаются на индекс и не должны удерживать текст
+        if self.source is not None:
+            self._offsets()
+            self.source = None
+
+    def position(self, offset):
+        newlines = self._offsets()
+        line = bisect_left(newlines, offset)
+        if line:
+            return self.line + line, offset - newlines[line - 1]
+        return self.line, self.col + offset
 
 
 class Token:
-    __slots__ = ('type', 'value', 'line', 'col')
+    __slots__ = ('type', 'value', 'start', 'index')
 
-    def __init__(self, type, value, line, col):
+    def __init__(self, type, value, start, index):
         self.type = type
         self.value = value
-        self.line = line
-        self.col = col
+        self.start = start
+        self.index = index
+
+    @property
+    def line(self):
+        return self.index.position(self.start)[0]
+
+    @property
+    def col(self):
+        return self.index.position(self.start)[1]
 
     def __repr__(self):
         return f"Token({self.type}, {repr(self.value)}, line={self.line}, col={self.col})"
 
 
 class ASTNode:
-    pass
+    # Без __dict__ у каждого узла: в большом AST это заметная часть памяти
+    __slots__ = ()
 
 
 class NumberNode(ASTNode):
@@ -42,42 +106,61 @@ class NameNode(ASTNode):
         self.name = name
 
 
+# token у массивов, словарей и операций - открывающий токен, по которому
+# ошибки вычисления (например, LimitError) указывают место в тексте
 class ArrayNode(ASTNode):
-    __slots__ = ('elements',)
+    __slots__ = ('elements', 'token')
 
-    def __init__(self, elements):
+    def __init__(self, elements, token=None):
         self.elements = elements
+        self.token = token
 
 
 class DictNode(ASTNode):
-    __slots__ = ('pairs',)
+    __slots__ = ('pairs', 'token')
 
-    def __init__(self, pairs):
+    def __init__(self, pairs, token=None):
         self.pairs = pairs  # list of (name, expr)
+        self.token = token
 
 
 class BraceNode(ASTNode):
-    __slots__ = ('op', 'args')
+    __slots__ = ('op', 'args', 'common', 'token')
 
-    def __init__(self, op, args):
+    def __init__(self, op, args, token=None):
         self.op = op
         self.args = args
+        self.token = token
+        # (первый такой же узел, имена, от которых зависит операция), если
+        # операция встречается в программе несколько раз (см. Parser._brace и
+        # Optimizer._build); иначе None
+        self.common = None
 
 
 class Definition(ASTNode):
-    __slots__ = ('name', 'value_expr')
+    __slots__ = ('name', 'value_expr', 'token')
 
-    def __init__(self, name, value_expr):
+    def __init__(self, name, value_expr, token=None):
         self.name = name
         self.value_expr = value_expr
+        self.token = token  # токен def: по нему Watcher находит текст определения
+
+
+class Include(ASTNode):
+    __slots__ = ('path', 'token')
+
+    def __init__(self, path, token=None):
+        self.path = path  # абсолютный путь
+        self.token = token
 
 
 class Program(ASTNode):
-    __slots__ = ('definitions', 'main_expr')
+    __slots__ = ('definitions', 'main_expr', 'includes')
 
-    def __init__(self, definitions, main_expr):
+    def __init__(self, definitions, main_expr, includes=()):
         self.definitions = definitions
         self.main_expr = main_expr
+        self.includes = includes  # пути подключенных файлов
 
 
 class ConfigError(Exception):
@@ -87,160 +170,471 @@ class ConfigError(Exception):
         super().__init__(message)
 
 
+# Пробелы и комментарии поглощаются префиксом самого токена, поэтому
+# на каждый токен приходится ровно одно совпадение регулярного выражения.
+_SKIP = r'[ \t\r\n]*(?:%[^\n]*[ \t\r\n]*)*'
+_TOKEN_SPECS = [
+    ('NAME', r'[A-Za-z_][A-Za-z0-9_]*'),  # Ключевые слова различаются по _KEYWORDS
+    ('NUMBER', r'\d+'),
+    ('DICT_OPEN', r'\(\['),
+    ('DICT_CLOSE', r'\]\)'),
+    ('PUNCT', r'[(){}:,+\-*/;]'),
+    ('STRING', r'"(?:\\.|[^"\\])*"'),
+    ('END', r'\Z'),
+    ('MISMATCH', r'.'),
+]
+_TOKEN_RE = re.compile(_SKIP + '(?:' + '|'.join('(?P<%s>%s)' % pair for pair in _TOKEN_SPECS) + ')')
+_NEWLINE_RE = re.compile('\n')
+_CHUNK_SIZE = 1 << 20
+
+TOKEN_TYPES = (
+    'NAME', 'NUMBER', 'STRING', 'DICT_OPEN', 'DICT_CLOSE',
+    'ARRAY_KEYWORD', 'DEF', 'CHR', 'LEN',
+    'LPAREN', 'RPAREN', 'LBRACE', 'RBRACE', 'COLON', 'COMMA',
+    'PLUS', 'MINUS', 'TIMES', 'DIV', 'SEMICOLON',
+)
+_TYPE_IDS = {name: i for i, name in enumerate(TOKEN_TYPES)}
+
+# Номер группы регулярного выражения -> тип токена (или имя группы,
+# если тип уточняется по значению)
+_GROUP_KINDS = (None,) + tuple(
+    name if name in ('NAME', 'PUNCT', 'END', 'MISMATCH') else _TYPE_IDS[name]
+    for name, _ in _TOKEN_SPECS
+)
+
+_KEYWORDS = {
+    'array': _TYPE_IDS['ARRAY_KEYWORD'],
+    'def': _TYPE_IDS['DEF'],
+    'chr': _TYPE_IDS['CHR'],
+    'len': _TYPE_IDS['LEN'],
+}
+
+_PUNCTUATION = {
+    '(': _TYPE_IDS['LPAREN'],
+    ')': _TYPE_IDS['RPAREN'],
+    '{': _TYPE_IDS['LBRACE'],
+    '}': _TYPE_IDS['RBRACE'],
+    ':': _TYPE_IDS['COLON'],
+    ',': _TYPE_IDS['COMMA'],
+    '+': _TYPE_IDS['PLUS'],
+    '-': _TYPE_IDS['MINUS'],
+    '*': _TYPE_IDS['TIMES'],
+    '/': _TYPE_IDS['DIV'],
+    ';': _TYPE_IDS['SEMICOLON'],
+}
+
+
+# Поток токенов в колоночном виде: тип, начало и конец каждого токена
+# лежат в параллельных массивах, текст вырезается из исходника по запросу.
+class TokenStore:
+    __slots__ = ('source', 'types', 'starts', 'ends', 'index')
+
+    def __init__(self, source, index=None):
+        self.source = source
+        self.types = array('i')
+        self.starts = array('i')
+        self.ends = array('i')
+        self.index = index if index is not None else LineIndex(source)
+
+    def __len__(self):
+        return len(self.types)
+
+    def __getitem__(self, i):
+        return Token(TOKEN_TYPES[self.types[i]], self.value(i), self.starts[i], self.index)
+
+    def value(self, i):
+        return self.source[self.starts[i]:self.ends[i]]
+
+
 def tokenize(s):
-    token_specs = [
-        ('COMMENT', r'%[^\n]*'),
-        ('WHITESPACE', r'[ \t\r\n]+'),
-        ('DICT_OPEN', r'\(\['),
-        ('DICT_CLOSE', r'\]\)'),
-        ('ARRAY_KEYWORD', r'array'),
-        ('DEF', r'def'),
-        ('CHR', r'chr'),
-        ('LEN', r'len'),
-        ('NUMBER', r'\d+'),
-        ('STRING', r'"(?:\\.|[^"\\])*"'),
-        ('NAME', r'[A-Za-z_][A-Za-z0-9_]*'),  # Изменено: поддержка строчных букв и _
-        ('LPAREN', r'\('),
-        ('RPAREN', r'\)'),
-        ('LBRACE', r'\{'),
-        ('RBRACE', r'\}'),
-        ('COLON', r':'),
-        ('COMMA', r','),
-        ('PLUS', r'\+'),
-        ('MINUS', r'-'),
-        ('TIMES', r'\*'),
-        ('DIV', r'/'),
-        ('SEMICOLON', r';'),
-        ('MISMATCH', r'.'),
-    ]
-    tok_regex = '|'.join('(?P<%s>%s)' % pair for pair in token_specs)
-    line = 1
-    col = 1
-    tokens = []
-    for mo in re.finditer(tok_regex, s):
-        kind = mo.lastgroup
-        value = mo.group()
-        if kind == 'COMMENT' or kind == 'WHITESPACE':
-            for char in value:
-                if char == '\n':
-                    line += 1
-                    col = 1
-                else:
-                    col += 1
-            continue
+    store = TokenStore(s)
+    types_append = store.types.append
+    starts_append = store.starts.append
+    ends_append = store.ends.append
+    kinds = _GROUP_KINDS
+    keywords = _KEYWORDS
+    name_id = _TYPE_IDS['NAME']
+    punctuation = _PUNCTUATION
+    for mo in _TOKEN_RE.finditer(s):
+        group = mo.lastindex
+        kind = kinds[group]
+        start, end = mo.span(group)
+        if kind == 'NAME':
+            kind = keywords.get(mo.group(group), name_id)
+        elif kind == 'PUNCT':
+            kind = punctuation[s[start]]
+        elif kind == 'END':
+            break
         elif kind == 'MISMATCH':
-            raise ConfigError(f"Unexpected character '{value}'", Token('MISMATCH', value, line, col))
+            raise ConfigError(f"Unexpected character '{s[start]}'", Token('MISMATCH', s[start], start, store.index))
+        types_append(kind)
+        starts_append(start)
+        ends_append(end)
+    return store
+
+
+def tokenize_stream(stream, chunk_size=_CHUNK_SIZE):
+    # Читает stream (текстовый или бинарный файл, mmap) порциями и выдает
+    # TokenStore для каждой порции. Хвост порции, который может оказаться
+    # началом незавершенного токена, переносится в следующую.
+    decoder = None
+    buf = ''
+    line = col = 1
+    kinds = _GROUP_KINDS
+    keywords = _KEYWORDS
+    name_id = _TYPE_IDS['NAME']
+    punctuation = _PUNCTUATION
+    final = False
+    while not final:
+        data = stream.read(chunk_size)
+        final = not data
+        if isinstance(data, bytes):
+            if decoder is None:
+                decoder = codecs.getincrementaldecoder('utf-8')()
+            data = decoder.decode(data, final)
+        buf = buf + data if buf else data
+
+        store = TokenStore(buf, LineIndex(buf, line, col))
+        types_append = store.types.append
+        starts_append = store.starts.append
+        ends_append = store.ends.append
+        size = len(buf)
+        consumed = size
+        for mo in _TOKEN_RE.finditer(buf):
+            group = mo.lastindex
+            kind = kinds[group]
+            start, end = mo.span(group)
+            if not final and (end == size or kind == 'END' or (kind == 'MISMATCH' and buf[start] == '"')):
+                consumed = mo.start()
+                break
+            if kind == 'NAME':
+                kind = keywords.get(mo.group(group), name_id)
+            elif kind == 'PUNCT':
+                kind = punctuation[buf[start]]
+            elif kind == 'END':
+                break
+            elif kind == 'MISMATCH':
+                raise ConfigError(f"Unexpected character '{buf[start]}'", Token('MISMATCH', buf[start], start, store.index))
+            types_append(kind)
+            starts_append(start)
+            ends_append(end)
+        if len(store):
+            yield store
+
+        newlines = buf.count('\n', 0, consumed)
+        if newlines:
+            line += newlines
+            col = consumed - buf.rfind('\n', 0, consumed)
+        else:
+            col += consumed
+        buf = buf[consumed:]
 
-        token = Token(kind, value, line, col)
-        tokens.append(token)
 
-        # Update line and column
-        for char in value:
-            if char == '\n':
-                line += 1
-                col = 1
-            else:
-                col += 1
-    return tokens
+def tokenize_file(path, chunk_size=_CHUNK_SIZE):
+    import mmap
+    with open(path, 'rb') as f:
+        try:
+            source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            # Пустые файлы, каналы и устройства читаются порциями
+            source = f
+        try:
+            yield from tokenize_stream(source, chunk_size)
+        finally:
+            if source is not f:
+                source.close()
 
 
 class Parser:
-    def __init__(self, tokens):
-        self.tokens = tokens
+    def __init__(self, tokens, path=None, modules=None):
+        # tokens - TokenStore или итерируемая последовательность TokenStore
+        # (например, tokenize_stream()), которая читается по мере разбора.
+        # path - файл с текстом: (include "...") ищется относительно него,
+        # а без path - относительно текущего каталога
+        self.path = path
+        self.modules = modules if modules is not None else module_cache
+        if isinstance(tokens, TokenStore):
+            tokens = (tokens,)
+        self._batches = iter(tokens)
+        self._lookahead = None
+        self._braces = {}  # ключ операции -> первый узел с ним
+        self.tokens = None
+        self._types = ()
+        self._count = 0
         self.pos = 0
-        self.current_token = self.tokens[0] if tokens else None
+        self.current_type = None
+        self._next_batch()
+
+    @property
+    def current_token(self):
+        if self.current_type is None:
+            return None
+        return self.tokens[self.pos]
+
+    def _location(self, token_type, value):
+        # Токен текущей позиции без вырезания значения из текста
+        return Token(token_type, value, self.tokens.starts[self.pos], self.tokens.index)
+
+    def _fetch_batch(self):
+        for batch in self._batches:
+            if len(batch):
+                return batch
+        return None
+
+    def _next_batch(self):
+        batch = self._lookahead
+        if batch is None:
+            batch = self._fetch_batch()
+        self._lookahead = None
+        if self.tokens is not None:
+            self.tokens.index.release()
+        if batch is None:
+            self.current_type = None
+            return
+        self.tokens = batch
+        self._types = batch.types
+        self._count = len(batch)
+        self.pos = 0
+        self.current_type = TOKEN_TYPES[self._types[0]]
 
     def advance(self):
         self.pos += 1
-        if self.pos < len(self.tokens):
-            self.current_token = self.tokens[self.pos]
+        if self.pos < self._count:
+            self.current_type = TOKEN_TYPES[self._types[self.pos]]
         else:
-            self.current_token = None
+            self._next_batch()
 
     def peek(self):
-        if self.pos + 1 < len(self.tokens):
-            return self.tokens[self.pos + 1]
-        return None
+        if self.pos + 1 < self._count:
+            return TOKEN_TYPES[self._types[self.pos + 1]]
+        if self._lookahead is None:
+            self._lookahead = self._fetch_batch()
+            if self._lookahead is None:
+                return None
+        return TOKEN_TYPES[self._lookahead.types[0]]
 
     def consume(self, token_type, error_msg=None):
-        if self.current_token is None:
+        if self.current_type is None:
             raise ConfigError("Unexpected end of input")
-        if self.current_token.type != token_type:
+        if self.current_type != token_type:
             if error_msg:
                 raise ConfigError(error_msg, self.current_token)
-            raise ConfigError(f"Expected {token_type}, got {self.current_token.type}", self.current_token)
-        token = self.current_token
+            raise ConfigError(f"Expected {token_type}, got {self.current_type}", self.current_token)
+        value = self.tokens.value(self.pos)
         self.advance()
-        return token
+        return value
 
     def parse_program(self):
         definitions = []
-        while self.current_token and self.current_token.type == 'LPAREN':
-            next_token = self.peek()
-            if next_token and next_token.type == 'DEF':
+        while self.current_type == 'LPAREN':
+            next_type = self.peek()
+            if next_type == 'DEF':
                 definitions.append(self.parse_definition())
+            elif next_type == 'NAME':
+                definitions.append(self.parse_include())
             else:
                 break
         main_expr = self.parse_expr()
-        if self.current_token:
-            raise ConfigError(f"Unexpected token after main expression: {self.current_token.type}", self.current_token)
-        return Program(definitions, main_expr)
+        if self.current_type is not None:
+            raise ConfigError(f"Unexpected token after main expression: {self.current_type}", self.current_token)
+        includes = []
+        definitions = self.modules.expand(definitions, self.path, includes)
+        return Program(definitions, main_expr, tuple(includes))
+
+    def parse_module(self):
+        # Подключаемый файл: только определения и (include ...), без основного выражения
+        items = []
+        while self.current_type is not None:
+            if self.current_type != 'LPAREN':
+                raise ConfigError(f"Expected definition or include in included file, got {self.current_type}",
+                                  self.current_token)
+            if self.peek() == 'NAME':
+                items.append(self.parse_include())
+            else:
+                items.append(self.parse_definition())
+        return items
+
+    def parse_include(self):
+        self.consume('LPAREN')
+        token = self.current_token
+        if self.current_type != 'NAME' or self.tokens.value(self.pos) != 'include':
+            raise ConfigError("Expected 'def' or 'include' after '('", token)
+        self.advance()
+        if self.current_type != 'STRING':
+            raise ConfigError(f"Expected file name after 'include', got {self.current_type}", self.current_token)
+        name = _unescape(self.consume('STRING')[1:-1])
+        self.consume('RPAREN', "Expected ')' after included file name")
+        self.consume('SEMICOLON', "Expected ';' after include")
+        base = os.path.dirname(os.path.abspath(self.path)) if self.path else os.getcwd()
+        path = os.path.normpath(os.path.join(base, name))
+        # Файл начинает загружаться сразу, пока разбирается остальной текст
+        self.modules.prefetch(path)
+        return Include(path, token)
 
     def parse_definition(self):
         self.consume('LPAREN')
-        def_token = self.consume('DEF', "Expected 'def' after '('")
+        def_tokens, def_pos = self.tokens, self.pos
+        self.consume('DEF', "Expected 'def' after '('")
 
         # Проверяем, что после def идет имя (теперь может быть с маленькой буквы или _)
-        if self.current_token is None:
-            raise ConfigError("Expected name after 'def'", def_token)
+        if self.current_type is None:
+            raise ConfigError("Expected name after 'def'", def_tokens[def_pos])
 
-        if self.current_token.type != 'NAME':
-            raise ConfigError(f"Expected name after 'def', got {self.current_token.type}", self.current_token)
+        if self.current_type != 'NAME':
+            raise ConfigError(f"Expected name after 'def', got {self.current_type}", self.current_token)
 
-        name_token = self.consume('NAME', "Expected constant name after 'def'")
+        name = self.consume('NAME', "Expected constant name after 'def'")
         value_expr = self.parse_expr()
         self.consume('RPAREN', "Expected ')' after constant value")
         self.consume('SEMICOLON', "Expected ';' after definition")
-        return Definition(name_token.value, value_expr)
+        return Definition(name, value_expr, Token('DEF', 'def', def_tokens.starts[def_pos], def_tokens.index))
 
+    # Разбор выражения с явным стеком незакрытых массивов, словарей и
+    # операций: глубина вложенности ограничена только памятью.
     def parse_expr(self):
-        if self.current_token is None:
+        stack = []
+        while True:
+            token_type = self.current_type
+            if token_type is None:
+                raise ConfigError("Unexpected end of input")
+
+            if token_type == 'NUMBER':
+                node = NumberNode(self.consume('NUMBER'))
+            elif token_type == 'STRING':
+                node = StringNode(_unescape(self.consume('STRING')[1:-1]))
+            elif token_type == 'NAME':
+                node = NameNode(self.consume('NAME'))
+            elif token_type == 'ARRAY_KEYWORD':
+                token = self._location('ARRAY_KEYWORD', 'array')
+                self.consume('ARRAY_KEYWORD')
+                self.consume('LPAREN', "Expected '(' after 'array'")
+                if self.current_type is not None and self.current_type != 'RPAREN':
+                    stack.append((ArrayNode, [], token))
+                    continue
+                self.consume('RPAREN', "Expected ')' to close array")
+                node = ArrayNode([], token)
+            elif token_type == 'DICT_OPEN':
+                token = self._location('DICT_OPEN', '([')
+                self.consume('DICT_OPEN')
+                if self.current_type is not None and self.current_type != 'DICT_CLOSE':
+                    stack.append((DictNode, [], token, [self._parse_dict_key()]))
+                    continue
+                self.consume('DICT_CLOSE', "Expected '])' to close dictionary")
+                node = DictNode([], token)
+            elif token_type == 'LBRACE':
+                token = self._location('LBRACE', '{')
+                self.consume('LBRACE')
+                op_str = self._parse_brace_op()
+                if self.current_type is not None and self.current_type != 'RBRACE':
+                    stack.append((BraceNode, [], token, op_str))
+                    continue
+                self.consume('RBRACE', "Expected '}' to close brace expression")
+                node = self._brace(op_str, [], token)
+            else:
+                raise ConfigError(f"Unexpected token in expression: {token_type}", self.current_token)
+
+            # Выражение разобрано: добавляем его в незакрытые контейнеры
+            while stack:
+                frame = stack[-1]
+                kind = frame[0]
+                if kind is ArrayNode:
+                    frame[1].append(node)
+                    if self.current_type == 'COMMA':
+                        self.consume('COMMA')
+                        break
+                    self.consume('RPAREN', "Expected ')' to close array")
+                    node = ArrayNode(frame[1], frame[2])
+                elif kind is DictNode:
+                    keys = frame[3]
+                    frame[1].append((keys[-1], node))
+                    if self.current_type == 'COMMA':
+                        self.consume('COMMA')
+                        keys.append(self._parse_dict_key())
+                        break
+                    self.consume('DICT_CLOSE', "Expected '])' to close dictionary")
+                    node = DictNode(frame[1], frame[2])
+                else:
+                    frame[1].append(node)
+                    if self.current_type is not None and self.current_type != 'RBRACE':
+                        break
+                    self.consume('RBRACE', "Expected '}' to close brace expression")
+                    node = self._brace(frame[3], frame[1], frame[2])
+                stack.pop()
+            else:
+                return node
+
+    def _brace(self, op, args, token):
+        # Повторяющиеся операции над числами, строками, именами и такими же
+        # операциями отмечаются общим common, и Evaluator вычисляет их один
+        # раз для каждого набора определений (см. _common_key). Ключ - текст
+        # листьев (число не совпадает с именем: начинается с цифры) и первые
+        # узлы операций-аргументов, поэтому операция стоит одного поиска в словаре
+        node = BraceNode(op, args, token)
+        key = [op]
+        append = key.append
+        for arg in args:
+            cls = arg.__class__
+            if cls is NameNode:
+                append(arg.name)
+            elif cls is NumberNode:
+                append(arg.value)
+            elif cls is BraceNode:
+                append(arg if arg.common is None else arg.common[0])
+            elif cls is StringNode:
+                append((arg.value,))
+            else:
+                return node
+        key = tuple(key)
+        first = self._braces.setdefault(key, node)
+        if first is not node:
+            if first.common is None:
+                first.common = (first, tuple(_referenced_names(first, ordered=True)))
+            node.common = first.common
+        return node
+
+    def _parse_dict_key(self):
+        # Проверяем, что ключ словаря - это допустимое имя
+        if self.current_type != 'NAME':
+            raise ConfigError(f"Expected key name in dictionary, got {self.current_type}",
+                              self.current_token)
+
+        name = self.consume('NAME', "Expected key name in dictionary")
+        self.consume('COLON', "Expected ':' after key name")
+        return name
+
+    def _parse_brace_op(self):
+        op_type = self.current_type
+        if op_type is None:
+            raise ConfigError("Unexpected end of input in brace expression")
+
+        op_value = self.tokens.value(self.pos)
+        # Поддерживаем операторы как в верхнем, так и в нижнем регистре
+        if op_type in ['PLUS', 'MINUS', 'TIMES', 'DIV']:
+            op_str = op_value
+            self.advance()
+        elif op_type in ['CHR', 'LEN'] or \
+                (op_type == 'NAME' and op_value.lower() in ['chr', 'len', 'range']):
+            # Приводим к нижнему регистру для единообразия
+            op_str = op_value.lower()
+            self.advance()
+        else:
+            raise ConfigError(f"Expected operator in brace expression, got {op_type}", self.current_token)
+        return op_str
+
+
+# Рекурсивный разбор выражений - эталон для проверки и замеров
+class RecursiveParser(Parser):
+    def parse_expr(self):
+        token_type = self.current_type
+        if token_type is None:
             raise ConfigError("Unexpected end of input")
 
-        token_type = self.current_token.type
         if token_type == 'NUMBER':
-            token = self.consume('NUMBER')
-            return NumberNode(token.value)
+            return NumberNode(self.consume('NUMBER'))
         elif token_type == 'STRING':
-            token = self.consume('STRING')
-            raw_str = token.value[1:-1]
-            unescaped = ''
-            i = 0
-            while i < len(raw_str):
-                if raw_str[i] == '\\':
-                    i += 1
-                    if i < len(raw_str):
-                        c = raw_str[i]
-                        if c == '"':
-                            unescaped += '"'
-                        elif c == '\\':
-                            unescaped += '\\'
-                        elif c == 'n':
-                            unescaped += '\n'
-                        elif c == 't':
-                            unescaped += '\t'
-                        else:
-                            unescaped += c
-                        i += 1
-                    else:
-                        unescaped += '\\'
-                else:
-                    unescaped += raw_str[i]
-                    i += 1
-            return StringNode(unescaped)
+            return StringNode(_unescape(self.consume('STRING')[1:-1]))
         elif token_type == 'NAME':
-            token = self.consume('NAME')
-            return NameNode(token.value)
+            return NameNode(self.consume('NAME'))
         elif token_type == 'ARRAY_KEYWORD':
             return self.parse_array_expr()
         elif token_type == 'DICT_OPEN':
@@ -251,77 +645,513 @@ class Parser:
             raise ConfigError(f"Unexpected token in expression: {token_type}", self.current_token)
 
     def parse_array_expr(self):
+        token = self._location('ARRAY_KEYWORD', 'array')
         self.consume('ARRAY_KEYWORD')
         self.consume('LPAREN', "Expected '(' after 'array'")
         elements = []
-        if self.current_token and self.current_token.type != 'RPAREN':
+        if self.current_type is not None and self.current_type != 'RPAREN':
             elements.append(self.parse_expr())
-            while self.current_token and self.current_token.type == 'COMMA':
+            while self.current_type == 'COMMA':
                 self.consume('COMMA')
                 elements.append(self.parse_expr())
         self.consume('RPAREN', "Expected ')' to close array")
-        return ArrayNode(elements)
+        return ArrayNode(elements, token)
 
     def parse_dict_expr(self):
+        token = self._location('DICT_OPEN', '([')
         self.consume('DICT_OPEN')
         pairs = []
-        if self.current_token and self.current_token.type != 'DICT_CLOSE':
+        if self.current_type is not None and self.current_type != 'DICT_CLOSE':
             while True:
-                # Проверяем, что ключ словаря - это допустимое имя
-                if self.current_token.type != 'NAME':
-                    raise ConfigError(f"Expected key name in dictionary, got {self.current_token.type}",
-                                      self.current_token)
-
-                name_token = self.consume('NAME', "Expected key name in dictionary")
-                self.consume('COLON', "Expected ':' after key name")
+                name = self._parse_dict_key()
                 value_expr = self.parse_expr()
-                pairs.append((name_token.value, value_expr))
-                if self.current_token and self.current_token.type == 'COMMA':
+                pairs.append((name, value_expr))
+                if self.current_type == 'COMMA':
                     self.consume('COMMA')
                 else:
                     break
         self.consume('DICT_CLOSE', "Expected '])' to close dictionary")
-        return DictNode(pairs)
+        return DictNode(pairs, token)
 
     def parse_brace_expr(self):
+        token = self._location('LBRACE', '{')
         self.consume('LBRACE')
-        if self.current_token is None:
-            raise ConfigError("Unexpected end of input in brace expression")
-
-        op_token = self.current_token
-        # Поддерживаем операторы как в верхнем, так и в нижнем регистре
-        if op_token.type in ['PLUS', 'MINUS', 'TIMES', 'DIV']:
-            op_str = op_token.value
-            self.advance()
-        elif op_token.type in ['CHR', 'LEN'] or \
-                (op_token.type == 'NAME' and op_token.value.lower() in ['chr', 'len']):
-            # Приводим к нижнему регистру для единообразия
-            op_str = op_token.value.lower()
-            self.advance()
-        else:
-            raise ConfigError(f"Expected operator in brace expression, got {op_token.type}", op_token)
-
+        op_str = self._parse_brace_op()
         args = []
-        while self.current_token and self.current_token.type != 'RBRACE':
+        while self.current_type is not None and self.current_type != 'RBRACE':
             args.append(self.parse_expr())
 
         self.consume('RBRACE', "Expected '}' to close brace expression")
-        return BraceNode(op_str, args)
+        return BraceNode(op_str, args, token)
+
+
+# Разобранные подключаемые файлы, общие для всех программ процесса. Запись
+# актуальна, пока у файла не изменились mtime и размер; иначе сравнивается
+# хэш содержимого (как в ProgramCache). Подключения внутри файла хранятся
+# узлами Include и раскрываются в expand() - так кэш не зависит от того,
+# кто подключил файл, а циклы видны по цепочке подключений.
+class ModuleCache:
+    MAX_WORKERS = 8
+
+    def __init__(self):
+        self._entries = {}  # путь -> (mtime_ns, size, digest, items)
+        self._locks = {}
+        self._lock = _thread.allocate_lock()
+        self._executor = None
+        self.hits = 0
+        self.misses = 0
+
+    def _path_lock(self, path):
+        with self._lock:
+            lock = self._locks.get(path)
+            if lock is None:
+                lock = self._locks[path] = _thread.allocate_lock()
+            return lock
+
+    def prefetch(self, path):
+        # Независимые подключения загружаются параллельно в фоновых потоках;
+        # ошибки здесь не важны - их сообщит load() при раскрытии
+        with self._lock:
+            if self._executor is None:
+                import concurrent.futures
+                self._executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(self.MAX_WORKERS, os.cpu_count() or 1), thread_name_prefix='include')
+            executor = self._executor
+        executor.submit(self._prefetch, path)
+
+    def _prefetch(self, path):
+        try:
+            self.load(path)
+        except Exception:
+            pass
+
+    def load(self, path):
+        with self._path_lock(path):
+            st = os.stat(path)
+            entry = self._entries.get(path)
+            if entry is not None and entry[:2] == (st.st_mtime_ns, st.st_size):
+                with self._lock:
+                    self.hits += 1
+                return entry[3]
+            with open(path, 'rb') as f:
+                data = f.read()
+            import hashlib
+            digest = hashlib.sha256(data).digest()
+            if entry is not None and entry[2] == digest:
+                items = entry[3]
+                with self._lock:
+                    self.hits += 1
+            else:
+                try:
+                    tokens = tokenize(data.decode('utf-8'))
+                    tokens.index.path = path
+                    items = Parser(tokens, path, self).parse_module()
+                except ConfigError as e:
+                    raise ConfigError(f"{os.path.relpath(path)}: {str(e)}") from None
+                except UnicodeDecodeError as e:
+                    raise ConfigError(f"{os.path.relpath(path)}: {str(e)}") from None
+                with self._lock:
+                    self.misses += 1
+            self._entries[path] = (st.st_mtime_ns, st.st_size, digest, items)
+            return items
+
+    def expand(self, items, path=None, includes=None):
+        # Заменяет узлы Include определениями файлов. Каждый файл подключается
+        # в программу один раз; includes пополняется путями подключенных файлов
+        if not any(isinstance(item, Include) for item in items):
+            return items
+        root = os.path.abspath(path) if path else None
+        seen = {root}
+        definitions = []
+        stack = [(iter(items), root)]
+        while stack:
+            for item in stack[-1][0]:
+                if not isinstance(item, Include):
+                    definitions.append(item)
+                    continue
+                chain = [p for _, p in stack if p is not None]
+                if item.path in chain:
+                    cycle = ' -> '.join(os.path.relpath(p) for p in chain[chain.index(item.path):] + [item.path])
+                    raise self._error(f"Include cycle: {cycle}", item, stack[-1][1], root)
+                if item.path in seen:
+                    continue
+                seen.add(item.path)
+                try:
+                    module = self.load(item.path)
+                except OSError as e:
+                    message = f"Cannot include {os.path.relpath(item.path)}: {e.strerror}"
+                    raise self._error(message, item, stack[-1][1], root) from None
+                if includes is not None:
+                    includes.append(item.path)
+                stack.append((iter(module), item.path))
+                break
+            else:
+                stack.pop()
+        return definitions
+
+    @staticmethod
+    def _error(message, include, path, root):
+        # Позиция в подключенном файле дополняется его именем
+        error = ConfigError(message, include.token)
+        if path != root:
+            error = ConfigError(f"{os.path.relpath(path)}: {str(error)}")
+        return error
+
+    def __len__(self):
+        return len(self._entries)
+
+
+module_cache = ModuleCache()
+
+
+def _file_stats(paths):
+    # mtime и размер файлов: по ним кэши замечают изменение подключенных файлов
+    stats = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            stats.append((st.st_mtime_ns, st.st_size))
+        except OSError:
+            stats.append(None)
+    return tuple(stats)
+
+
+_ESCAPES = {'"': '"', '\\': '\\', 'n': '\n', 't': '\t'}
+
+
+def _unescape(raw_str):
+    if '\\' not in raw_str:
+        return raw_str
+    unescaped = []
+    i = 0
+    while i < len(raw_str):
+        if raw_str[i] == '\\':
+            i += 1
+            if i < len(raw_str):
+                c = raw_str[i]
+                unescaped.append(_ESCAPES.get(c, c))
+                i += 1
+            else:
+                unescaped.append('\\')
+        else:
+            unescaped.append(raw_str[i])
+            i += 1
+    return ''.join(unescaped)
+
+
+# Ограничения вычисления недоверенных конфигураций; None - без ограничения.
+# max_int_bits - разрядность целых результатов операций (проверяется и при
+# свертке констант), max_nodes, max_bytes и max_depth - число узлов,
+# примерный размер компактного JSON и вложенность каждого построенного
+# значения, timeout - секунды от создания Evaluator.
+class Limits:
+    __slots__ = ('max_int_bits', 'max_nodes', 'max_bytes', 'max_depth', 'timeout')
+
+    def __init__(self, max_int_bits=None, max_nodes=None, max_bytes=None, max_depth=None, timeout=None):
+        self.max_int_bits = max_int_bits
+        self.max_nodes = max_nodes
+        self.max_bytes = max_bytes
+        self.max_depth = max_depth
+        self.timeout = timeout
+
+
+# Превышение Limits. Ошибка не дополняется контекстом объемлющих операций и
+# определений: место в тексте (и подключенный файл) уже в сообщении.
+class LimitError(ConfigError):
+    def __init__(self, message, token=None):
+        if token is not None and token.index.path is not None:
+            message = f"{os.path.relpath(token.index.path)}: Line {token.line}, Col {token.col}: {message}"
+            token = None
+        super().__init__(message, token)
+
+
+def _int_bits(value):
+    # Наибольшая разрядность целых в результате операции
+    cls = value.__class__
+    if cls is int:
+        return value.bit_length()
+    if cls is list or cls is array:
+        return max(max(value).bit_length(), min(value).bit_length()) if value else 0
+    if cls is range:
+        return max(value.start.bit_length(), value.stop.bit_length())
+    return 0
+
+
+_INT_EXACT_WIDTH = 10 ** 18
+
+
+def _int_width(value):
+    # Длина записи целого; для длинных чисел - оценка сверху по разрядности
+    if -_INT_EXACT_WIDTH < value < _INT_EXACT_WIDTH:
+        return len(str(value))
+    return (value.bit_length() * 1233 >> 12) + 2
 
 
 class Evaluator:
-    def __init__(self, env=None):
+    def __init__(self, env=None, interner=None, limits=None):
         self.env = env if env is not None else {}
+        self.interner = interner
+        self.limits = limits
+        self._deadline = None
+        self._sizes = None
+        if limits is not None:
+            if limits.timeout is not None:
+                self._deadline = time.perf_counter() + limits.timeout
+            if (limits.max_nodes, limits.max_bytes, limits.max_depth) != (None, None, None):
+                # id значения -> (значение, (узлы, байты, глубина)); значение
+                # хранится, чтобы его id не достался другому объекту
+                self._sizes = {}
+
+    # Обход в обратном порядке с явным стеком: для каждого незавершенного
+    # массива, словаря или операции хранится список уже вычисленных значений
+    def evaluate(self, node):
+        stack = []
+        pending = {}  # повторяющаяся операция -> ключ ее значения в table.memo
+        env = self.env
+        interner = self.interner
+        limits = self.limits
+        try:
+            while True:
+                if isinstance(node, NumberNode):
+                    value = int(node.value)
+                elif isinstance(node, StringNode):
+                    value = node.value
+                elif isinstance(node, NameNode):
+                    try:
+                        value = env[node.name]
+                    except KeyError:
+                        raise ConfigError(f"Undefined constant: {node.name}") from None
+                elif isinstance(node, ArrayNode):
+                    if node.elements:
+                        stack.append((node, node.elements, []))
+                        node = node.elements[0]
+                        continue
+                    value = []
+                elif isinstance(node, DictNode):
+                    if node.pairs:
+                        children = [expr for _, expr in node.pairs]
+                        stack.append((node, children, []))
+                        node = children[0]
+                        continue
+                    value = {}
+                elif isinstance(node, BraceNode):
+                    # Повторяющаяся операция вычисляется один раз для каждого набора
+                    # определений, на которые ссылается (см. _common_key)
+                    key = _common_key(node, env) if node.common is not None else None
+                    if key is not None and key in env.table.memo:
+                        env.table.saved += 1
+                        value = env.table.memo[key]
+                    elif node.args:
+                        if key is not None:
+                            pending[node] = key
+                        stack.append((node, node.args, []))
+                        node = node.args[0]
+                        continue
+                    else:
+                        value = self.apply_brace(node, [])
+                        if key is not None:
+                            env.table.memo[key] = value
+                else:
+                    raise ConfigError(f"Unknown node type: {type(node)}")
+                if interner is not None:
+                    value = interner.intern(value)
+
+                while stack:
+                    parent, children, values = stack[-1]
+                    values.append(value)
+                    if len(values) < len(children):
+                        node = children[len(values)]
+                        break
+                    stack.pop()
+                    if isinstance(parent, ArrayNode):
+                        value = values
+                    elif isinstance(parent, DictNode):
+                        value = {name: item for (name, _), item in zip(parent.pairs, values)}
+                    else:
+                        value = self.apply_brace(parent, values)
+                        if pending and parent in pending:
+                            env.table.memo[pending.pop(parent)] = value
+                    if interner is not None:
+                        value = interner.intern(value)
+                    if limits is not None:
+                        self._check_limits(value, parent)
+                else:
+                    return value
+        except (DefinitionError, LimitError):
+            raise
+        except Exception as e:
+            # Как и при рекурсивном вычислении, каждая объемлющая операция
+            # добавляет к сообщению свой контекст
+            for parent, _, _ in reversed(stack):
+                if isinstance(parent, BraceNode):
+                    e = ConfigError(f"Error evaluating arguments for {parent.op}: {str(e)}")
+            raise e
+
+    def _check_limits(self, value, node):
+        # Вызывается для каждого вычисленного массива, словаря и операции
+        limits = self.limits
+        self._check_deadline(node)
+        if limits.max_int_bits is not None and node.__class__ is BraceNode:
+            bits = _int_bits(value)
+            if bits > limits.max_int_bits:
+                raise LimitError(f"Result of {node.op} has {bits} bits, limit is {limits.max_int_bits}",
+                                 node.token)
+        if self._sizes is not None and value.__class__ is not int and value.__class__ is not str:
+            nodes, size, depth = self._measure(value)
+            if limits.max_nodes is not None and nodes > limits.max_nodes:
+                raise LimitError(f"Value has {nodes} nodes, limit is {limits.max_nodes}", node.token)
+            if limits.max_bytes is not None and size > limits.max_bytes:
+                raise LimitError(f"Value takes about {size} bytes of JSON, limit is {limits.max_bytes}", node.token)
+            if limits.max_depth is not None and depth > limits.max_depth:
+                raise LimitError(f"Value has {depth} levels of nesting, limit is {limits.max_depth}", node.token)
+
+    def _check_deadline(self, node):
+        if self._deadline is not None and time.perf_counter() > self._deadline:
+            raise LimitError(f"Evaluation time limit of {self.limits.timeout} s exceeded", node.token)
+
+    def _check_size(self, count, node):
+        # Поэлементный результат из count чисел: не меньше count + 1 узлов и
+        # двух символов JSON на число
+        limits = self.limits
+        if limits.max_nodes is not None and count + 1 > limits.max_nodes:
+            raise LimitError(f"Value has {count + 1} nodes, limit is {limits.max_nodes}", node.token)
+        if limits.max_bytes is not None and 2 * count + 1 > limits.max_bytes:
+            raise LimitError(f"Value takes about {2 * count + 1} bytes of JSON, limit is {limits.max_bytes}",
+                             node.token)
+
+    def _measure(self, value):
+        # Узлы, примерный размер в компактном JSON (строки - в символах, без
+        # экранирования) и глубина значения. Значения, построенные этим
+        # Evaluator, уже измерены, поэтому массив или словарь обходится на
+        # один уровень
+        cls = value.__class__
+        if cls is str:
+            return 1, len(value) + 2, 0
+        if cls is int:
+            return 1, _int_width(value), 0
+        entry = self._sizes.get(id(value))
+        if entry is not None:
+            return entry[1]
+        if cls is list or cls is dict:
+            nodes, size, depth = len(value) + 1, max(len(value), 1) + 1, 0
+            items = value
+            if cls is dict:
+                size += sum(map(len, value)) + 3 * len(value)
+                items = value.values()
+            sizes = self._sizes
+            for item in items:
+                # Строки и небольшие числа учитываются на месте
+                item_cls = item.__class__
+                if item_cls is str:
+                    size += len(item) + 2
+                elif item_cls is int and -_INT_EXACT_WIDTH < item < _INT_EXACT_WIDTH:
+                    size += len(str(item))
+                else:
+                    entry = sizes.get(id(item))
+                    n, b, d = entry[1] if entry is not None else self._measure(item)
+                    nodes += n - 1
+                    size += b
+                    if d > depth:
+                        depth = d
+            result = nodes, size, depth + 1
+        elif value:
+            # array и range: ширина числа - не больше, чем у крайних значений
+            if cls is range:
+                count = _length(value)
+                width = max(_int_width(value[0]), _int_width(value[-1]))
+            else:
+                count = len(value)
+                width = max(_int_width(min(value)), _int_width(max(value)))
+            result = count + 1, count * (width + 1) + 1, 1
+        else:
+            result = 1, 2, 1
+        self._sizes[id(value)] = (value, result)
+        return result
+
+    def apply_brace(self, node, args):
+        op = node.op.lower()  # Приводим к нижнему регистру для единообразия
+        func = BRACE_OPS.get(op)
+        if func is None:
+            raise ConfigError(f"Unknown operator: {op}")
+        if (self.limits is not None and op in _ELEMENTWISE_OPS and len(args) == 2 and
+                (isinstance(args[0], _VECTOR_TYPES) or isinstance(args[1], _VECTOR_TYPES))):
+            # Большой результат отвергается до построения, а время проверяется по ходу
+            return _elementwise(args, op, _ELEMENTWISE_OPS[op], lambda size: self._check_size(size, node),
+                                lambda: self._check_deadline(node))
+        return func(args)
+
+    def evaluate_program(self, program):
+        self.definitions = self._definition_table(program.definitions)
+        return self.evaluate_in(program.main_expr, self.definitions.scope())
+
+    def _definition_table(self, definitions):
+        return DefinitionTable(definitions, lambda i, env: self.evaluate_in(definitions[i].value_expr, env), self.env)
+
+    # Вычисляет только значение по пути вида "player.stats[0].health": путь
+    # проходится по узлам DictNode и ArrayNode (и по ссылкам на определения),
+    # а вычисляется лишь найденное поддерево и нужные ему определения
+    def evaluate_path(self, program, path):
+        steps = parse_path(path) if isinstance(path, str) else list(path)
+        definitions = program.definitions
+        table = self.definitions = self._definition_table(definitions)
+        node, index = program.main_expr, None
+        for n, step in enumerate(steps):
+            while isinstance(node, NameNode):
+                target = table.resolve(node.name, index)
+                if target is None:
+                    break
+                node, index = definitions[target].value_expr, target
+            if isinstance(node, DictNode) and isinstance(step, str):
+                for name, expr in reversed(node.pairs):
+                    if name == step:
+                        node = expr
+                        break
+                else:
+                    raise ConfigError(f"Path not found: {_format_path(steps[:n + 1])}")
+            elif isinstance(node, ArrayNode) and isinstance(step, int):
+                if not -len(node.elements) <= step < len(node.elements):
+                    raise ConfigError(f"Path not found: {_format_path(steps[:n + 1])}")
+                node = node.elements[step]
+            elif isinstance(node, (DictNode, ArrayNode)):
+                raise ConfigError(f"Path not found: {_format_path(steps[:n + 1])}")
+            else:
+                # Значение получается операцией или из внешнего окружения -
+                # вычисляем его и продолжаем путь по значению
+                return _select_value(self._evaluate_at(node, index), steps, n)
+        return self._evaluate_at(node, index)
+
+    def _evaluate_at(self, node, index):
+        table = self.definitions
+        if index is None:
+            return self.evaluate_in(node, table.scope())
+        try:
+            return self.evaluate_in(node, table.scope(index))
+        except (DefinitionError, LimitError):
+            raise
+        except Exception as e:
+            raise DefinitionError(f"Error in definition '{table.definitions[index].name}': {str(e)}")
 
+    def evaluate_in(self, node, env):
+        saved = self.env
+        self.env = env
+        try:
+            return self.evaluate(node)
+        finally:
+            self.env = saved
+
+
+# Рекурсивное вычисление - эталон для проверки и замеров
+class RecursiveEvaluator(Evaluator):
     def evaluate(self, node):
         if isinstance(node, NumberNode):
             return int(node.value)
         elif isinstance(node, StringNode):
             return node.value
         elif isinstance(node, NameNode):
-            if node.name in self.env:
+            try:
                 return self.env[node.name]
-            raise ConfigError(f"Undefined constant: {node.name}")
+            except KeyError:
+                raise ConfigError(f"Undefined constant: {node.name}") from None
         elif isinstance(node, ArrayNode):
             return [self.evaluate(elem) for elem in node.elements]
         elif isinstance(node, DictNode):
@@ -334,85 +1164,2574 @@ class Evaluator:
     def evaluate_brace(self, node):
         try:
             args = [self.evaluate(arg) for arg in node.args]
+        except DefinitionError:
+            raise
         except Exception as e:
             raise ConfigError(f"Error evaluating arguments for {node.op}: {str(e)}")
+        return self.apply_brace(node, args)
 
-        op = node.op.lower()  # Приводим к нижнему регистру для единообразия
-        if op == '+':
-            self._check_arity(args, 2, '+')
-            self._check_all_int(args, '+')
-            return args[0] + args[1]
-        elif op == '-':
-            self._check_arity(args, 2, '-')
-            self._check_all_int(args, '-')
-            return args[0] - args[1]
-        elif op == '*':
-            self._check_arity(args, 2, '*')
-            self._check_all_int(args, '*')
-            return args[0] * args[1]
-        elif op == '/':
-            self._check_arity(args, 2, '/')
-            self._check_all_int(args, '/')
-            if args[1] == 0:
-                raise ConfigError("Division by zero in constant expression")
-            return args[0] // args[1]
-        elif op == 'chr':
-            self._check_arity(args, 1, 'chr')
-            if not isinstance(args[0], int):
-                raise ConfigError("chr() expects an integer argument")
+
+class DefinitionError(ConfigError):
+    pass
+
+
+# Определения вычисляются лениво, при первом обращении, и не более одного
+# раза. Имя внутри определения ссылается на последнее определение с этим
+# именем выше по тексту, а если такого нет - на последнее определение в
+# файле (ссылка вперед). Зависимости вычисляются обходом с явным стеком,
+# на котором же обнаруживаются циклы.
+class DefinitionTable:
+    def __init__(self, definitions, evaluate, base=None):
+        self.definitions = definitions
+        self.evaluate = evaluate  # evaluate(index, env) -> value
+        self.base = base if base is not None else {}
+        self.values = {}
+        self.memo = {}  # значения повторяющихся операций, см. _common_key
+        self.saved = 0  # сколько вычислений операций заменено значением из memo
+        self._positions = {}
+        for i, defn in enumerate(definitions):
+            self._positions.setdefault(defn.name, []).append(i)
+        self._dependencies = {}
+
+    @property
+    def evaluated(self):
+        return len(self.values)
+
+    def resolve(self, name, index=None):
+        # index=None - ссылка из основного выражения
+        positions = self._positions.get(name)
+        if positions is None:
+            return None
+        if index is not None:
+            k = bisect_left(positions, index)
+            if k:
+                return positions[k - 1]
+            if name in self.base:
+                return None
+        return positions[-1]
+
+    def scope(self, index=None):
+        return _DefinitionScope(self, index)
+
+    def dependencies(self, index):
+        deps = self._dependencies.get(index)
+        if deps is None:
+            deps = []
+            for name in _referenced_names(self.definitions[index].value_expr, ordered=True):
+                target = self.resolve(name, index)
+                if target is not None:
+                    deps.append(target)
+            self._dependencies[index] = deps
+        return deps
+
+    def value(self, index):
+        values = self.values
+        if index in values:
+            return values[index]
+        stack = [(index, iter(self.dependencies(index)))]
+        path = [index]
+        on_path = {index}
+        while stack:
+            current, deps = stack[-1]
+            for dep in deps:
+                if dep in values:
+                    continue
+                if dep in on_path:
+                    cycle = path[path.index(dep):] + [dep]
+                    names = ' -> '.join(self.definitions[i].name for i in cycle)
+                    raise DefinitionError(f"Circular definition: {names}")
+                stack.append((dep, iter(self.dependencies(dep))))
+                path.append(dep)
+                on_path.add(dep)
+                break
+            else:
+                stack.pop()
+                path.pop()
+                on_path.discard(current)
+                values[current] = self._evaluate(current)
+        return values[index]
+
+    def _evaluate(self, index):
+        try:
+            return self.evaluate(index, self.scope(index))
+        except (DefinitionError, LimitError):
+            raise
+        except Exception as e:
+            raise DefinitionError(f"Error in definition '{self.definitions[index].name}': {str(e)}")
+
+
+# Ключ значения повторяющейся операции: сам узел (после Optimizer равные
+# операции - один объект) и определения, на которые указывают ее имена из
+# этой области видимости. Вне DefinitionTable операции не запоминаются.
+def _common_key(node, env):
+    if env.__class__ is not _DefinitionScope:
+        return None
+    table, index = env.table, env.index
+    first, names = node.common
+    return (first,) + tuple([table.resolve(name, index) for name in names])
+
+
+class _DefinitionScope(dict):
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table, index):
+        super().__init__()
+        self.table = table
+        self.index = index
+
+    def __missing__(self, name):
+        target = self.table.resolve(name, self.index)
+        if target is None:
+            value = self.table.base[name]
+        else:
+            value = self.table.value(target)
+        self[name] = value
+        return value
+
+
+_PATH_STEP_RE = re.compile(r'\.([A-Za-z_][A-Za-z0-9_]*)|\[(-?\d+)\]')
+
+
+def parse_path(path):
+    # Первый ключ пишется без точки: "a.b[0]" разбирается как ".a.b[0]"
+    text = path if path.startswith('[') else '.' + path
+    steps = []
+    pos = 0
+    while pos < len(text):
+        mo = _PATH_STEP_RE.match(text, pos)
+        if mo is None:
+            raise ConfigError(f"Invalid path: {path}")
+        steps.append(mo.group(1) if mo.group(1) is not None else int(mo.group(2)))
+        pos = mo.end()
+    return steps
+
+
+def _format_path(steps):
+    parts = []
+    for step in steps:
+        if isinstance(step, int):
+            parts.append(f'[{step}]')
+        else:
+            parts.append(f'.{step}' if parts else step)
+    return ''.join(parts)
+
+
+def _select_value(value, steps, start):
+    for n in range(start, len(steps)):
+        step = steps[n]
+        if isinstance(value, dict) and isinstance(step, str) and step in value:
+            value = value[step]
+        elif isinstance(value, _VECTOR_TYPES) and isinstance(step, int) and -len(value) <= step < len(value):
+            value = value[step]
+        else:
+            raise ConfigError(f"Path not found: {_format_path(steps[:n + 1])}")
+    return value
+
+
+# Хэш-консинг значений: структурно равные строки, числа, массивы и словари
+# заменяются одним общим объектом, поэтому повторяющиеся блоки конфигурации
+# хранятся в памяти один раз. Элементы контейнера к этому моменту уже общие,
+# и ключ контейнера строится из их id. Общие значения нельзя изменять.
+# В shared собираются id контейнеров, встретившихся больше одного раза.
+class Interner:
+    def __init__(self):
+        self._scalars = {}
+        self._containers = {}
+        self._canonical = {}  # id -> общий контейнер
+        self.shared = set()
+        self.hits = 0
+
+    def intern(self, value):
+        cls = value.__class__
+        if cls is str or cls is int:
+            return self._scalars.setdefault((cls, value), value)
+        if cls is not list and cls is not dict:
+            return value
+        canonical = self._canonical
+        if id(value) in canonical:
+            # Повторное обращение к уже общему значению, например к константе
+            self.hits += 1
+            self.shared.add(id(value))
+            return value
+        if cls is list:
+            key = (list, tuple(map(id, value)))
+        else:
+            key = (dict, tuple(value), tuple(map(id, value.values())))
+        existing = self._containers.get(key)
+        if existing is not None:
+            self.hits += 1
+            self.shared.add(id(existing))
+            return existing
+        self._containers[key] = value
+        canonical[id(value)] = value
+        return value
+
+
+def _check_arity(args, expected, op):
+    if len(args) != expected:
+        raise ConfigError(f"{op} expects {expected} arguments, got {len(args)}")
+
+
+def _check_all_int(args, op):
+    if not all(isinstance(a, int) for a in args):
+        types = ', '.join(type(a).__name__ for a in args)
+        raise ConfigError(f"{op} expects integer arguments, got types: {types}")
+
+
+# Арифметика над массивами выполняется поэлементно, число с массивом -
+# для каждого элемента. Результат от PACK_MIN_LENGTH элементов хранится
+# упакованным в array('q'), если все значения помещаются в 64 бита. При
+# заданных Limits Evaluator проверяет размер результата до его построения,
+# а время - через каждые PACKED_CHUNK элементов.
+PACK_MIN_LENGTH = 64
+PACKED_CHUNK = 4096
+_VECTOR_TYPES = (list, array, range)
+
+
+def _length(value):
+    # len() для range длиннее sys.maxsize не работает, длина считается по границам
+    if value.__class__ is range:
+        return (value[-1] - value[0]) // value.step + 1 if value else 0
+    return len(value)
+
+
+def _as_vector(value, op):
+    # range не превращается в массив: его элементы - всегда целые
+    if value.__class__ is array or value.__class__ is range:
+        return value
+    try:
+        return array('q', value)
+    except TypeError:
+        pass
+    except OverflowError:
+        # Большие целые остаются в списке
+        if all(item.__class__ is int for item in value):
+            return value
+    types = ', '.join(sorted({type(item).__name__ for item in value if item.__class__ is not int}))
+    raise ConfigError(f"{op} expects arrays of integers, got elements of types: {types}")
+
+
+def _check_scalar(args, scalar, op):
+    if not isinstance(scalar, int):
+        types = ', '.join(type(a).__name__ for a in args)
+        raise ConfigError(f"{op} expects integer arguments, got types: {types}")
+
+
+def _elementwise(args, op, func, check_size=None, tick=None):
+    # check_size(длина) вызывается до построения результата, tick() - через
+    # каждые PACKED_CHUNK элементов
+    a, b = args
+    if isinstance(a, _VECTOR_TYPES) and isinstance(b, _VECTOR_TYPES):
+        size, other = _length(a), _length(b)
+        if size != other:
+            raise ConfigError(f"{op} expects arrays of the same length, got {size} and {other}")
+    elif isinstance(a, _VECTOR_TYPES):
+        _check_scalar(args, b, op)
+        size, b = _length(a), repeat(b)
+    else:
+        _check_scalar(args, a, op)
+        size, a = _length(b), repeat(a)
+    if check_size is not None:
+        check_size(size)
+    if a.__class__ is not repeat:
+        a = _as_vector(a, op)
+    if b.__class__ is not repeat:
+        b = _as_vector(b, op)
+    try:
+        if size >= PACK_MIN_LENGTH:
             try:
-                return chr(args[0])
-            except ValueError as e:
-                raise ConfigError(f"chr() error: {str(e)}")
-        elif op == 'len':
-            self._check_arity(args, 1, 'len')
-            arg = args[0]
-            if isinstance(arg, str) or isinstance(arg, list):
-                return len(arg)
-            raise ConfigError(f"len() expects string or array, got {type(arg).__name__}")
+                values = map(func, a, b)
+                return array('q', values if tick is None else _ticks(values, tick))
+            except OverflowError:
+                # Значение вышло за 64 бита - считаем заново в списке
+                pass
+        values = map(func, a, b)
+        return list(values if tick is None else _ticks(values, tick))
+    except ZeroDivisionError:
+        raise ConfigError("Division by zero in constant expression") from None
+
+
+def _ticks(values, tick):
+    while True:
+        chunk = tuple(islice(values, PACKED_CHUNK))
+        if not chunk:
+            return
+        tick()
+        yield from chunk
+
+
+def _arithmetic(args, op, func):
+    _check_arity(args, 2, op)
+    if isinstance(args[0], _VECTOR_TYPES) or isinstance(args[1], _VECTOR_TYPES):
+        return _elementwise(args, op, func)
+    _check_all_int(args, op)
+    return func(args[0], args[1])
+
+
+def _op_add(args):
+    return _arithmetic(args, '+', operator.add)
+
+
+def _op_sub(args):
+    return _arithmetic(args, '-', operator.sub)
+
+
+def _op_mul(args):
+    return _arithmetic(args, '*', operator.mul)
+
+
+def _op_div(args):
+    _check_arity(args, 2, '/')
+    if not isinstance(args[0], _VECTOR_TYPES) and not isinstance(args[1], _VECTOR_TYPES):
+        _check_all_int(args, '/')
+    if args[1] == 0:
+        raise ConfigError("Division by zero in constant expression")
+    return _arithmetic(args, '/', operator.floordiv)
+
+
+def _op_chr(args):
+    _check_arity(args, 1, 'chr')
+    if not isinstance(args[0], int):
+        raise ConfigError("chr() expects an integer argument")
+    try:
+        return chr(args[0])
+    except ValueError as e:
+        raise ConfigError(f"chr() error: {str(e)}")
+
+
+def _op_len(args):
+    _check_arity(args, 1, 'len')
+    arg = args[0]
+    if isinstance(arg, str) or isinstance(arg, _VECTOR_TYPES):
+        return len(arg)
+    raise ConfigError(f"len() expects string or array, got {type(arg).__name__}")
+
+
+# Последовательность не строится: range хранит только границы и шаг,
+# len и индексация работают за O(1), а JSONEmitter выводит ее частями.
+# Длина ограничена sys.maxsize, как у len() в Python
+def _op_range(args):
+    if not 2 <= len(args) <= 3:
+        raise ConfigError(f"range expects 2 or 3 arguments, got {len(args)}")
+    _check_all_int(args, 'range')
+    if len(args) == 3 and args[2] == 0:
+        raise ConfigError("range step must not be zero")
+    value = range(*args)
+    size = _length(value)
+    if size > sys.maxsize:
+        raise ConfigError(f"range has {size} elements, at most {sys.maxsize} are supported")
+    return value
+
+
+# Операторы, которые Evaluator с Limits выполняет над массивами сам (см. apply_brace)
+_ELEMENTWISE_OPS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': operator.floordiv,
+}
+
+BRACE_OPS = {
+    '+': _op_add,
+    '-': _op_sub,
+    '*': _op_mul,
+    '/': _op_div,
+    'chr': _op_chr,
+    'len': _op_len,
+    'range': _op_range,
+}
+
+
+_NESTED_TYPES = frozenset((list, dict, array))
+
+
+def _unpack(value):
+    # Результат для пользователя библиотеки: array('q') заменяется списком,
+    # чтобы тип массива не зависел от его длины. Контейнеры без array('q')
+    # внутри не копируются, общие подзначения остаются общими
+    if value.__class__ is array:
+        return value.tolist()
+    if value.__class__ is not list and value.__class__ is not dict:
+        return value
+    done = {}  # id контейнера -> он же с замененными массивами
+    stack = [value]
+    while stack:
+        item = stack[-1]
+        if id(item) in done:
+            stack.pop()
+            continue
+        nested = [child for child in (item.values() if item.__class__ is dict else item)
+                  if child.__class__ in _NESTED_TYPES]
+        pending = [child for child in nested if child.__class__ is not array and id(child) not in done]
+        if pending:
+            stack.extend(pending)
+            continue
+        stack.pop()
+        if all(child.__class__ is not array and done[id(child)] is child for child in nested):
+            done[id(item)] = item
+        elif item.__class__ is dict:
+            done[id(item)] = {name: _unpacked(child, done) for name, child in item.items()}
         else:
-            raise ConfigError(f"Unknown operator: {op}")
+            done[id(item)] = [_unpacked(child, done) for child in item]
+    return done[id(value)]
+
+
+def _unpacked(value, done):
+    if value.__class__ is array:
+        if id(value) not in done:
+            done[id(value)] = value.tolist()
+        return done[id(value)]
+    if value.__class__ is list or value.__class__ is dict:
+        return done[id(value)]
+    return value
+
+
+class CompiledProgram:
+    __slots__ = ('definitions', 'functions', 'main_expr')
+
+    def __init__(self, definitions, functions, main_expr):
+        self.definitions = definitions
+        self.functions = functions  # скомпилированные значения definitions
+        self.main_expr = main_expr
+
+    def evaluate(self, env=None):
+        functions = self.functions
+        table = DefinitionTable(self.definitions, lambda i, scope: functions[i](scope), env)
+        return _unpack(self.main_expr(table.scope()))
+
 
-    def _check_arity(self, args, expected, op):
-        if len(args) != expected:
-            raise ConfigError(f"{op} expects {expected} arguments, got {len(args)}")
+# Переводит AST в дерево замыканий вида f(env) -> value: выбор обработчика
+# узла и оператора происходит один раз при компиляции, а не при каждом вычислении.
+class Compiler:
+    def __init__(self):
+        self._common = {}  # повторяющаяся операция -> ее замыкание
 
-    def _check_all_int(self, args, op):
-        if not all(isinstance(a, int) for a in args):
-            types = ', '.join(type(a).__name__ for a in args)
-            raise ConfigError(f"{op} expects integer arguments, got types: {types}")
+    def compile_program(self, program):
+        # Замыкания не образуют циклов, а сборщик мусора на миллионах новых
+        # объектов тратит больше времени, чем сама компиляция
+        with _gc_paused():
+            functions = tuple(self.compile(defn.value_expr) for defn in program.definitions)
+            return CompiledProgram(program.definitions, functions, self.compile(program.main_expr))
+
+    def compile(self, node):
+        handler = self._handlers.get(type(node))
+        if handler is None:
+            raise ConfigError(f"Unknown node type: {type(node)}")
+        return handler(self, node)
+
+    def compile_number(self, node):
+        value = int(node.value)
+        return lambda env: value
+
+    def compile_string(self, node):
+        value = node.value
+        return lambda env: value
+
+    def compile_name(self, node):
+        name = node.name
+
+        def load(env):
+            try:
+                return env[name]
+            except KeyError:
+                raise ConfigError(f"Undefined constant: {name}") from None
+        return load
+
+    def compile_array(self, node):
+        elements = tuple(self.compile(elem) for elem in node.elements)
+        return lambda env: [f(env) for f in elements]
+
+    def compile_dict(self, node):
+        pairs = tuple((name, self.compile(expr)) for name, expr in node.pairs)
+        return lambda env: {name: f(env) for name, f in pairs}
+
+    def compile_brace(self, node):
+        if node.common is None:
+            return self._compile_brace(node)
+        memoized = self._common.get(node)
+        if memoized is None:
+            memoized = self._common[node] = self._compile_common(node, self._compile_brace(node))
+        return memoized
+
+    @staticmethod
+    def _compile_common(node, compute):
+        # Значение запоминается в таблице определений текущего вычисления,
+        # как и в Evaluator.evaluate
+        def memoized(env):
+            key = _common_key(node, env)
+            if key is None:
+                return compute(env)
+            table = env.table
+            try:
+                value = table.memo[key]
+            except KeyError:
+                value = table.memo[key] = compute(env)
+                return value
+            table.saved += 1
+            return value
+        return memoized
+
+    def _compile_brace(self, node):
+        op = node.op
+        func = BRACE_OPS.get(op.lower())
+        args = tuple(self.compile(arg) for arg in node.args)
+        if func is None:
+            def unknown(env):
+                evaluate_args(env)
+                raise ConfigError(f"Unknown operator: {op.lower()}")
+            result = unknown
+        elif len(args) == 2 and func in _INT_FAST_PATHS:
+            result = self._compile_binary(op, func, _INT_FAST_PATHS[func], *args)
+        else:
+            def apply(env):
+                return func(evaluate_args(env))
+            result = apply
+
+        def evaluate_args(env):
+            try:
+                return [f(env) for f in args]
+            except DefinitionError:
+                raise
+            except Exception as e:
+                raise ConfigError(f"Error evaluating arguments for {op}: {str(e)}")
+        return result
+
+    def _compile_binary(self, op, func, fast, left, right):
+        # Два целых аргумента вычисляются напрямую, остальные случаи
+        # (включая ошибки типов) уходят в общую реализацию оператора.
+        def binary(env):
+            try:
+                a = left(env)
+                b = right(env)
+            except DefinitionError:
+                raise
+            except Exception as e:
+                raise ConfigError(f"Error evaluating arguments for {op}: {str(e)}")
+            if a.__class__ is int and b.__class__ is int and (fast is not _floordiv or b):
+                return fast(a, b)
+            return func([a, b])
+        return binary
+
+    _handlers = {
+        NumberNode: compile_number,
+        StringNode: compile_string,
+        NameNode: compile_name,
+        ArrayNode: compile_array,
+        DictNode: compile_dict,
+        BraceNode: compile_brace,
+    }
+
+
+@contextmanager
+def _gc_paused():
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+_floordiv = operator.floordiv
+_INT_FAST_PATHS = {
+    _op_add: operator.add,
+    _op_sub: operator.sub,
+    _op_mul: operator.mul,
+    _op_div: _floordiv,
+}
+
+
+def compile_program(program):
+    return Compiler().compile_program(program)
+
+
+# Свертка констант между Parser и Evaluator: операции над литералами
+# вычисляются заранее, константы-литералы подставляются вместо ссылок,
+# а определения, на которые никто не ссылается, удаляются. Операции,
+# которые завершаются ошибкой, остаются в дереве, чтобы Evaluator сообщил
+# о них с тем же текстом и в том же порядке.
+class Optimizer:
+    def __init__(self, limits=None):
+        # С limits свертка не строит целых больше limits.max_int_bits
+        self.limits = limits
+        self._nodes = {}  # ключ структуры -> общий узел (см. _build)
+
+    def optimize_program(self, program):
+        consts = {}
+        definitions = []
+        for defn in program.definitions:
+            value_expr = self.fold(defn.value_expr, consts)
+            if isinstance(value_expr, (NumberNode, StringNode)):
+                consts[defn.name] = value_expr
+            else:
+                consts.pop(defn.name, None)
+            definitions.append(Definition(defn.name, value_expr))
+        main_expr = self.fold(program.main_expr, consts)
+        return Program(self._drop_unused(definitions, main_expr), main_expr, program.includes)
+
+    def fold(self, node, consts):
+        def leaf(node):
+            if isinstance(node, NameNode):
+                return consts.get(node.name, node)
+            return node
+        return _transform(node, leaf, self._build)
+
+    def _build(self, node, children):
+        # Свертка совмещена с хэш-консингом: структурно равные массивы,
+        # словари и операции становятся одним узлом. Ключ узла строится из
+        # ключей листьев и id уже общих дочерних узлов, поэтому повторная
+        # операция сворачивается один раз. Операция, встреченная повторно,
+        # получает в common имена, от которых зависит, и вычисляется один раз
+        child_keys = tuple(map(_share_key, children))
+        cls = node.__class__
+        if cls is BraceNode:
+            key = (BraceNode, node.op.lower(), child_keys)
+        elif cls is ArrayNode:
+            key = (ArrayNode, child_keys)
+        else:
+            key = (DictNode, tuple(name for name, _ in node.pairs), child_keys)
+        existing = self._nodes.get(key)
+        if existing is not None:
+            if existing.__class__ is BraceNode and existing.common is None:
+                # Узел построен в fold_brace, входное дерево не меняется
+                existing.common = (existing, tuple(_referenced_names(existing, ordered=True)))
+            return existing
+        if cls is BraceNode:
+            node = self.fold_brace(node, children)
+        elif any(a is not b for a, b in zip(children, _children(node))):
+            node = self._rebuild(node, children)
+        self._nodes[key] = node
+        return node
+
+    def fold_brace(self, node, args):
+        folded = BraceNode(node.op, args, node.token)
+        func = BRACE_OPS.get(node.op.lower())
+        if func is None or not all(_is_constant(arg) for arg in args):
+            return folded
+        evaluator = Evaluator()
+        try:
+            value = func([evaluator.evaluate(arg) for arg in args])
+        except ConfigError:
+            return folded
+        if isinstance(value, int):
+            limits = self.limits
+            if limits is not None and limits.max_int_bits is not None and value.bit_length() > limits.max_int_bits:
+                # Ошибку выдаст вычислитель, если значение понадобится
+                return folded
+            return NumberNode(value)
+        elif isinstance(value, str):
+            return StringNode(value)
+        return folded
+
+    @staticmethod
+    def _rebuild(node, children):
+        if isinstance(node, ArrayNode):
+            return ArrayNode(children, node.token)
+        elif isinstance(node, DictNode):
+            return DictNode([(name, child) for (name, _), child in zip(node.pairs, children)], node.token)
+        return BraceNode(node.op, children, node.token)
+
+    def _drop_unused(self, definitions, main_expr):
+        # Обратный проход: needed - имена, на которые ссылаются оставшиеся
+        # определения и основное выражение, но которые еще не связаны
+        first_index = {}
+        last_index = {}
+        for i, defn in enumerate(definitions):
+            first_index.setdefault(defn.name, i)
+            last_index[defn.name] = i
+        # Цель ссылки вперед (см. DefinitionTable) сохраняется всегда: само
+        # ссылающееся определение не считается безопасным и не удаляется
+        forward_targets = set()
+        for i, defn in enumerate(definitions):
+            for name in _referenced_names(defn.value_expr):
+                if first_index.get(name, i) >= i and name in last_index:
+                    forward_targets.add(last_index[name])
+        needed = _referenced_names(main_expr)
+        kept = []
+        for i in range(len(definitions) - 1, -1, -1):
+            defn = definitions[i]
+            if defn.name in needed:
+                needed.discard(defn.name)
+            elif i in forward_targets:
+                pass
+            elif _is_safe(defn.value_expr, first_index, i):
+                continue
+            needed |= _referenced_names(defn.value_expr)
+            kept.append(defn)
+        kept.reverse()
+        return kept
+
+
+def _children(node):
+    if isinstance(node, ArrayNode):
+        return node.elements
+    elif isinstance(node, DictNode):
+        return [expr for _, expr in node.pairs]
+    elif isinstance(node, BraceNode):
+        return node.args
+    return None
+
+
+def _iter_nodes(node):
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        children = _children(node)
+        if children:
+            stack.extend(reversed(children))
+
+
+def _transform(node, leaf, build):
+    # Пересборка дерева снизу вверх без рекурсии: leaf(node) для листьев,
+    # build(node, children) для массивов, словарей и операций
+    stack = []
+    while True:
+        children = _children(node)
+        if children:
+            stack.append((node, children, []))
+            node = children[0]
+            continue
+        result = leaf(node) if children is None else build(node, [])
+        while stack:
+            parent, children, results = stack[-1]
+            results.append(result)
+            if len(results) < len(children):
+                node = children[len(results)]
+                break
+            stack.pop()
+            result = build(parent, results)
+        else:
+            return result
+
+
+def _share_key(node):
+    cls = node.__class__
+    if cls is NumberNode or cls is StringNode:
+        return (cls, node.value)
+    elif cls is NameNode:
+        return (cls, node.name)
+    return id(node)
+
+
+def _is_constant(node):
+    return all(isinstance(n, (NumberNode, StringNode, ArrayNode, DictNode)) for n in _iter_nodes(node))
+
+
+def _referenced_names(node, ordered=False):
+    names = (n.name for n in _iter_nodes(node) if isinstance(n, NameNode))
+    if ordered:
+        return list(dict.fromkeys(names))
+    return set(names)
+
+
+def _is_safe(node, first_index, index):
+    # Определение можно удалить, только если его вычисление не может
+    # завершиться ошибкой: в нем нет операций и неопределенных имен
+    for n in _iter_nodes(node):
+        if isinstance(n, BraceNode):
+            return False
+        elif isinstance(n, NameNode) and first_index.get(n.name, index) >= index:
+            return False
+    return True
+
+
+def optimize(program, limits=None):
+    return Optimizer(limits).optimize_program(program)
+
+
+# Встраиваемый интерфейс: loads(), load() и compile() возвращают объекты
+# Python без JSON. Скомпилированные программы хранятся в ограниченном кэше
+# по хэшу текста; каждый вызов заново вычисляет программу, поэтому
+# возвращенные значения можно изменять.
+class CompiledCache:
+    DEFAULT_MAX_ENTRIES = 128
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        # sha256 текста и каталога -> (программа, подключенные файлы, их mtime и размеры)
+        self._entries = OrderedDict()
+        self._lock = _thread.allocate_lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, text, path=None, limits=None):
+        # Подключения ищутся относительно path или текущего каталога,
+        # поэтому каталог входит в ключ; программа с limits - отдельная запись
+        base = os.path.dirname(os.path.abspath(path)) if path else os.getcwd()
+        if limits is not None:
+            base += '\0limits=' + ','.join(str(getattr(limits, name)) for name in Limits.__slots__)
+        import hashlib
+        key = hashlib.sha256(f"{base}\0{text}".encode('utf-8', 'surrogatepass')).digest()
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is not None and (not entry[1] or _file_stats(entry[1]) == entry[2]):
+            with self._lock:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            return entry[0]
+        program, includes = _compile_text(text, path, limits)
+        with self._lock:
+            self.misses += 1
+            self._entries[key] = (program, includes, _file_stats(includes))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return program
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _InterpretedProgram:
+    # Замена CompiledProgram для слишком глубоких выражений (компилятор
+    # рекурсивен, а Evaluator обходит дерево с явным стеком) и для программ
+    # с Limits: проверки ограничений есть только в Evaluator
+    __slots__ = ('program', 'limits')
+
+    def __init__(self, program, limits=None):
+        self.program = program
+        self.limits = limits
+
+    def evaluate(self, env=None):
+        return _unpack(Evaluator(env, limits=self.limits).evaluate_program(self.program))
+
+
+def _compile_text(text, path=None, limits=None):
+    # Возвращает программу и пути подключенных файлов
+    program = optimize(Parser(tokenize(text), path).parse_program(), limits)
+    if limits is not None:
+        return _InterpretedProgram(program, limits), program.includes
+    try:
+        return compile_program(program), program.includes
+    except RecursionError:
+        return _InterpretedProgram(program), program.includes
+
+
+compiled_cache = CompiledCache()
+
+
+def compile(text, cache=True, path=None, limits=None):
+    # Возвращает программу с методом evaluate(env=None); path - файл,
+    # относительно которого ищутся подключения, limits - Limits для каждого вычисления
+    return compiled_cache.get(text, path, limits) if cache else _compile_text(text, path, limits)[0]
+
+
+def loads(text, env=None, limits=None):
+    return compile(text, limits=limits).evaluate(env)
+
+
+def load(path, env=None, limits=None):
+    with open(path, 'r', encoding='utf-8') as f:
+        return compile(f.read(), path=path, limits=limits).evaluate(env)
+
+
+@contextmanager
+def atomic_write(path, binary=False):
+    # Пишем во временный файл рядом и переименовываем: читатели видят либо
+    # старое содержимое, либо новое целиком
+    import tempfile
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with (os.fdopen(fd, 'wb') if binary else os.fdopen(fd, 'w', encoding='utf-8')) as f:
+            # mkstemp создает файл с правами 0600; результат получает права
+            # заменяемого файла или обычные для нового файла
+            try:
+                mode = os.stat(path).st_mode & 0o7777
+            except FileNotFoundError:
+                mode = 0o666 & ~_umask()
+            os.fchmod(fd, mode)
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _umask():
+    # Узнать umask можно, только установив его; значение читается один раз
+    global _UMASK
+    if _UMASK is None:
+        _UMASK = os.umask(0o22)
+        os.umask(_UMASK)
+    return _UMASK
+
+
+_UMASK = None
+
+
+# Кэш результатов на диске, адресуемый содержимым: ключ - хэш исходного
+# файла и версии транслятора, значение - готовый JSON. Записи пишутся во
+# временный файл и атомарно переименовываются, поэтому параллельные
+# процессы видят либо целую запись, либо ее отсутствие. Давность записи
+# отслеживается по mtime, при превышении max_bytes удаляются самые старые.
+_INCLUDE_RE = re.compile(rb'\(\s*include\s*"((?:\\.|[^"\\])*)"')
+
+
+class ResultCache:
+    DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def key_for_file(self, path, variant='json'):
+        # В ключ входит и содержимое подключенных файлов. Они ищутся в тексте
+        # без разбора: лишнее совпадение (например, в комментарии) только
+        # добавляет в ключ еще один файл
+        import hashlib
+        digest = hashlib.sha256(f"{__version__}\0{variant}\0".encode('utf-8'))
+        root = os.path.abspath(path)
+        pending = [root]
+        seen = {root}
+        while pending:
+            current = pending.pop(0)
+            base = os.path.dirname(current)
+            if current != root:
+                digest.update(b'\0' + os.fsencode(current) + b'\0')
+            try:
+                f = open(current, 'rb')
+            except OSError:
+                if current == root:
+                    raise
+                continue
+            with f:
+                tail = b''
+                for chunk in iter(lambda: f.read(_CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    data = tail + chunk
+                    for mo in _INCLUDE_RE.finditer(data):
+                        name = _unescape(mo.group(1).decode('utf-8', 'replace'))
+                        included = os.path.normpath(os.path.join(base, name))
+                        if included not in seen:
+                            seen.add(included)
+                            pending.append(included)
+                    tail = data[-4096:]
+        return digest.hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + '.json')
+
+    def open_entry(self, key):
+        # Открытый файл остается читаемым, даже если запись тут же вытеснят
+        path = self._entry_path(key)
+        try:
+            f = open(path, 'r', encoding='utf-8')
+        except FileNotFoundError:
+            self._record('misses')
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self._record('hits')
+        return f
+
+    @contextmanager
+    def write_entry(self, key):
+        with atomic_write(self._entry_path(key)) as f:
+            yield f
+        self.evict()
+
+    def _entries(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.json'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def evict(self):
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def _record(self, counter):
+        setattr(self, counter, getattr(self, counter) + 1)
+        # Счетчики за все время - одна строка "попадания промахи" в файле
+        # stats. Он заменяется целиком (atomic_write), а одновременные
+        # обновления из разных процессов упорядочивает блокировка stats.lock
+        import fcntl
+        fd = os.open(os.path.join(self.directory, 'stats.lock'), os.O_WRONLY | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            totals = self._totals()
+            totals[counter] += 1
+            with atomic_write(os.path.join(self.directory, 'stats')) as f:
+                f.write(f"{totals['hits']} {totals['misses']}\n")
+        finally:
+            os.close(fd)
+
+    def _totals(self):
+        try:
+            with open(os.path.join(self.directory, 'stats'), encoding='utf-8') as f:
+                hits, misses = map(int, f.read().split())
+        except (FileNotFoundError, ValueError):
+            hits = misses = 0
+        return {'hits': hits, 'misses': misses}
+
+    def stats(self):
+        totals = self._totals()
+        entries = self._entries()
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'total_hits': totals['hits'],
+            'total_misses': totals['misses'],
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
+
+
+class _Tee:
+    __slots__ = ('streams',)
+
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+
+
+# Пишет JSON порциями в выходной поток, обходя значение без рекурсии.
+# Вывод совпадает с json.dumps(value, ensure_ascii=False, indent=indent),
+# а при indent=None - с компактной формой separators=(',', ':').
+# Контейнеры, id которых входят в shared (см. Interner), сериализуются один
+# раз для каждой глубины, дальше используется готовый текст.
+class JSONEmitter:
+    FLUSH_PARTS = 4096
+    PACKED_CHUNK = PACKED_CHUNK
+
+    def __init__(self, out, indent=2, shared=None):
+        self.out = out
+        self.indent = indent
+        self.shared = shared
+        self._memo = {}
+        self._parts = []
+        self._newlines = ['\n'] if indent is not None else ['']
+        self._key_separator = ': ' if indent is not None else ':'
+
+    def _newline(self, depth):
+        newlines = self._newlines
+        while len(newlines) <= depth:
+            newlines.append('\n' + ' ' * (self.indent * len(newlines)) if self.indent is not None else '')
+        return newlines[depth]
+
+    def flush(self):
+        if self._parts:
+            self.out.write(''.join(self._parts))
+            self._parts = []
+
+    def emit(self, value):
+        parts = self._parts
+        append = parts.append
+        encode = encode_basestring
+        key_separator = self._key_separator
+        flush_parts = self.FLUSH_PARTS
+        shared = self.shared
+        memo = self._memo
+        captures = 0  # сколько общих контейнеров сейчас записывается
+        stack = []
+        depth = 0
+        while True:
+            cls = value.__class__
+            if cls is str:
+                append(encode(value))
+            elif cls is int:
+                append(int.__repr__(value))
+            elif cls is array or cls is range:
+                # Упакованный массив и range пишутся кусками без обхода по стеку;
+                # срез range тоже range, так что список значений не строится
+                if value:
+                    newline = self._newline(depth + 1)
+                    separator = ',' + newline
+                    append('[' + newline)
+                    for start in range(0, len(value), self.PACKED_CHUNK):
+                        if start:
+                            append(separator)
+                        append(separator.join(map(int.__repr__, value[start:start + self.PACKED_CHUNK])))
+                        if not captures:
+                            self.flush()
+                            parts = self._parts
+                            append = parts.append
+                    append(self._newline(depth) + ']')
+                else:
+                    append('[]')
+            elif cls is list or cls is dict:
+                key = None
+                if not value:
+                    append('[]' if cls is list else '{}')
+                elif shared and id(value) in shared and (id(value), depth) in memo:
+                    append(memo[id(value), depth])
+                else:
+                    if shared and id(value) in shared:
+                        key = (id(value), depth)
+                        captures += 1
+                    depth += 1
+                    if cls is list:
+                        append('[' + self._newline(depth))
+                        stack.append((iter(value), False, ']', key, len(parts) - 1))
+                    else:
+                        append('{' + self._newline(depth))
+                        stack.append((iter(value.items()), True, '}', key, len(parts) - 1))
+                    value = None
+            else:
+                raise TypeError(f"Object of type {cls.__name__} is not JSON serializable")
+
+            # Пока записывается общий контейнер, его части должны остаться в буфере
+            if not captures and len(parts) > flush_parts:
+                self.flush()
+                parts = self._parts
+                append = parts.append
+
+            # Переход к следующему элементу: закрываем исчерпанные контейнеры
+            while stack:
+                iterator, is_dict, closing, key, start = stack[-1]
+                item = next(iterator, _END)
+                if item is _END:
+                    stack.pop()
+                    depth -= 1
+                    append(self._newline(depth) + closing)
+                    if key is not None:
+                        text = ''.join(parts[start:])
+                        del parts[start:]
+                        append(text)
+                        memo[key] = text
+                        captures -= 1
+                    continue
+                if value is not None:
+                    append(',' + self._newline(depth))
+                if is_dict:
+                    append(encode(item[0]) + key_separator)
+                    value = item[1]
+                else:
+                    value = item
+                break
+            else:
+                break
+        self.flush()
+
+
+_END = object()
+
+
+def dump_json(value, out, compact=False, shared=None):
+    JSONEmitter(out, indent=None if compact else 2, shared=shared).emit(value)
+
+
+# Двоичный формат результата. Файл начинается с BINARY_MAGIC, за ним идут
+# записи значений, в конце - смещение корня (uint32) и снова b'CFGB'.
+# Все числа little-endian, смещения - от начала файла:
+#   b'i' int64                  целое
+#   b'I' uint32 n, n байт       большое целое (дополнительный код)
+#   b's' uint32 n, n байт       строка UTF-8
+#   b'a' uint32 n, n * uint32   массив: смещения элементов
+#   b'd' uint32 n, n * (uint32 ключ, uint32 значение), n * uint32
+#                               словарь: пары в исходном порядке и номера пар,
+#                               упорядоченные по байтам ключа, для двоичного поиска
+# Элементы записываются раньше содержащих их контейнеров. Одинаковые строки и
+# числа, а также один и тот же объект (см. Interner) записываются один раз.
+BINARY_MAGIC = b'CFGB\x01'
+# Форматы struct создаются при первом чтении или записи (см. _binary_formats)
+_BINARY_TRAILER = _UINT32 = _INT64 = None
+
+
+def _binary_formats():
+    global _BINARY_TRAILER, _UINT32, _INT64
+    if _UINT32 is None:
+        import struct
+        _BINARY_TRAILER = struct.Struct('<I4s')
+        _INT64 = struct.Struct('<q')
+        _UINT32 = struct.Struct('<I')
+
+
+class BinaryWriter:
+    FLUSH_BYTES = 1 << 16
+
+    def __init__(self, out):
+        _binary_formats()
+        self.out = out
+        self.pos = 0
+        self._buffer = []
+        self._buffered = 0
+        self._scalars = {}
+        self._containers = {}  # id -> смещение
+
+    def _emit(self, data):
+        offset = self.pos
+        if offset + len(data) > 0xFFFFFFFF:
+            raise ConfigError("Binary output is limited to 4 GiB")
+        self._buffer.append(data)
+        self.pos += len(data)
+        self._buffered += len(data)
+        if self._buffered > self.FLUSH_BYTES:
+            self.flush()
+        return offset
+
+    def flush(self):
+        if self._buffer:
+            self.out.write(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def write(self, value):
+        self._emit(BINARY_MAGIC)
+        root = self._write_value(value)
+        self._emit(_BINARY_TRAILER.pack(root, BINARY_MAGIC[:4]))
+        self.flush()
+
+    def _write_value(self, value):
+        # Обход в обратном порядке с явным стеком, как в JSONEmitter
+        stack = []
+        while True:
+            cls = value.__class__
+            if cls is list or cls is dict or cls is array or cls is range:
+                offset = self._containers.get(id(value))
+                if offset is None:
+                    items = list(value.values()) if cls is dict else value
+                    if items:
+                        stack.append((value, items, []))
+                        value = items[0]
+                        continue
+                    offset = self._container(value, [])
+            else:
+                offset = self._scalar(value)
+            while stack:
+                parent, items, offsets = stack[-1]
+                offsets.append(offset)
+                if len(offsets) < len(items):
+                    value = items[len(offsets)]
+                    break
+                stack.pop()
+                offset = self._container(parent, offsets)
+            else:
+                return offset
+
+    def _scalar(self, value):
+        cls = value.__class__
+        key = (cls, value)
+        offset = self._scalars.get(key)
+        if offset is not None:
+            return offset
+        if cls is str:
+            data = value.encode('utf-8', 'surrogatepass')
+            record = b's' + _UINT32.pack(len(data)) + data
+        elif cls is int:
+            if -(1 << 63) <= value < (1 << 63):
+                record = b'i' + _INT64.pack(value)
+            else:
+                size = value.bit_length() // 8 + 1
+                record = b'I' + _UINT32.pack(size) + value.to_bytes(size, 'little', signed=True)
+        else:
+            raise TypeError(f"Object of type {cls.__name__} is not serializable")
+        offset = self._scalars[key] = self._emit(record)
+        return offset
+
+    def _container(self, value, offsets):
+        import struct
+        count = len(offsets)
+        if value.__class__ is not dict:
+            record = b'a' + struct.pack(f'<{count + 1}I', count, *offsets)
+        else:
+            keys = [key.encode('utf-8', 'surrogatepass') for key in value]
+            pairs = []
+            for key, offset in zip(value, offsets):
+                pairs.append(self._scalar(key))
+                pairs.append(offset)
+            order = sorted(range(count), key=keys.__getitem__)
+            record = b'd' + struct.pack(f'<{3 * count + 1}I', count, *pairs, *order)
+        offset = self._containers[id(value)] = self._emit(record)
+        return offset
+
+
+def dump_binary(value, out):
+    BinaryWriter(out).write(value)
+
+
+# Чтение двоичного формата через mmap: разбирается только то, к чему
+# обращаются. Массивы и словари возвращаются как BinaryArray и BinaryDict,
+# строки и числа - как объекты Python.
+class BinaryReader:
+    def __init__(self, path):
+        import mmap
+        _binary_formats()
+        with open(path, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ConfigError(f"Not a binary config file: {path}") from None
+        data = self._mmap
+        if (len(data) < len(BINARY_MAGIC) + _BINARY_TRAILER.size or data[:len(BINARY_MAGIC)] != BINARY_MAGIC
+                or data[-4:] != BINARY_MAGIC[:4]):
+            self._mmap.close()
+            raise ConfigError(f"Not a binary config file: {path}")
+        self.root_offset = _BINARY_TRAILER.unpack_from(data, len(data) - _BINARY_TRAILER.size)[0]
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def root(self):
+        return self.view(self.root_offset)
+
+    def get(self, path):
+        steps = parse_path(path) if isinstance(path, str) else list(path)
+        offset = self.root_offset
+        for n, step in enumerate(steps):
+            offset = self._child(offset, step)
+            if offset is None:
+                raise ConfigError(f"Path not found: {_format_path(steps[:n + 1])}")
+        return self.view(offset)
+
+    def view(self, offset):
+        tag = self._mmap[offset]
+        if tag == 0x61:  # b'a'
+            return BinaryArray(self, offset)
+        elif tag == 0x64:  # b'd'
+            return BinaryDict(self, offset)
+        return self._scalar(offset)
+
+    def _scalar(self, offset):
+        data = self._mmap
+        tag = data[offset]
+        if tag == 0x69:  # b'i'
+            return _INT64.unpack_from(data, offset + 1)[0]
+        size = _UINT32.unpack_from(data, offset + 1)[0]
+        raw = data[offset + 5:offset + 5 + size]
+        if tag == 0x73:  # b's'
+            return raw.decode('utf-8', 'surrogatepass')
+        elif tag == 0x49:  # b'I'
+            return int.from_bytes(raw, 'little', signed=True)
+        raise ConfigError(f"Corrupted binary config at offset {offset}")
+
+    def _count(self, offset):
+        return _UINT32.unpack_from(self._mmap, offset + 1)[0]
+
+    def _element(self, offset, index):
+        count = self._count(offset)
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            return None
+        return _UINT32.unpack_from(self._mmap, offset + 5 + 4 * index)[0]
+
+    def _lookup(self, offset, key):
+        # Двоичный поиск по таблице номеров пар, упорядоченных по ключу
+        data = self._mmap
+        count = self._count(offset)
+        pairs = offset + 5
+        order = pairs + 8 * count
+        target = key.encode('utf-8', 'surrogatepass')
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pair = _UINT32.unpack_from(data, order + 4 * mid)[0]
+            key_offset = _UINT32.unpack_from(data, pairs + 8 * pair)[0]
+            size = _UINT32.unpack_from(data, key_offset + 1)[0]
+            current = data[key_offset + 5:key_offset + 5 + size]
+            if current == target:
+                return _UINT32.unpack_from(data, pairs + 8 * pair + 4)[0]
+            elif current < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
+
+    def _child(self, offset, step):
+        tag = self._mmap[offset]
+        if tag == 0x61 and isinstance(step, int):
+            return self._element(offset, step)
+        elif tag == 0x64 and isinstance(step, str):
+            return self._lookup(offset, step)
+        return None
+
+    def decode(self, offset=None):
+        # Полное чтение поддерева в объекты Python без рекурсии
+        import struct
+        offset = self.root_offset if offset is None else offset
+        data = self._mmap
+        stack = []
+        while True:
+            tag = data[offset]
+            if tag == 0x61 or tag == 0x64:
+                count = self._count(offset)
+                if count:
+                    if tag == 0x61:
+                        children = struct.unpack_from(f'<{count}I', data, offset + 5)
+                        keys = None
+                    else:
+                        pairs = struct.unpack_from(f'<{2 * count}I', data, offset + 5)
+                        children = pairs[1::2]
+                        keys = [self._scalar(key) for key in pairs[::2]]
+                    stack.append((children, keys, []))
+                    offset = children[0]
+                    continue
+                value = [] if tag == 0x61 else {}
+            else:
+                value = self._scalar(offset)
+            while stack:
+                children, keys, values = stack[-1]
+                values.append(value)
+                if len(values) < len(children):
+                    offset = children[len(values)]
+                    break
+                stack.pop()
+                value = values if keys is None else dict(zip(keys, values))
+            else:
+                return value
+
+
+class BinaryArray:
+    __slots__ = ('reader', 'offset')
+
+    def __init__(self, reader, offset):
+        self.reader = reader
+        self.offset = offset
+
+    def __len__(self):
+        return self.reader._count(self.offset)
+
+    def __getitem__(self, index):
+        offset = self.reader._element(self.offset, index)
+        if offset is None:
+            raise IndexError(index)
+        return self.reader.view(offset)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_python(self):
+        return self.reader.decode(self.offset)
+
+
+class BinaryDict:
+    __slots__ = ('reader', 'offset')
+
+    def __init__(self, reader, offset):
+        self.reader = reader
+        self.offset = offset
+
+    def __len__(self):
+        return self.reader._count(self.offset)
+
+    def __getitem__(self, key):
+        offset = self.reader._lookup(self.offset, key)
+        if offset is None:
+            raise KeyError(key)
+        return self.reader.view(offset)
+
+    def __contains__(self, key):
+        return self.reader._lookup(self.offset, key) is not None
+
+    def get(self, key, default=None):
+        offset = self.reader._lookup(self.offset, key)
+        return default if offset is None else self.reader.view(offset)
+
+    def keys(self):
+        reader = self.reader
+        return [reader._scalar(_UINT32.unpack_from(reader._mmap, self.offset + 5 + 8 * i)[0])
+                for i in range(len(self))]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_python(self):
+        return self.reader.decode(self.offset)
+
+
+def convert_file(path, out, cache=None, compact=False, intern=False, select=None, limits=None):
+    if cache:
+        variant = 'json-compact' if compact else 'json'
+        if select is not None:
+            variant += '\0select=' + select
+        if limits is not None:
+            # Результат без ограничений мог бы их нарушать
+            variant += '\0limits=' + ','.join(str(getattr(limits, name)) for name in Limits.__slots__)
+        key = cache.key_for_file(path, variant)
+        entry = cache.open_entry(key)
+        if entry is not None:
+            import shutil
+            with entry:
+                shutil.copyfileobj(entry, out)
+            return
+        with cache.write_entry(key) as f:
+            _convert(path, _Tee(out, f), compact, intern, select, limits)
+    else:
+        _convert(path, out, compact, intern, select, limits)
+
+
+def _convert(path, out, compact, intern=False, select=None, limits=None):
+    value, interner = _evaluate_file(path, intern, select, limits)
+    dump_json(value, out, compact, interner.shared if interner else None)
+
+
+def _evaluate_file(path, intern=False, select=None, limits=None):
+    # Программа вычисляется один раз, поэтому optimize() не окупается:
+    # проход по дереву стоит дороже сэкономленных вычислений
+    program = Parser(tokenize_file(path), path).parse_program()
+    interner = Interner() if intern else None
+    if select is not None:
+        return Evaluator(interner=interner, limits=limits).evaluate_path(program, select), interner
+    return Evaluator(interner=interner, limits=limits).evaluate_program(program), interner
+
+
+def convert_file_binary(path, out, intern=False, select=None, limits=None):
+    # out - двоичный поток
+    dump_binary(_evaluate_file(path, intern, select, limits)[0], out)
+
+
+_MISSING = object()
+
+
+# Список изменений {"path", "old", "new"} в порядке документа; у добавленных
+# значений нет "old", у удаленных - "new". Равные словари и списки
+# сравниваются целиком одним == (без обхода в Python, один и тот же объект -
+# сразу), поэтому обход заходит только в поддеревья, на пути к которым что-то
+# изменилось. Массивы сравниваются по индексам; steps - путь к old и new в
+# исходном значении.
+def diff_values(old, new, steps=()):
+    changes = []
+    stack = [(tuple(steps), old, new)]
+    while stack:
+        steps, a, b = stack.pop()
+        if a is b:
+            continue
+        if a is _MISSING or b is _MISSING:
+            change = {'path': _format_path(steps)}
+            if a is not _MISSING:
+                change['old'] = a
+            if b is not _MISSING:
+                change['new'] = b
+            changes.append(change)
+            continue
+        ca, cb = a.__class__, b.__class__
+        if ca is cb and (ca is dict or ca is list) and a == b:
+            continue
+        if ca is dict and cb is dict:
+            children = [(steps + (key,), value, b.get(key, _MISSING)) for key, value in a.items()]
+            children.extend((steps + (key,), _MISSING, value) for key, value in b.items() if key not in a)
+            stack.extend(reversed(children))
+        elif isinstance(a, _VECTOR_TYPES) and isinstance(b, _VECTOR_TYPES):
+            if ca is cb and ca is not list and a == b:
+                continue
+            size = max(len(a), len(b))
+            stack.extend((steps + (i,), a[i] if i < len(a) else _MISSING, b[i] if i < len(b) else _MISSING)
+                         for i in reversed(range(size)))
+        elif ca is not cb or a != b:
+            changes.append({'path': _format_path(steps), 'old': a, 'new': b})
+    return changes
+
+
+def diff_files(old_path, new_path, select=None, limits=None):
+    # Общий Interner сделал бы одинаковые поддеревья одним объектом, но его
+    # ключи строятся для каждого значения и обходятся дороже, чем == в
+    # diff_values по уже вычисленным деревьям
+    steps = parse_path(select) if select is not None else ()
+    values = []
+    for path in (old_path, new_path):
+        program = Parser(tokenize_file(path), path).parse_program()
+        evaluator = Evaluator(limits=limits)
+        if select is not None:
+            values.append(evaluator.evaluate_path(program, steps))
+        else:
+            values.append(evaluator.evaluate_program(program))
+    return diff_values(*values, steps)
+
+
+# Вычисление с замером времени определений. Зависимости определения
+# вычисляются до него, поэтому вызовы не вкладываются, но на случай
+# вложенности учитывается только внешний.
+class _ProfilingEvaluator(Evaluator):
+    def __init__(self, env=None, interner=None):
+        super().__init__(env, interner)
+        self.definition_time = 0.0
+        self._depth = 0
+
+    def _definition_table(self, definitions):
+        def evaluate(i, env):
+            self._depth += 1
+            start = time.perf_counter()
+            try:
+                return self.evaluate_in(definitions[i].value_expr, env)
+            finally:
+                self._depth -= 1
+                if not self._depth:
+                    self.definition_time += time.perf_counter() - start
+        return DefinitionTable(definitions, evaluate, self.env)
+
+
+class _CountingWriter:
+    __slots__ = ('out', 'size')
+
+    def __init__(self, out):
+        self.out = out
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data.encode('utf-8'))
+        if self.out is not None:
+            self.out.write(data)
+
+
+# Преобразование с отчетом по этапам (--profile): время, пиковая память и
+# счетчики каждого этапа. tracemalloc замедляет выполнение в разы, поэтому
+# память замеряется вторым проходом с выводом в никуда, а время - первым,
+# который и пишет результат. Обычный путь _convert() не меняется.
+class Profiler:
+    def __init__(self, log=sys.stderr, dump_path=None):
+        self.log = log
+        self.dump_path = dump_path  # файл для статистики cProfile
+        self.stages = {}  # имя -> [секунды, пик памяти, счетчики]
+        self._tracing = False
+
+    @contextmanager
+    def stage(self, name):
+        entry = self.stages.setdefault(name, [0.0, None, {}])
+        if self._tracing:
+            import tracemalloc
+            tracemalloc.reset_peak()
+            try:
+                yield entry[2]
+            finally:
+                entry[1] = tracemalloc.get_traced_memory()[1]
+        else:
+            start = time.perf_counter()
+            try:
+                yield entry[2]
+            finally:
+                entry[0] = time.perf_counter() - start
+
+    def convert(self, path, out, compact=False, intern=False, select=None):
+        try:
+            if self.dump_path:
+                import cProfile
+                profile = cProfile.Profile()
+                try:
+                    profile.runcall(self._run, path, out, compact, intern, select)
+                finally:
+                    profile.dump_stats(self.dump_path)
+            else:
+                self._run(path, out, compact, intern, select)
+
+            import tracemalloc
+            tracemalloc.start()
+            self._tracing = True
+            try:
+                self._run(path, _CountingWriter(None), compact, intern, select)
+            finally:
+                self._tracing = False
+                tracemalloc.stop()
+        finally:
+            self.report(path)
+
+    def _run(self, path, out, compact, intern, select):
+        with self.stage('tokenize') as counters:
+            batches = list(tokenize_file(path))
+        counters['tokens'] = sum(len(batch) for batch in batches)
+        with self.stage('parse') as counters:
+            program = Parser(batches, path).parse_program()
+        del batches
+        counters.update(_node_counts(program))
+
+        evaluator = _ProfilingEvaluator(interner=Interner() if intern else None)
+        with self.stage('evaluate') as counters:
+            if select is None:
+                value = evaluator.evaluate_program(program)
+            else:
+                value = evaluator.evaluate_path(program, select)
+        if not self._tracing:
+            table = evaluator.definitions
+            counters['definitions'] = (f"{table.evaluated} of {len(table.definitions)} "
+                                       f"({evaluator.definition_time * 1000:.1f} ms)")
+            counters['common subexpressions reused'] = table.saved
+            counters['main expression'] = \
+                f"{(self.stages['evaluate'][0] - evaluator.definition_time) * 1000:.1f} ms"
+
+        writer = out if isinstance(out, _CountingWriter) else _CountingWriter(out)
+        with self.stage('json') as counters:
+            dump_json(value, writer, compact, evaluator.interner.shared if intern else None)
+        counters['output bytes'] = writer.size
+
+    def report(self, path):
+        lines = [f"Profile of {path}" + (" (times include cProfile overhead):" if self.dump_path else ":")]
+        for name, (elapsed, peak, counters) in self.stages.items():
+            memory = f"{peak / 2 ** 20:9.2f} MiB peak" if peak is not None else ' ' * 18
+            info = ', '.join(f"{key} {value}" for key, value in counters.items())
+            lines.append(f"  {name:<9} {elapsed * 1000:10.1f} ms {memory}  {info}".rstrip())
+        total = sum(elapsed for elapsed, _, _ in self.stages.values())
+        lines.append(f"  {'total':<9} {total * 1000:10.1f} ms")
+        if self.dump_path:
+            lines.append(f"  cProfile statistics written to {self.dump_path}")
+        self.log.write('\n'.join(lines) + '\n')
+
+
+def _node_counts(program):
+    counts = {}
+    for root in [defn.value_expr for defn in program.definitions] + [program.main_expr]:
+        for node in _iter_nodes(root):
+            name = type(node).__name__
+            counts[name] = counts.get(name, 0) + 1
+    return {'nodes': sum(counts.values()),
+            'by class': '(' + ', '.join(f"{name} {count}" for name, count in sorted(counts.items())) + ')'}
+
+
+def _batch_worker(job):
+    path, output_path, compact, intern, select, cache_dir, cache_max_bytes, limits = job
+    try:
+        cache = ResultCache(cache_dir, cache_max_bytes) if cache_dir else None
+        # При ошибке файл результата не создается
+        with atomic_write(output_path) as f:
+            convert_file(path, f, cache, compact, intern, select, limits)
+        return path, os.path.getsize(path), None
+    except ConfigError as e:
+        return path, 0, str(e)
+    except Exception as e:
+        return path, 0, f"Internal error: {str(e)}"
+
+
+def expand_inputs(patterns):
+    import glob
+    paths = []
+    seen = set()
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) or [pattern]
+        for path in matches:
+            if path not in seen and not os.path.isdir(path):
+                seen.add(path)
+                paths.append(path)
+    return paths
+
+
+def convert_batch(patterns, output_dir, jobs=None, compact=False, cache_dir=None,
+                  cache_max_bytes=ResultCache.DEFAULT_MAX_BYTES, log=sys.stderr, intern=False, select=None,
+                  limits=None):
+    # Возвращает количество файлов, которые не удалось преобразовать
+    start = time.perf_counter()
+    os.makedirs(output_dir, exist_ok=True)
+    batch = []
+    failed = 0
+    outputs = {}
+    for path in expand_inputs(patterns):
+        name = os.path.splitext(os.path.basename(path))[0] + '.json'
+        if name in outputs:
+            log.write(f"{path}: output {name} already produced by {outputs[name]}\n")
+            failed += 1
+            continue
+        outputs[name] = path
+        batch.append((path, os.path.join(output_dir, name), compact, intern, select, cache_dir, cache_max_bytes,
+                      limits))
+
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(batch) < 2:
+        results = map(_batch_worker, batch)
+        executor = None
+    else:
+        import concurrent.futures
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(batch)))
+        results = executor.map(_batch_worker, batch, chunksize=max(1, len(batch) // (jobs * 4)))
+    converted = 0
+    total_bytes = 0
+    try:
+        for path, size, error in results:
+            if error is None:
+                converted += 1
+                total_bytes += size
+            else:
+                failed += 1
+                log.write(f"{path}: {error}\n")
+    finally:
+        if executor:
+            executor.shutdown()
+
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    log.write(
+        f"Converted {converted}/{converted + failed} files in {elapsed:.2f} s: "
+        f"{converted / elapsed:.1f} files/sec, {total_bytes / elapsed / 2 ** 20:.2f} MiB/sec\n"
+    )
+    return failed
+
+
+# Программы, уже разобранные и вычисленные сервером. Запись считается
+# актуальной, пока у файла не изменились mtime и размер; иначе сравнивается
+# хэш содержимого, и только при его изменении файл разбирается заново.
+# Изменение подключенного файла (mtime или размер) тоже требует вычисления.
+class ProgramCache:
+    DEFAULT_MAX_ENTRIES = 64
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, limits=None):
+        self.max_entries = max_entries
+        self.limits = limits
+        # путь -> (mtime_ns, size, digest, value, includes, stats подключенных файлов)
+        self._entries = OrderedDict()
+        self._lock = _thread.allocate_lock()
+        self.hits = 0
+        self.misses = 0
+
+    def value(self, path):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        includes_fresh = entry is not None and (not entry[4] or _file_stats(entry[4]) == entry[5])
+        if includes_fresh and entry[:2] == (st.st_mtime_ns, st.st_size):
+            with self._lock:
+                self._entries.move_to_end(path)
+                self.hits += 1
+            return entry[3]
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        import hashlib
+        digest = hashlib.sha256(data).digest()
+        if includes_fresh and entry[2] == digest:
+            value, includes, stats = entry[3:]
+            hit = True
+        else:
+            # Кэшируется значение, а не программа, поэтому без optimize()
+            program = Parser(tokenize(data.decode('utf-8')), path).parse_program()
+            includes = program.includes
+            stats = _file_stats(includes)
+            value = Evaluator(limits=self.limits).evaluate_program(program)
+            hit = False
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            self._entries[path] = (st.st_mtime_ns, st.st_size, digest, value, includes, stats)
+            self._entries.move_to_end(path)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _SocketTextWriter:
+    __slots__ = ('sock',)
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, data):
+        self.sock.sendall(data.encode('utf-8'))
+
+
+def _handle_connection(request, client_address, server):
+    # socketserver вызывает RequestHandlerClass(соединение, адрес, сервер);
+    # функции достаточно, и StreamRequestHandler не нужен при импорте модуля
+    out = _SocketTextWriter(request)
+    with request.makefile('rb') as rfile:
+        for line in rfile:
+            if line.strip():
+                server.config_server.process(line, out)
+
+
+def _write_error(out, message):
+    import json
+    out.write(json.dumps({'ok': False, 'error': message}, ensure_ascii=False, separators=(',', ':')))
+
+
+# Сервер на Unix-сокете. Протокол - JSON по строкам, ответ тоже одной строкой:
+#   {"op": "convert", "path": "...", "select": "a.b[0]"}  ->  {"ok": true, "value": ...}
+#   {"op": "stats"}                                        ->  {"ok": true, "stats": {...}}
+# При ошибке возвращается {"ok": false, "error": "..."}. Соединения
+# обслуживает socketserver.ThreadingUnixStreamServer, каждое в своем потоке.
+class ConfigServer:
+    def __init__(self, socket_path, max_entries=ProgramCache.DEFAULT_MAX_ENTRIES, limits=None):
+        import socketserver
+        self.programs = ProgramCache(max_entries, limits)
+        self._stats_lock = _thread.allocate_lock()
+        self.requests = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        server = self._server = socketserver.ThreadingUnixStreamServer(socket_path, _handle_connection)
+        server.daemon_threads = True
+        server.config_server = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.server_close()
+
+    def serve_forever(self, poll_interval=0.5):
+        self._server.serve_forever(poll_interval)
+
+    def shutdown(self):
+        self._server.shutdown()
+
+    def server_close(self):
+        self._server.server_close()
+
+    def process(self, line, out):
+        import json
+        start = time.perf_counter()
+        failed = False
+        try:
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                raise ConfigError(f"Invalid request: {str(e)}") from None
+            op = request.get('op') if isinstance(request, dict) else None
+            if op == 'convert':
+                if not isinstance(request.get('path'), str):
+                    raise ConfigError("Request is missing 'path'")
+                value = self.programs.value(request['path'])
+                if request.get('select') is not None:
+                    value = _select_value(value, parse_path(request['select']), 0)
+                # Значение уже вычислено, поэтому ошибка не может возникнуть посреди ответа
+                out.write('{"ok":true,"value":')
+                dump_json(value, out, compact=True)
+                out.write('}')
+            elif op == 'stats':
+                out.write(json.dumps({'ok': True, 'stats': self.stats()}, separators=(',', ':')))
+            else:
+                raise ConfigError(f"Unknown request: {op}")
+        except ConfigError as e:
+            failed = True
+            _write_error(out, str(e))
+        except Exception as e:
+            failed = True
+            _write_error(out, f"Internal error: {str(e)}")
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._stats_lock:
+                self.requests += 1
+                if failed:
+                    self.errors += 1
+                self.total_latency += elapsed
+                self.max_latency = max(self.max_latency, elapsed)
+        # Конец строки пишется после учета запроса: получивший ответ клиент
+        # уже видит его в статистике
+        out.write('\n')
+
+    def stats(self):
+        programs = self.programs
+        with self._stats_lock:
+            requests, errors = self.requests, self.errors
+            total_latency, max_latency = self.total_latency, self.max_latency
+        lookups = programs.hits + programs.misses
+        return {
+            'requests': requests,
+            'errors': errors,
+            'cache_hits': programs.hits,
+            'cache_misses': programs.misses,
+            'cache_hit_rate': programs.hits / lookups if lookups else 0.0,
+            'cached_programs': len(programs),
+            'avg_latency_ms': total_latency / requests * 1000 if requests else 0.0,
+            'max_latency_ms': max_latency * 1000,
+        }
+
+
+def serve(socket_path, max_entries=ProgramCache.DEFAULT_MAX_ENTRIES, limits=None):
+    # Удаляется только сокет, оставшийся от прошлого запуска: если на нем
+    # принимает соединения другой сервер, он не трогается
+    try:
+        mode = os.lstat(socket_path).st_mode
+    except FileNotFoundError:
+        pass
+    else:
+        if not stat.S_ISSOCK(mode):
+            raise ConfigError(f"{socket_path} exists and is not a socket")
+        import socket
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            try:
+                sock.connect(socket_path)
+            except ConnectionRefusedError:
+                os.unlink(socket_path)
+            else:
+                raise ConfigError(f"{socket_path} is in use by another server")
+    with ConfigServer(socket_path, max_entries, limits) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+
+
+def send_request(socket_path, request):
+    # Клиент для сервера: отправляет один запрос и возвращает разобранный ответ
+    import json
+    import socket
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as f:
+            f.write(json.dumps(request).encode('utf-8') + b'\n')
+            f.flush()
+            return json.loads(f.readline())
+
+
+# Поток документов: из inp (двоичный поток, например sys.stdin.buffer)
+# читаются конфигурации, каждая из которых завершается символом RS (\x1e)
+# или предваряется своей длиной ("<число байт>\n<текст>"). Документ
+# обрабатывается, как только прочитан целиком; пустые документы между
+# RS пропускаются, последний можно не завершать. В out для каждого пишется
+# строка ответа в формате сервера. Читается столько, сколько уже доступно
+# (read1), и ответы на прочитанные документы выводятся одной записью -
+# генератор получает ответ сразу, а при плотном потоке записи не мелкие.
+# Если прочитано не меньше STREAM_PARALLEL_MIN документов и jobs > 1, они
+# делятся между процессами пула с сохранением порядка ответов. Пробелы и
+# переводы строк между документами с длиной пропускаются; кадр с неверной
+# длиной дает ответ с ошибкой, и чтение продолжается со следующей строки.
+STREAM_FRAMINGS = ('rs', 'length')
+STREAM_PARALLEL_MIN = 256
+
+
+def convert_stream(inp, out, framing='rs', select=None, jobs=1, chunk_size=1 << 16, limits=None):
+    # Возвращает количество документов с ошибкой
+    if framing not in STREAM_FRAMINGS:
+        raise ConfigError(f"Unknown stream framing: {framing}")
+    steps = parse_path(select) if select is not None else None
+    failed = 0
+    buf = b''
+    final = False
+    executor = None
+    try:
+        while not final:
+            data = inp.read1(chunk_size) if hasattr(inp, 'read1') else inp.read(chunk_size)
+            final = not data
+            buf += data
+            documents, buf = _split_documents(buf, framing, final)
+            if not documents:
+                continue
+            if jobs > 1 and len(documents) >= STREAM_PARALLEL_MIN:
+                if executor is None:
+                    import concurrent.futures
+                    executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+                size = -(-len(documents) // jobs)
+                results = executor.map(_stream_worker, [(documents[i:i + size], steps, limits)
+                                                        for i in range(0, len(documents), size)])
+            else:
+                results = [_stream_worker((documents, steps, limits))]
+            for text, errors in results:
+                out.write(text)
+                failed += errors
+            out.flush()
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return failed
+
+
+def _stream_worker(job):
+    # Ответы на документы одной строкой и количество ошибок
+    documents, steps, limits = job
+    parts = []
+    writer = _StringWriter(parts)
+    failed = 0
+    for document in documents:
+        if isinstance(document, ConfigError):
+            # Кадр, который не удалось разобрать (см. _split_documents)
+            _write_error(writer, str(document))
+            failed += 1
+        elif not _convert_document(document, writer, steps, limits):
+            failed += 1
+        parts.append('\n')
+    return ''.join(parts), failed
+
+
+def _split_documents(buf, framing, final):
+    # Возвращает (полные документы, непрочитанный остаток); вместо кадра,
+    # который не удалось разобрать, в документах - ConfigError
+    documents = []
+    if framing == 'rs':
+        pieces = buf.split(b'\x1e')
+        buf = b'' if final else pieces.pop()
+        documents = [piece for piece in pieces if piece.strip()]
+        return documents, buf
+    pos = 0
+    size = len(buf)
+    while True:
+        while pos < size and buf[pos] in b' \t\r\n':
+            pos += 1
+        newline = buf.find(b'\n', pos)
+        if newline < 0:
+            if final and pos < size:
+                documents.append(ConfigError("Truncated length prefix in stream"))
+                pos = size
+            break
+        header = buf[pos:newline].strip()
+        if not header.isdigit():
+            documents.append(ConfigError(f"Invalid length prefix in stream: {header[:20]!r}"))
+            pos = newline + 1
+            continue
+        end = newline + 1 + int(header)
+        if end > size:
+            if final:
+                documents.append(ConfigError("Truncated document in stream"))
+                pos = size
+            break
+        documents.append(buf[newline + 1:end])
+        pos = end
+    return documents, buf[pos:]
+
+
+class _StringWriter:
+    __slots__ = ('write',)
+
+    def __init__(self, parts):
+        self.write = parts.append
+
+
+def _convert_document(document, out, steps, limits=None):
+    try:
+        program = Parser(tokenize(document.decode('utf-8'))).parse_program()
+        evaluator = Evaluator(limits=limits)
+        value = evaluator.evaluate_program(program) if steps is None else evaluator.evaluate_path(program, steps)
+    except ConfigError as e:
+        _write_error(out, str(e))
+        return False
+    except Exception as e:
+        _write_error(out, f"Internal error: {str(e)}")
+        return False
+    out.write('{"ok":true,"value":')
+    dump_json(value, out, compact=True)
+    out.write('}')
+    return True
+
+
+# Следит за файлом опросом os.stat и при изменении пересчитывает только то,
+# что изменилось. От прошлого успешного вычисления хранятся его текст,
+# таблица определений со значениями, места определений в тексте и значения
+# массивов, словарей и операций основного выражения по смещениям их
+# открывающих токенов. Что изменилось, определяется сравнением текста, а
+# не обходом дерева: обход стоил бы столько же, сколько само вычисление.
+class Watcher:
+    def __init__(self, path, output, compact=False, interval=0.5, log=sys.stderr):
+        self.path = path
+        self.output = output
+        self.compact = compact
+        self.interval = interval
+        self.log = log
+        self.table = None
+        self.spans = []
+        self.memo = None  # (смещение корня, запись), см. _evaluate_main
+        self.text = None  # текст, к которому относятся table, spans и memo
+        self.evaluated = 0  # сколько определений вычислено при последнем обновлении
+        self._stat = None  # mtime и размер файла и подключенных файлов
+        self._includes = ()
+        self._source = None
+
+    def run(self):
+        while True:
+            self.update()
+            time.sleep(self.interval)
+
+    def update(self):
+        # Возвращает True, если выходной файл был переписан
+        try:
+            st = os.stat(self.path)
+            stat = ((st.st_mtime_ns, st.st_size),) + _file_stats(self._includes)
+            if stat == self._stat:
+                return False
+            old_stat, self._stat = self._stat, stat
+            with open(self.path, 'r', encoding='utf-8') as f:
+                source = f.read()
+        except (OSError, ValueError) as e:
+            self.log.write(f"{self.path}: {str(e)}\n")
+            return False
+        if source == self._source and stat[1:] == old_stat[1:]:
+            return False
+        self._source = source
+
+        start = time.perf_counter()
+        try:
+            tokens = tokenize(source)
+            program = Parser(tokens, self.path).parse_program()
+            self._includes = program.includes
+            self._stat = stat[:1] + _file_stats(program.includes)
+            value, table, spans, memo, evaluated = self._evaluate(program, source, tokens.index)
+            with atomic_write(self.output) as f:
+                dump_json(value, f, self.compact)
+        except ConfigError as e:
+            self.log.write(f"{self.path}: {str(e)}\n")
+            return False
+        except Exception as e:
+            # Цикл наблюдения продолжается, прежний результат остается
+            self.log.write(f"{self.path}: Internal error: {str(e)}\n")
+            return False
+        self.table, self.spans, self.memo, self.text, self.evaluated = table, spans, memo, source, evaluated
+        elapsed = time.perf_counter() - start
+        self.log.write(f"{self.path}: wrote {self.output}, {evaluated} of {len(program.definitions)} "
+                       f"definitions evaluated in {elapsed * 1000:.1f} ms\n")
+        return True
+
+    def _evaluate(self, program, source, index):
+        definitions = program.definitions
+        evaluator = Evaluator()
+        table = DefinitionTable(definitions, lambda i, env: evaluator.evaluate_in(definitions[i].value_expr, env))
+        main_expr = program.main_expr
+        spans = _definition_spans(definitions, index, main_expr.token.start if _children(main_expr) is not None
+                                  else len(source))
+        clean = self._clean_definitions(table, spans, source)
+        for i, j in clean.items():
+            table.values[i] = self.table.values[j]
+        reused = len(table.values)
+
+        # Имена, которые из основного выражения указывают не на то же
+        # неизмененное определение, что и раньше
+        dirty = set()
+        old = self.table
+        if old is not None:
+            for name, positions in table._positions.items():
+                old_positions = old._positions.get(name)
+                if old_positions is None or clean.get(positions[-1]) != old_positions[-1]:
+                    dirty.add(name)
+            dirty.update(name for name in old._positions if name not in table._positions)
+        value, memo = self._evaluate_main(main_expr, evaluator, table.scope(), source, dirty)
+        return value, table, spans, memo, len(table.values) - reused
+
+    def _clean_definitions(self, table, spans, source):
+        # Возвращает {новый индекс: старый индекс} для определений, значения
+        # которых можно взять из прошлого вычисления: текст не изменился,
+        # имена в нем ссылаются на соответствующие старые определения, и те
+        # тоже не изменились
+        old = self.table
+        if old is None:
+            return {}
+        old_spans, old_source = self.spans, self.text
+        mapping = {}
+        for name, positions in table._positions.items():
+            old_positions = old._positions.get(name, ())
+            for i, j in zip(positions, old_positions):
+                span, old_span = spans[i], old_spans[j]
+                if span.__class__ is tuple:
+                    same = (old_span.__class__ is tuple and
+                            source[span[0]:span[1]] == old_source[old_span[0]:old_span[1]])
+                else:
+                    same = span is old_span
+                if not same or j not in old.values:
+                    continue
+                # Тот же текст - те же имена, и все они разрешались, иначе
+                # определение не было бы вычислено: зависимости берутся из
+                # старой таблицы без обхода дерева
+                deps = [table.resolve(old.definitions[d].name, i) for d in old.dependencies(j)]
+                if None not in deps:
+                    table._dependencies[i] = deps
+                    mapping[i] = j
+        clean = {}
+        for root in mapping:
+            stack = [root]
+            while stack:
+                i = stack[-1]
+                if i in clean:
+                    stack.pop()
+                    continue
+                deps = table.dependencies(i)
+                if i not in mapping or [mapping.get(d) for d in deps] != old.dependencies(mapping[i]):
+                    clean[i] = None
+                    stack.pop()
+                    continue
+                pending = [d for d in deps if d not in clean]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+                clean[i] = mapping[i] if all(clean[d] is not None for d in deps) else None
+        return {i: j for i, j in clean.items() if j is not None}
+
+    def _evaluate_main(self, node, evaluator, scope, source, dirty):
+        # Сверху вниз: массив, словарь или операция берется из прошлого
+        # результата, если ее текст лежит в общем начале или общем конце
+        # старого и нового текста и не упоминает имен из dirty; иначе
+        # массивы и словари собираются из своих элементов, а операции
+        # вычисляются. Концом текста узла считается начало следующего узла
+        # с токеном (или конец родителя): граница может захватить лишнее,
+        # но не меньше нужного. Запись узла - (значение, {смещение вложенного
+        # узла от начала родителя: запись}), поэтому неизмененный узел
+        # переносится в новый результат вместе с вложенными за O(1)
+        old_source = self.text
+        if old_source is None:
+            prefix = suffix = shift = 0
+        else:
+            prefix, suffix = _common_affixes(old_source, source)
+            shift = len(source) - len(old_source)
+        changed_end = len(source) - suffix
+
+        def old_offset(start):
+            if start < prefix:
+                return start
+            elif start >= changed_end:
+                return start - shift
+            return None
+
+        def old_entry(old_children, old_start, child):
+            if old_children is None or child.__class__ not in _CONTAINER_TYPES:
+                return None
+            offset = old_offset(child.token.start)
+            return old_children.get(offset - old_start) if offset is not None else None
+
+        # Где в тексте упоминаются измененные имена
+        positions = _word_positions(source, dirty) if self.memo is not None and dirty else ()
+
+        def mentions(start, end):
+            k = bisect_left(positions, start)
+            return k < len(positions) and positions[k] < end
+
+        if node.__class__ not in _CONTAINER_TYPES:
+            return evaluator.evaluate_in(node, scope), None
+        root_start = node.token.start
+        old = None
+        if self.memo is not None and self.memo[0] == old_offset(root_start):
+            old = self.memo[1]
+        stack = []
+        end = len(source)
+        while True:
+            if node.__class__ not in _CONTAINER_TYPES:
+                value, entry = evaluator.evaluate_in(node, scope), None
+            else:
+                start = node.token.start
+                children = _children(node)
+                if old is not None and (end <= prefix or start >= changed_end) and not mentions(start, end):
+                    entry = old
+                elif node.__class__ is BraceNode or not children:
+                    entry = (evaluator.evaluate_in(node, scope), None)
+                else:
+                    bounds = []
+                    for child in reversed(children):
+                        bounds.append(end)
+                        if child.__class__ in _CONTAINER_TYPES:
+                            end = child.token.start
+                    bounds.reverse()
+                    old_start = old_offset(start) if old is not None else None
+                    old_children = old[1] if old_start is not None else None
+                    stack.append((node, start, children, bounds, [], {}, old_children, old_start))
+                    node, end = children[0], bounds[0]
+                    old = old_entry(old_children, old_start, node)
+                    continue
+                value = entry[0]
+
+            while stack:
+                parent, parent_start, children, bounds, values, entries, old_children, old_start = stack[-1]
+                if entry is not None:
+                    entries[node.token.start - parent_start] = entry
+                values.append(value)
+                if len(values) < len(children):
+                    node, end = children[len(values)], bounds[len(values)]
+                    old = old_entry(old_children, old_start, node)
+                    break
+                stack.pop()
+                if parent.__class__ is ArrayNode:
+                    value = values
+                else:
+                    value = {name: item for (name, _), item in zip(parent.pairs, values)}
+                node, entry = parent, (value, entries)
+            else:
+                return value, (root_start, entry)
+
+
+_CONTAINER_TYPES = (ArrayNode, DictNode, BraceNode)
+_WORD_RE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*')
+_WORD_CHARS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_')
+# Больше имен ищется одним проходом по всем словам текста
+_WORD_SEARCH_MAX = 64
+
+
+def _word_positions(text, words):
+    # Смещения, с которых в text начинается одно из words целым словом, по возрастанию
+    if len(words) > _WORD_SEARCH_MAX:
+        return [m.start() for m in _WORD_RE.finditer(text) if m.group() in words]
+    positions = []
+    for word in words:
+        start = text.find(word)
+        while start >= 0:
+            end = start + len(word)
+            if text[start - 1:start] not in _WORD_CHARS and text[end:end + 1] not in _WORD_CHARS:
+                positions.append(start)
+            start = text.find(word, end)
+    positions.sort()
+    return positions
+
+
+def _definition_spans(definitions, index, end):
+    # Текст каждого определения из файла с LineIndex index - от его def до
+    # следующего def (или до end); определения подключенных файлов
+    # сравниваются по самим объектам: ModuleCache возвращает те же, пока
+    # файл не изменился
+    spans = list(definitions)
+    for i in range(len(definitions) - 1, -1, -1):
+        token = definitions[i].token
+        if token is not None and token.index is index:
+            spans[i] = (token.start, end)
+            end = token.start
+    return spans
+
+
+def _common_affixes(a, b):
+    # Длины общего начала и общего конца строк; вместе не больше длины короче
+    limit = min(len(a), len(b))
+    prefix = _common_prefix(a, b, limit)
+    return prefix, _common_prefix(a[::-1], b[::-1], limit - prefix)
+
+
+def _common_prefix(a, b, limit, block=4096):
+    # Сравнение блоками, затем двоичный поиск внутри отличающегося блока
+    start = 0
+    while start < limit:
+        stop = min(start + block, limit)
+        if a[start:stop] != b[start:stop]:
+            break
+        start = stop
+    else:
+        return limit
+    while stop - start > 1:
+        middle = (start + stop) // 2
+        if a[start:middle] == b[start:middle]:
+            start = middle
+        else:
+            stop = middle
+    return start
 
 
 def main():
+    import argparse
     parser = argparse.ArgumentParser(description='Config to JSON converter')
-    parser.add_argument('--input', required=True, help='Path to input config file')
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('--input', help='Path to input config file')
+    inputs.add_argument('--batch', nargs='+', metavar='PATTERN',
+                        help='Input files or glob patterns to convert into --output-dir')
+    inputs.add_argument('--serve', metavar='SOCKET', help='Serve conversion requests on a Unix socket')
+    inputs.add_argument('--stream', nargs='?', const='rs', choices=STREAM_FRAMINGS,
+                        help='Convert configs read from stdin, each terminated by \\x1e (rs) or prefixed with '
+                             '"<bytes>\\n" (length), into one JSON line each on stdout')
+    inputs.add_argument('--diff', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Write the list of paths whose values differ between two configs')
+    parser.add_argument('--output', help='Write the result to this file instead of stdout')
+    parser.add_argument('--output-dir', help='Directory for batch mode results')
+    parser.add_argument('--jobs', type=int, help='Worker processes for batch and stream modes (default: CPU count)')
+    parser.add_argument('--compact', action='store_true', help='Write JSON without indentation')
+    parser.add_argument('--format', choices=('json', 'binary'), default='json',
+                        help='Output format; binary is an indexed format read by BinaryReader (not cached)')
+    parser.add_argument('--watch', action='store_true',
+                        help='Rewrite --output whenever --input changes, re-evaluating only what changed')
+    parser.add_argument('--watch-interval', type=float, default=0.5, help='Polling interval for --watch in seconds')
+    parser.add_argument('--select', metavar='PATH',
+                        help='Convert only the value at PATH, e.g. player.stats.health or world.spawn_points[0]')
+    parser.add_argument('--intern', action='store_true',
+                        help='Share structurally identical values in memory and in the JSON writer')
+    parser.add_argument('--cache-dir', help='Directory for cached conversion results')
+    parser.add_argument('--cache-max-bytes', type=int, default=ResultCache.DEFAULT_MAX_BYTES,
+                        help='Size limit of the cache directory')
+    parser.add_argument('--cache-stats', action='store_true', help='Print cache statistics to stderr')
+    parser.add_argument('--profile', action='store_true',
+                        help='Report time, memory and counters of each stage to stderr (the cache is not used)')
+    parser.add_argument('--profile-dump', metavar='FILE', help='With --profile, also save cProfile statistics')
+    parser.add_argument('--max-programs', type=int, default=ProgramCache.DEFAULT_MAX_ENTRIES,
+                        help='Number of evaluated configs kept in memory by --serve')
+    parser.add_argument('--max-int-bits', type=int, help='Fail if an operation produces a wider integer')
+    parser.add_argument('--max-nodes', type=int, help='Fail if a value has more nodes (arrays, dicts and scalars)')
+    parser.add_argument('--max-bytes', type=int, help='Fail if a value takes more bytes of compact JSON (estimated)')
+    parser.add_argument('--max-depth', type=int, help='Fail if arrays and dicts are nested deeper')
+    parser.add_argument('--timeout', type=float, help='Fail if evaluating a config takes longer, in seconds')
     args = parser.parse_args()
+    limit_values = (args.max_int_bits, args.max_nodes, args.max_bytes, args.max_depth, args.timeout)
+    limits = Limits(*limit_values) if any(value is not None for value in limit_values) else None
+    if args.batch and not args.output_dir:
+        parser.error('--batch requires --output-dir')
+    if args.stream and args.output:
+        parser.error('--stream writes its results to stdout')
+    if args.watch and not (args.input and args.output):
+        parser.error('--watch requires --input and --output')
+    if args.profile and (not args.input or args.watch):
+        parser.error('--profile works only with a single --input conversion')
+    if args.format == 'binary' and (not args.input or args.watch or args.profile):
+        parser.error('--format binary works only with a single --input conversion')
+    if limits and (args.watch or args.profile):
+        parser.error('--max-int-bits, --max-nodes, --max-bytes, --max-depth and --timeout '
+                     'do not apply to --watch and --profile')
+
+    if args.serve:
+        try:
+            serve(args.serve, args.max_programs, limits)
+        except ConfigError as e:
+            sys.stderr.write(str(e) + '\n')
+            sys.exit(1)
+        return
 
-    try:
-        with open(args.input, 'r', encoding='utf-8') as f:
-            content = f.read()
+    if args.stream:
+        try:
+            failed = convert_stream(sys.stdin.buffer, sys.stdout, args.stream, args.select,
+                                    args.jobs or os.cpu_count() or 1, limits=limits)
+        except ConfigError as e:
+            sys.stderr.write(str(e) + '\n')
+            sys.exit(1)
+        except KeyboardInterrupt:
+            return
+        sys.exit(1 if failed else 0)
+
+    if args.watch:
+        try:
+            Watcher(args.input, args.output, args.compact, args.watch_interval).run()
+        except KeyboardInterrupt:
+            pass
+        return
 
-        tokens = tokenize(content)
-        parser = Parser(tokens)
-        program = parser.parse_program()
+    if args.batch:
+        failed = convert_batch(args.batch, args.output_dir, args.jobs, args.compact, args.cache_dir,
+                               args.cache_max_bytes, intern=args.intern, select=args.select, limits=limits)
+        sys.exit(1 if failed else 0)
 
-        env = {}
-        evaluator = Evaluator(env)
+    try:
+        cache = ResultCache(args.cache_dir, args.cache_max_bytes) if args.cache_dir and not args.profile else None
 
-        # Evaluate definitions
-        for defn in program.definitions:
-            try:
-                value = evaluator.evaluate(defn.value_expr)
-                env[defn.name] = value
-            except Exception as e:
-                raise ConfigError(f"Error in definition '{defn.name}': {str(e)}")
+        binary = args.format == 'binary'
 
-        # Evaluate main expression
-        result = evaluator.evaluate(program.main_expr)
+        def convert(out):
+            if args.diff:
+                dump_json(diff_files(*args.diff, select=args.select, limits=limits), out, args.compact)
+            elif args.profile:
+                Profiler(dump_path=args.profile_dump).convert(args.input, out, args.compact, args.intern, args.select)
+            elif binary:
+                convert_file_binary(args.input, out, args.intern, args.select, limits)
+            else:
+                convert_file(args.input, out, cache, args.compact, args.intern, args.select, limits)
 
-        # Output JSON
-        json_output = json.dumps(result, ensure_ascii=False, indent=2)
-        sys.stdout.write(json_output)
+        if args.output:
+            with atomic_write(args.output, binary) as f:
+                convert(f)
+        else:
+            convert(sys.stdout.buffer if binary else sys.stdout)
+
+        if cache and args.cache_stats:
+            stats = cache.stats()
+            sys.stderr.write(
+                f"Cache: {stats['hits']} hits, {stats['misses']} misses "
+                f"(total {stats['total_hits']} hits, {stats['total_misses']} misses), "
+                f"{stats['entries']} entries, {stats['bytes']} bytes\n"
+            )
 
     except ConfigError as e:
         sys.stderr.write(str(e) + '\n')
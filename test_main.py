@@ -1,10 +1,17 @@
+import io
+import os
+import socket
+import threading
 import unittest
 import json
 import tempfile
 import subprocess
 import sys
+import time
 from pathlib import Path
 
+import main
+
 
 class ConfigLanguageTests(unittest.TestCase):
     @classmethod
@@ -89,6 +96,1057 @@ class ConfigLanguageTests(unittest.TestCase):
             self.assertEqual(output_json, self.expected_results["game.conf"])
         except json.JSONDecodeError as e:
             self.fail(f"Ошибка разбора JSON: {e}\nВывод:\n{result.stdout}")
+    def test_cache_dir(self):
+        """Повторный запуск с --cache-dir берет результат из кэша"""
+        input_file = self.test_path / "game.conf"
+        cache_dir = self.test_path / "cache"
+        cmd = [sys.executable, str(self.conversion_script), "--input", str(input_file),
+               "--cache-dir", str(cache_dir), "--cache-stats"]
+        first = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
+        second = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
+
+        self.assertEqual(first.returncode, 0, first.stderr)
+        self.assertEqual(second.returncode, 0, second.stderr)
+        self.assertIn("0 hits, 1 misses", first.stderr)
+        self.assertIn("1 hits, 0 misses", second.stderr)
+        self.assertIn("total 1 hits, 1 misses", second.stderr)
+        self.assertEqual(second.stdout, first.stdout)
+        self.assertEqual(json.loads(second.stdout), self.expected_results["game.conf"])
+        names = sorted(os.listdir(cache_dir))
+        self.assertEqual([name for name in names if not name.endswith(".json")], ["stats", "stats.lock"])
+
+    def test_cache_totals(self):
+        """Счетчики за все время не теряют обновлений из параллельных процессов и не растут в размере"""
+        cache_dir = str(self.test_path / "cache_totals")
+        code = ("import sys, main\ncache = main.ResultCache(sys.argv[1])\n"
+                "for _ in range(50):\n    cache._record('hits')\ncache._record('misses')")
+        processes = [subprocess.Popen([sys.executable, "-c", code, cache_dir],
+                                      cwd=os.path.dirname(os.path.abspath(main.__file__))) for _ in range(4)]
+        for process in processes:
+            self.assertEqual(process.wait(), 0)
+        stats = main.ResultCache(cache_dir).stats()
+        self.assertEqual((stats["total_hits"], stats["total_misses"]), (200, 4))
+        self.assertEqual(os.path.getsize(os.path.join(cache_dir, "stats")), len("200 4\n"))
+
+    def test_batch_mode(self):
+        """Пакетный режим преобразует все файлы и сообщает об ошибках по каждому"""
+        output_dir = self.test_path / "batch_output"
+        cmd = [sys.executable, str(self.conversion_script), "--batch", str(self.test_path / "*.conf"),
+               "--output-dir", str(output_dir), "--jobs", "2"]
+        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
+
+        self.assertEqual(result.returncode, 1)
+        self.assertIn("invalid_syntax.conf: Line 3, Col 13: Expected ':' after key name", result.stderr)
+        self.assertIn("Converted 3/5 files", result.stderr)
+        for name, expected in self.expected_results.items():
+            output_file = output_dir / name.replace('.conf', '.json')
+            self.assertEqual(json.loads(output_file.read_text(encoding='utf-8')), expected)
+        self.assertEqual(sorted(os.listdir(output_dir)),
+                         sorted(name.replace('.conf', '.json') for name in self.expected_results))
+
+    def test_select(self):
+        """--select выводит только значение по пути"""
+        input_file = self.test_path / "game.conf"
+        cmd = [sys.executable, str(self.conversion_script), "--input", str(input_file),
+               "--select", "player.abilities[1].effect"]
+        result = subprocess.run(cmd, capture_output=True, text=True, encoding='utf-8')
+
+        self.assertEqual(result.returncode, 0, result.stderr)
+        expected = self.expected_results["game.conf"]["player"]["abilities"][1]["effect"]
+        self.assertEqual(json.loads(result.stdout), expected)
+
+
+class TokenizerTests(unittest.TestCase):
+    def test_keywords_and_positions(self):
+        """Ключевые слова определяются по таблице, позиции вычисляются лениво"""
+        tokens = main.tokenize('% comment\n(def arrays array);\n  {len "x"}')
+        self.assertEqual(
+            [(t.type, t.value, t.line, t.col) for t in tokens],
+            [
+                ('LPAREN', '(', 2, 1), ('DEF', 'def', 2, 2), ('NAME', 'arrays', 2, 6),
+                ('ARRAY_KEYWORD', 'array', 2, 13), ('RPAREN', ')', 2, 18), ('SEMICOLON', ';', 2, 19),
+                ('LBRACE', '{', 3, 3), ('LEN', 'len', 3, 4), ('STRING', '"x"', 3, 8), ('RBRACE', '}', 3, 11),
+            ]
+        )
+
+    def test_unexpected_character_location(self):
+        """Ошибка лексера указывает строку и столбец"""
+        with self.assertRaises(main.ConfigError) as ctx:
+            main.tokenize('([\n  a: 1,\n  b: @\n])')
+        self.assertEqual(str(ctx.exception), "Line 3, Col 6: Unexpected character '@'")
+
+    def test_columnar_token_store(self):
+        """Токены хранятся в параллельных массивах, текст вырезается по запросу"""
+        tokens = main.tokenize('([ key: "value" ])')
+        self.assertEqual(len(tokens), 5)
+        self.assertEqual(tokens.types.typecode, 'i')
+        self.assertEqual([tokens.value(i) for i in range(len(tokens))], ['([', 'key', ':', '"value"', '])'])
+        self.assertEqual(main.TOKEN_TYPES[tokens.types[1]], 'NAME')
+
+    def test_stream_chunk_boundaries(self):
+        """Потоковый лексер дает те же токены при любом размере порции"""
+        expected = [(t.type, t.value, t.line, t.col) for t in main.tokenize(GEOMETRY_CONF)]
+        for chunk_size in (1, 3, 64):
+            for stream in (io.StringIO(GEOMETRY_CONF), io.BytesIO(GEOMETRY_CONF.encode('utf-8'))):
+                batches = main.tokenize_stream(stream, chunk_size)
+                tokens = [(t.type, t.value, t.line, t.col) for batch in batches for t in batch]
+                self.assertEqual(tokens, expected)
+
+    def test_parser_reads_token_batches(self):
+        """Parser принимает генератор порций токенов"""
+        program = main.Parser(main.tokenize_stream(io.StringIO(GAME_CONF), 16)).parse_program()
+        self.assertEqual(len(program.definitions), 9)
+        with self.assertRaises(main.ConfigError) as ctx:
+            main.Parser(main.tokenize_stream(io.StringIO(INVALID_SYNTAX_CONF), 4)).parse_program()
+        self.assertEqual(str(ctx.exception), "Line 3, Col 13: Expected ':' after key name")
+
+    def test_nodes_do_not_keep_source(self):
+        """Узлы AST хранят место в тексте без самого текста порции"""
+        source = "(def A 1);\n([\n  a: array(1, 2),\n  b: {+ A 1}\n])"
+        for batches in (main.tokenize(source), main.tokenize_stream(io.StringIO(source), 8)):
+            program = main.Parser(batches).parse_program()
+            array_node, brace_node = (expr for _, expr in program.main_expr.pairs)
+            for node, position in ((program.main_expr, (2, 1)), (array_node, (3, 6)), (brace_node, (4, 6))):
+                self.assertIsNone(node.token.index.source)
+                self.assertEqual((node.token.line, node.token.col), position)
+
+
+class CompiledProgramTests(unittest.TestCase):
+    def test_matches_evaluator(self):
+        """Скомпилированная программа дает тот же результат, что и Evaluator"""
+        for source in (WEB_SERVER_CONF, GEOMETRY_CONF, GAME_CONF):
+            program = main.Parser(main.tokenize(source)).parse_program()
+            self.assertEqual(main.compile_program(program).evaluate(), main.Evaluator().evaluate_program(program))
+
+    def test_reuse_with_injected_env(self):
+        """Скомпилированную программу можно вычислять повторно с разным окружением"""
+        program = main.Parser(main.tokenize('(def B {* A 2}); ([ a: A, b: B ])')).parse_program()
+        compiled = main.compile_program(program)
+        self.assertEqual(compiled.evaluate({'A': 1}), {'a': 1, 'b': 2})
+        self.assertEqual(compiled.evaluate({'A': 5}), {'a': 5, 'b': 10})
+
+    def test_same_error_messages(self):
+        """Ошибки вычисления совпадают с эталонным Evaluator"""
+        for source in ('{+ {* X 1} 2}', '{/ 10 0}', '{+ 1 "a"}', '(def Z {len 5}); Z'):
+            program = main.Parser(main.tokenize(source)).parse_program()
+            with self.assertRaises(main.ConfigError) as expected:
+                main.Evaluator().evaluate_program(program)
+            with self.assertRaises(main.ConfigError) as actual:
+                main.compile_program(program).evaluate()
+            self.assertEqual(str(actual.exception), str(expected.exception))
+
+
+class OptimizerTests(unittest.TestCase):
+    def test_folds_constants_and_drops_definitions(self):
+        """Свертка констант убирает определения и операции, не меняя результат"""
+        program = main.Parser(main.tokenize(GAME_CONF)).parse_program()
+        optimized = main.optimize(program)
+        self.assertEqual(optimized.definitions, [])
+        self.assertEqual(main.Evaluator().evaluate_program(optimized), self.expected_game())
+        dragon = optimized.main_expr.pairs[1][1].elements[1]
+        self.assertIsInstance(dict(dragon.pairs)['damage'], main.NumberNode)
+
+    def test_errors_are_preserved(self):
+        """Ошибочные выражения не сворачиваются и дают прежние сообщения"""
+        cases = {
+            "(def ZERO 0); {/ 10 ZERO}": "Division by zero in constant expression",
+            '(def A {/ 1 0}); (def B 2); {+ A B}': "Error in definition 'A': Division by zero in constant expression",
+            '(def A array(1, C)); (def B 2); array(A, B)': "Error in definition 'A': Undefined constant: C",
+        }
+        for source, message in cases.items():
+            program = main.optimize(main.Parser(main.tokenize(source)).parse_program())
+            with self.assertRaises(main.ConfigError) as ctx:
+                main.Evaluator().evaluate_program(program)
+            self.assertEqual(str(ctx.exception), message)
+
+    def expected_game(self):
+        return json.loads(GAME_JSON)
+
+
+class JSONEmitterTests(unittest.TestCase):
+    def test_matches_json_dumps(self):
+        """Потоковый вывод побайтно совпадает с json.dumps"""
+        value = json.loads(GAME_JSON)
+        value["misc"] = {"empty_list": [], "empty_dict": {}, "escapes": "a\"b\\c\n\t\x01", "big": 10 ** 30}
+        for compact, expected in ((False, json.dumps(value, ensure_ascii=False, indent=2)),
+                                  (True, json.dumps(value, ensure_ascii=False, separators=(',', ':')))):
+            out = io.StringIO()
+            main.dump_json(value, out, compact)
+            self.assertEqual(out.getvalue(), expected)
+
+    def test_deep_nesting(self):
+        """Глубокая вложенность не приводит к RecursionError"""
+        value = []
+        for _ in range(10000):
+            value = [value]
+        out = io.StringIO()
+        main.dump_json(value, out, compact=True)
+        self.assertEqual(out.getvalue(), '[' * 10001 + ']' * 10001)
+
+
+class NestingTests(unittest.TestCase):
+    def test_explicit_stack_matches_recursive(self):
+        """Разбор и вычисление без рекурсии совпадают с рекурсивными версиями"""
+        for source in (WEB_SERVER_CONF, GEOMETRY_CONF, GAME_CONF):
+            program = main.Parser(main.tokenize(source)).parse_program()
+            reference = main.RecursiveParser(main.tokenize(source)).parse_program()
+            self.assertEqual(main.Evaluator().evaluate_program(program),
+                             main.RecursiveEvaluator().evaluate_program(reference))
+
+    def test_deep_nesting(self):
+        """Глубина вложенности не ограничена стеком вызовов Python"""
+        depth = 20000
+        source = '(def X 1); ' + '([a: ' * depth + '{+ 1 ' * depth + 'X' + '}' * depth + '])' * depth
+        value = main.Evaluator().evaluate_program(main.Parser(main.tokenize(source)).parse_program())
+        for _ in range(depth):
+            value = value['a']
+        self.assertEqual(value, depth + 1)
+
+    def test_nested_error_context(self):
+        """Вложенные операции добавляют контекст к сообщению об ошибке"""
+        program = main.Parser(main.tokenize('array({+ 1 {* 2 {- Y 1}}})')).parse_program()
+        with self.assertRaises(main.ConfigError) as ctx:
+            main.Evaluator().evaluate_program(program)
+        self.assertEqual(str(ctx.exception), "Error evaluating arguments for +: Error evaluating arguments for *: "
+                                             "Error evaluating arguments for -: Undefined constant: Y")
+
+
+class LazyDefinitionTests(unittest.TestCase):
+    def evaluate(self, source):
+        evaluator = main.Evaluator()
+        return evaluator.evaluate_program(main.Parser(main.tokenize(source)).parse_program()), evaluator
+
+    def test_only_referenced_definitions_are_evaluated(self):
+        """Вычисляются только определения, от которых зависит основное выражение"""
+        value, evaluator = self.evaluate('(def A 1); (def B {/ 1 0}); (def C {+ A 1}); (def D C); array(C, D)')
+        self.assertEqual(value, [2, 2])
+        self.assertEqual(evaluator.definitions.evaluated, 3)
+
+    def test_forward_references_and_shadowing(self):
+        """Ссылка вперед разрешается, переопределение видит предыдущее значение"""
+        value, _ = self.evaluate('(def A {+ B 1}); (def B 10); (def B {* B 2}); array(A, B)')
+        self.assertEqual(value, [21, 20])
+
+    def test_cycle_detection(self):
+        """Циклические определения приводят к понятной ошибке"""
+        with self.assertRaises(main.ConfigError) as ctx:
+            self.evaluate('(def A {+ B 1}); (def B {+ C 1}); (def C A); ([ x: A ])')
+        self.assertEqual(str(ctx.exception), "Circular definition: A -> B -> C -> A")
+
+    def test_long_dependency_chain(self):
+        """Длинная цепочка зависимостей вычисляется без рекурсии"""
+        source = '(def D0 0); ' + ' '.join(f'(def D{i} {{+ D{i - 1} 1}});' for i in range(1, 20000)) + ' D19999'
+        value, evaluator = self.evaluate(source)
+        self.assertEqual(value, 19999)
+        self.assertEqual(evaluator.definitions.evaluated, 20000)
+
+
+class SelectTests(unittest.TestCase):
+    def select(self, source, path):
+        program = main.Parser(main.tokenize(source)).parse_program()
+        evaluator = main.Evaluator()
+        return evaluator.evaluate_path(program, path), evaluator
+
+    def test_matches_full_evaluation(self):
+        """Значение по любому пути совпадает с частью полного результата"""
+        program = main.Parser(main.tokenize(GAME_CONF)).parse_program()
+        stack = [([], main.Evaluator().evaluate_program(program))]
+        while stack:
+            steps, expected = stack.pop()
+            if steps:
+                self.assertEqual(main.Evaluator().evaluate_path(program, steps), expected)
+            if isinstance(expected, dict):
+                stack.extend((steps + [key], item) for key, item in expected.items())
+            elif isinstance(expected, list):
+                stack.extend((steps + [i], item) for i, item in enumerate(expected))
+
+    def test_evaluates_only_selected_subtree(self):
+        """Остальная часть конфигурации и лишние определения не вычисляются"""
+        source = """
+        (def BAD {/ 1 0}); (def BASE 10); (def HP {* BASE 2});
+        (def STATS ([ health: HP, mana: BAD ]));
+        ([ player: ([ stats: STATS, broken: BAD ]), spawn: array(1, {+ 1 1}, HP) ])
+        """
+        value, evaluator = self.select(source, "player.stats.health")
+        self.assertEqual(value, 20)
+        self.assertEqual(evaluator.definitions.evaluated, 2)
+        self.assertEqual(self.select(source, "spawn[-2]")[0], 2)
+
+    def test_path_through_computed_value(self):
+        """Путь продолжается по вычисленному значению и внешним константам"""
+        program = main.Parser(main.tokenize('([ a: X ])')).parse_program()
+        value = main.Evaluator({"X": {"b": [5, 6]}}).evaluate_path(program, "a.b[1]")
+        self.assertEqual(value, 6)
+
+    def test_errors(self):
+        """Ошибки пути и определений сообщают, где они произошли"""
+        source = '(def A ([ x: {+ 1 "s"} ])); ([ a: A, b: array(1) ])'
+        cases = {
+            "a.y": "Path not found: a.y",
+            "b[1]": "Path not found: b[1]",
+            "b.c": "Path not found: b.c",
+            "a..x": "Invalid path: a..x",
+            "a.x": "Error in definition 'A': + expects integer arguments",
+        }
+        for path, message in cases.items():
+            with self.assertRaises(main.ConfigError) as ctx:
+                self.select(source, path)
+            self.assertIn(message, str(ctx.exception))
+
+
+class ServerTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.test_dir.cleanup)
+        self.config = os.path.join(self.test_dir.name, "game.conf")
+        with open(self.config, "w", encoding="utf-8") as f:
+            f.write(GAME_CONF)
+        self.socket_path = os.path.join(self.test_dir.name, "server.sock")
+        self.server = main.ConfigServer(self.socket_path, max_entries=2)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def test_concurrent_requests_and_stats(self):
+        """Параллельные запросы обслуживаются из кэша, счетчики отражают попадания"""
+        expected = json.loads(GAME_JSON)
+        responses = []
+
+        def client():
+            responses.append(main.send_request(self.socket_path, {"op": "convert", "path": self.config}))
+
+        threads = [threading.Thread(target=client) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(responses, [{"ok": True, "value": expected}] * 8)
+
+        response = main.send_request(self.socket_path, {"op": "convert", "path": self.config,
+                                                        "select": "player.stats.health"})
+        self.assertEqual(response, {"ok": True, "value": expected["player"]["stats"]["health"]})
+        stats = main.send_request(self.socket_path, {"op": "stats"})["stats"]
+        self.assertEqual(stats["requests"], 9)
+        self.assertEqual(stats["cache_hits"] + stats["cache_misses"], 9)
+        self.assertGreaterEqual(stats["cache_hits"], 1)
+        self.assertGreater(stats["avg_latency_ms"], 0)
+
+    def test_invalidation_and_errors(self):
+        """Изменение файла приводит к повторному разбору, ошибки возвращаются клиенту"""
+        request = {"op": "convert", "path": self.config}
+        main.send_request(self.socket_path, request)
+        with open(self.config, "w", encoding="utf-8") as f:
+            f.write("([ version: 2 ])")
+        st = os.stat(self.config)
+        os.utime(self.config, ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+        self.assertEqual(main.send_request(self.socket_path, request), {"ok": True, "value": {"version": 2}})
+
+        with open(self.config, "w", encoding="utf-8") as f:
+            f.write("([ version: ])")
+        os.utime(self.config, ns=(st.st_atime_ns, st.st_mtime_ns + 2 * 10 ** 9))
+        response = main.send_request(self.socket_path, request)
+        self.assertFalse(response["ok"])
+        self.assertIn("Line 1, Col 13", response["error"])
+        self.assertFalse(main.send_request(self.socket_path, {"op": "unknown"})["ok"])
+        self.assertEqual(main.send_request(self.socket_path, {"op": "stats"})["stats"]["errors"], 2)
+
+    def test_existing_file_kept(self):
+        """Файл, который не является сокетом, не удаляется"""
+        with self.assertRaises(main.ConfigError):
+            main.serve(self.config)
+        with open(self.config, encoding="utf-8") as f:
+            self.assertEqual(f.read(), GAME_CONF)
+
+    def test_running_server_kept(self):
+        """Сокет работающего сервера не удаляется вторым запуском на том же пути"""
+        with self.assertRaisesRegex(main.ConfigError, "in use"):
+            main.serve(self.socket_path)
+        self.assertTrue(main.send_request(self.socket_path, {"op": "stats"})["ok"])
+
+    def test_stale_socket_replaced(self):
+        """Сокет, на котором никто не слушает, заменяется новым сервером"""
+        stale = os.path.join(self.test_dir.name, "stale.sock")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.bind(stale)
+        server = subprocess.Popen([sys.executable, "-c", "import main, sys; main.serve(sys.argv[1])", stale],
+                                  cwd=os.path.dirname(os.path.abspath(main.__file__)))
+        self.addCleanup(server.wait)
+        self.addCleanup(server.terminate)
+        for _ in range(1000):
+            try:
+                response = main.send_request(stale, {"op": "stats"})
+                break
+            except OSError:
+                time.sleep(0.01)
+        self.assertTrue(response["ok"])
+
+
+class WatcherTests(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.test_dir.cleanup)
+        self.config = os.path.join(self.test_dir.name, "app.conf")
+        self.output = os.path.join(self.test_dir.name, "app.json")
+        self.log = io.StringIO()
+        self.watcher = main.Watcher(self.config, self.output, log=self.log)
+        self.version = 0
+
+    def save(self, source):
+        with open(self.config, "w", encoding="utf-8") as f:
+            f.write(source)
+        # mtime меняется явно: запись может уложиться в разрешение часов файловой системы
+        self.version += 1
+        os.utime(self.config, ns=(self.version * 10 ** 9, self.version * 10 ** 9))
+
+    def result(self):
+        with open(self.output, encoding="utf-8") as f:
+            return json.load(f)
+
+    def test_reevaluates_only_changed_definitions(self):
+        """Пересчитываются измененные определения и зависящие от них"""
+        template = """
+        (def BASE {base}); (def HP {{* BASE 2}}); (def MANA {mana}); (def OTHER {{len "abc"}});
+        ([ hp: HP, mana: MANA, other: OTHER, list: array(1, {{+ 1 2}}) ])
+        """
+        self.save(template.format(base=10, mana="{+ BASE 5}"))
+        self.assertTrue(self.watcher.update())
+        self.assertEqual(self.watcher.evaluated, 4)
+        self.assertFalse(self.watcher.update())
+
+        self.save(template.format(base=10, mana="{+ BASE 6}"))
+        self.assertTrue(self.watcher.update())
+        self.assertEqual(self.watcher.evaluated, 1)
+        self.assertEqual(self.result(), {"hp": 20, "mana": 16, "other": 3, "list": [1, 3]})
+
+        self.save(template.format(base=20, mana="{+ BASE 6}"))
+        self.assertTrue(self.watcher.update())
+        self.assertEqual(self.watcher.evaluated, 3)
+        self.assertEqual(self.result(), {"hp": 40, "mana": 26, "other": 3, "list": [1, 3]})
+
+    def test_shadowing_changes_are_detected(self):
+        """Новое определение с тем же именем меняет значения ссылок на него"""
+        self.save('(def A 1); (def B {+ A 1}); ([ b: B, a: A ])')
+        self.watcher.update()
+        self.save('(def A 1); (def A 5); (def B {+ A 1}); ([ b: B, a: A ])')
+        self.watcher.update()
+        self.assertEqual(self.result(), {"b": 6, "a": 5})
+
+    def test_text_edits_in_main(self):
+        """Правки, сдвиги и комментарии в главном выражении дают тот же результат, что полный расчет"""
+        versions = [
+            '(def A 1); (def B 2);\n([ x: array(A, {+ B 1}), y: ([ z: B, w: "s" ]), v: {* A 3} ])',
+            '(def A 1); (def B 2);\n([ x: array(A, {+ B 10}), y: ([ z: B, w: "s" ]), v: {* A 3} ])',
+            '% комментарий\n\n  (def A 1); (def B 2);\n([ x: array(A, {+ B 10}), y: ([ z: B, w: "st" ]), v: {* A 3} ])',
+            '(def A 7); (def B 2);\n([ x: array(A, {+ B 10}),  % x\n\n y: ([ z: B, w: "st" ]), v: {* A 3} ])',
+            '(def A 7); (def B 4);\n([ x: array(A, {+ B 10}), q: B,\n\n y: ([ z: B, w: "st" ]), v: {* A 3} ])',
+            '(def A 7); (def B 4);\n([ q: B, y: ([ z: B ]), v: {* A 3} ])',
+        ]
+        for source in versions:
+            self.save(source)
+            self.assertTrue(self.watcher.update())
+            self.assertEqual(self.result(), main.loads(source))
+
+    def test_errors_keep_previous_output(self):
+        """Ошибка в новой версии сообщается, а прежний результат остается"""
+        self.save('(def A 1); ([ a: A ])')
+        self.watcher.update()
+        self.save('(def A {/ 1 0}); ([ a: A ])')
+        self.assertFalse(self.watcher.update())
+        self.assertIn("Error in definition 'A': Division by zero", self.log.getvalue())
+        self.assertEqual(self.result(), {"a": 1})
+        self.assertEqual(sorted(os.listdir(self.test_dir.name)), ["app.conf", "app.json"])
+
+    def test_internal_errors_keep_watching(self):
+        """Прочие исключения тоже только сообщаются, наблюдение продолжается"""
+        self.save('([ a: 1 ])')
+        self.watcher.update()
+        self.save('([ a: {chr 99999999999999999999} ])')
+        self.assertFalse(self.watcher.update())
+        self.assertIn("Internal error:", self.log.getvalue())
+        self.assertEqual(self.result(), {"a": 1})
+        watcher = main.Watcher(self.config, os.path.join(self.test_dir.name, "missing", "app.json"), log=self.log)
+        self.assertFalse(watcher.update())
+        self.assertEqual(self.log.getvalue().count("Internal error:"), 2)
+
+
+class BenchmarkSuiteTests(unittest.TestCase):
+    def test_generator_is_seeded(self):
+        """Генератор воспроизводим и порождает корректные конфигурации"""
+        import bench
+        params = dict(entries=50, depth=3, definitions=20, string_length=8, op_density=0.5)
+        source = bench.generate_synthetic(seed=7, **params)
+        self.assertEqual(source, bench.generate_synthetic(seed=7, **params))
+        self.assertNotEqual(source, bench.generate_synthetic(seed=8, **params))
+        program = main.Parser(main.tokenize(source)).parse_program()
+        self.assertEqual(len(main.Evaluator().evaluate_program(program)), 50)
+
+    def test_regressions_are_flagged(self):
+        """Замедление сверх порога отмечается только для совпадающих параметров"""
+        import bench
+        params = {"entries": 10}
+        baseline = {"cases": {"a": {"params": params, "stages": {"parse": 1.0, "json": 1.0}},
+                              "b": {"params": {"entries": 20}, "stages": {"parse": 1.0}}}}
+        current = {"cases": {"a": {"params": params, "stages": {"parse": 1.2, "json": 1.05}},
+                             "b": {"params": {"entries": 30}, "stages": {"parse": 5.0}}}}
+        self.assertEqual(bench.compare_results(current, baseline, 0.1), [("a", "parse", 1.0, 1.2)])
+
+
+class ProfilerTests(unittest.TestCase):
+    def test_report(self):
+        """Отчет содержит все этапы и их счетчики, вывод не меняется"""
+        with tempfile.TemporaryDirectory() as test_dir:
+            config = os.path.join(test_dir, "game.conf")
+            dump = os.path.join(test_dir, "game.prof")
+            with open(config, "w", encoding="utf-8") as f:
+                f.write(GAME_CONF)
+            out, log = io.StringIO(), io.StringIO()
+            profiler = main.Profiler(log=log, dump_path=dump)
+            profiler.convert(config, out)
+            self.assertEqual(json.loads(out.getvalue()), json.loads(GAME_JSON))
+            self.assertTrue(os.path.getsize(dump))
+
+        self.assertEqual(list(profiler.stages), ["tokenize", "parse", "evaluate", "json"])
+        self.assertEqual(profiler.stages["tokenize"][2]["tokens"], len(main.tokenize(GAME_CONF)))
+        self.assertEqual(profiler.stages["json"][2]["output bytes"], len(out.getvalue().encode("utf-8")))
+        self.assertTrue(all(peak is not None for _, peak, _ in profiler.stages.values()))
+        report = log.getvalue()
+        for text in ("MiB peak", "BraceNode", "definitions ", "main expression", "cProfile statistics"):
+            self.assertIn(text, report)
+
+    def test_common_subexpressions(self):
+        """Повторные операции учитываются и без optimize()"""
+        with tempfile.TemporaryDirectory() as test_dir:
+            config = os.path.join(test_dir, "items.conf")
+            with open(config, "w", encoding="utf-8") as f:
+                f.write('(def TAGS array(1, 2));\n([ a: {len TAGS}, b: {len TAGS}, c: {+ {len TAGS} 1} ])')
+            profiler = main.Profiler(log=io.StringIO())
+            profiler.convert(config, io.StringIO())
+        self.assertEqual(profiler.stages["evaluate"][2]["common subexpressions reused"], 2)
+
+
+class LibraryApiTests(unittest.TestCase):
+    def test_loads_and_load(self):
+        """loads/load возвращают объекты Python, совпадающие с выводом JSON"""
+        self.assertEqual(main.loads(GAME_CONF), json.loads(GAME_JSON))
+        with tempfile.TemporaryDirectory() as test_dir:
+            path = os.path.join(test_dir, "web.conf")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(WEB_SERVER_CONF)
+            self.assertEqual(main.load(path), json.loads(WEB_SERVER_JSON))
+        self.assertEqual(main.loads('array(X, {+ X 1})', {"X": 1}), [1, 2])
+        with self.assertRaises(main.ConfigError):
+            main.loads('{/ 1 0}')
+
+    def test_compiled_cache(self):
+        """Повторные вызовы берут программу из кэша, но возвращают новые объекты"""
+        source = '(def A 2); ([ items: array(A, {* A 3}) ])'
+        program = main.compile(source)
+        self.assertIs(main.compile(source), program)
+        first = main.loads(source)
+        first["items"].append(0)
+        self.assertEqual(main.loads(source), {"items": [2, 6]})
+        self.assertEqual(program.evaluate(), {"items": [2, 6]})
+
+        cache = main.CompiledCache(max_entries=2)
+        for text in ("1", "2", "3", "1"):
+            cache.get(text)
+        self.assertEqual((cache.hits, cache.misses, len(cache)), (0, 4, 2))
+
+    def test_import_is_light(self):
+        """Импорт модуля не загружает argparse, json и модули сервера, кэшей и двоичного формата"""
+        heavy = ("argparse", "json", "concurrent.futures", "socket", "socketserver", "tempfile", "shutil",
+                 "glob", "mmap", "hashlib", "threading", "struct")
+        code = f"import sys, main; print(sorted(m for m in {heavy!r} if m in sys.modules))"
+        result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(main.__file__)))
+        self.assertEqual(result.stdout.strip(), "[]", result.stderr)
+
+
+class BinaryFormatTests(unittest.TestCase):
+    def write(self, value):
+        test_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(test_dir.cleanup)
+        path = os.path.join(test_dir.name, "value.cfgb")
+        with open(path, "wb") as f:
+            main.dump_binary(value, f)
+        reader = main.BinaryReader(path)
+        self.addCleanup(reader.close)
+        return reader
+
+    def test_round_trip_and_lookup(self):
+        """Двоичный файл читается целиком и по пути без разбора остального"""
+        value = json.loads(GAME_JSON)
+        value["misc"] = {"big": -10 ** 30, "edge": [2 ** 63 - 1, -2 ** 63, 2 ** 63], "text": "ключ\n\"", "empty": [{}, []]}
+        reader = self.write(value)
+        self.assertEqual(reader.decode(), value)
+        self.assertEqual(reader.get("player.abilities[1].effect").to_python(),
+                         value["player"]["abilities"][1]["effect"])
+        self.assertEqual(reader.get("misc.edge[-1]"), 2 ** 63)
+        self.assertEqual(reader.root["misc"]["text"], "ключ\n\"")
+        self.assertEqual(reader.root.keys(), list(value))
+        self.assertNotIn("missing", reader.root)
+        with self.assertRaises(main.ConfigError) as ctx:
+            reader.get("player.abilities[5]")
+        self.assertIn("Path not found: player.abilities[5]", str(ctx.exception))
+
+    def test_shared_values_written_once(self):
+        """Повторяющиеся строки, числа и общие поддеревья хранятся один раз"""
+        block = {"hp": 100, "loot": ["gold", "gold"]}
+        out = io.BytesIO()
+        main.dump_binary([block] * 100, out)
+        self.assertLess(len(out.getvalue()), 600)
+
+    def test_cli(self):
+        """--format binary пишет файл, который читает BinaryReader"""
+        with tempfile.TemporaryDirectory() as test_dir:
+            config = os.path.join(test_dir, "game.conf")
+            output = os.path.join(test_dir, "game.cfgb")
+            with open(config, "w", encoding="utf-8") as f:
+                f.write(GAME_CONF)
+            result = subprocess.run([sys.executable, os.path.abspath(main.__file__), "--input", config,
+                                     "--format", "binary", "--output", output], capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            with main.BinaryReader(output) as reader:
+                self.assertEqual(reader.decode(), json.loads(GAME_JSON))
+            with self.assertRaises(main.ConfigError):
+                main.BinaryReader(config)
+
+
+class InterningTests(unittest.TestCase):
+    SOURCE = """
+    (def LOOT array("gold", {* 2 5}, ([ rare: 0 ])));
+    ([
+        a: ([ hp: 10, loot: array("gold", 10, ([ rare: 0 ])) ]),
+        b: ([ hp: 10, loot: LOOT ]),
+        c: array(LOOT, LOOT, array())
+    ])
+    """
+
+    def test_identical_subtrees_are_shared(self):
+        """Структурно равные значения становятся одним объектом"""
+        program = main.Parser(main.tokenize(self.SOURCE)).parse_program()
+        interner = main.Interner()
+        value = main.Evaluator(interner=interner).evaluate_program(program)
+        self.assertEqual(value, main.Evaluator().evaluate_program(program))
+        self.assertIs(value["a"], value["b"])
+        self.assertIs(value["a"]["loot"], value["c"][1])
+        self.assertIn(id(value["a"]), interner.shared)
+        self.assertNotIn(id(value), interner.shared)
+
+    def test_emitter_reuses_shared_text(self):
+        """Вывод с повторным использованием текста совпадает с json.dumps"""
+        program = main.Parser(main.tokenize(self.SOURCE)).parse_program()
+        interner = main.Interner()
+        value = main.Evaluator(interner=interner).evaluate_program(program)
+        for compact, expected in ((False, json.dumps(value, ensure_ascii=False, indent=2)),
+                                  (True, json.dumps(value, ensure_ascii=False, separators=(',', ':')))):
+            out = io.StringIO()
+            main.dump_json(value, out, compact, interner.shared)
+            self.assertEqual(out.getvalue(), expected)
+
+
+class VectorArithmeticTests(unittest.TestCase):
+    def test_elementwise_operators(self):
+        """Арифметика над массивами поэлементная, число применяется к каждому элементу"""
+        self.assertEqual(main.loads("{+ array(1, 2, 3) 10}"), [11, 12, 13])
+        self.assertEqual(main.loads("{- 10 array(1, 2)}"), [9, 8])
+        self.assertEqual(main.loads("{* array(1, 2) array(3, 4)}"), [3, 8])
+        self.assertEqual(main.loads("{/ {- array(0, 7) 7} 2}"), [-4, 0])
+        self.assertEqual(main.loads("{len {* array(1, 2, 3) 2}}"), 3)
+        self.assertEqual(main.loads("{* array(X, 1) X}", {"X": 2 ** 70}), [2 ** 140, 2 ** 70])
+        for source, message in (("{+ array(1) array(1, 2)}", "+ expects arrays of the same length, got 1 and 2"),
+                                ('{* array(1, "a") 2}', "* expects arrays of integers, got elements of types: str"),
+                                ('{- array(1) "a"}', "- expects integer arguments, got types: list, str"),
+                                ("{/ array(1, 2) array(1, 0)}", "Division by zero in constant expression"),
+                                ("{/ array(1, 2) 0}", "Division by zero in constant expression"),
+                                ('{/ "a" 0}', "/ expects integer arguments, got types: str, int")):
+            with self.assertRaises(main.ConfigError) as ctx:
+                main.loads(source)
+            self.assertIn(message, str(ctx.exception))
+
+    def test_large_results_are_packed(self):
+        """Большие результаты хранятся в array('q') и выводятся как обычные массивы"""
+        items = ", ".join(map(str, range(100)))
+        text = f"([ table: {{* array({items}) 3}}, big: {{* array({items}) {2 ** 62}}} ])"
+        program = main.Parser(main.tokenize(text)).parse_program()
+        value = main.Evaluator().evaluate_program(program)
+        self.assertEqual(value["table"].typecode, "q")
+        self.assertIsInstance(value["big"], list)
+        expected = {"table": [i * 3 for i in range(100)], "big": [i * 2 ** 62 for i in range(100)]}
+        for compact in (False, True):
+            out = io.StringIO()
+            main.dump_json(value, out, compact)
+            self.assertEqual(out.getvalue(), json.dumps(expected, indent=None if compact else 2,
+                                                        separators=(',', ':') if compact else None))
+        with tempfile.TemporaryDirectory() as test_dir:
+            path = os.path.join(test_dir, "value.cfgb")
+            with open(path, "wb") as f:
+                main.dump_binary(value, f)
+            with main.BinaryReader(path) as reader:
+                self.assertEqual(reader.get("table[99]"), 297)
+                self.assertEqual(reader.decode(), expected)
+
+    def test_library_returns_lists(self):
+        """loads и compile().evaluate() возвращают списки при любой длине результата"""
+        items = ", ".join(map(str, range(100)))
+        text = f"(def T {{* array({items}) 3}}); ([ a: T, b: array(T, {{+ array(1) 1}}), s: \"x\" ])"
+        for value in (main.loads(text), main.compile(text, cache=False).evaluate(),
+                      main._InterpretedProgram(main.Parser(main.tokenize(text)).parse_program()).evaluate()):
+            self.assertIs(type(value["a"]), list)
+            self.assertIs(type(value["b"][0]), list)
+            self.assertIs(value["b"][0], value["a"])
+            self.assertEqual(value, {"a": [i * 3 for i in range(100)], "b": [value["a"], [2]], "s": "x"})
+
+
+class RangeTests(unittest.TestCase):
+    def test_range_is_lazy(self):
+        """range не строит список: len за O(1), индексация и арифметика работают, слишком длинный - ошибка"""
+        self.assertEqual(list(main.loads("{range 0 5}")), [0, 1, 2, 3, 4])
+        self.assertEqual(list(main.loads("{Range 10 0 {- 0 3}}")), [10, 7, 4, 1])
+        self.assertEqual(main.loads("{len {range 0 1000000000000 2}}"), 500000000000)
+        self.assertEqual(main.loads("{* {range 1 4} 2}"), [2, 4, 6])
+        self.assertEqual(main.loads("([ range: 1 ])"), {"range": 1})
+        program = main.Parser(main.tokenize("([ ids: {range 100 1000000000} ])")).parse_program()
+        self.assertEqual(main.Evaluator().evaluate_path(program, "ids[5]"), 105)
+        for source, message in (("{range 1}", "range expects 2 or 3 arguments, got 1"),
+                                ('{range "a" 2}', "range expects integer arguments, got types: str, int"),
+                                ("{range 0 5 0}", "range step must not be zero"),
+                                ("{len {range 0 100000000000000000000}}",
+                                 "range has 100000000000000000000 elements, at most 9223372036854775807")):
+            with self.assertRaises(main.ConfigError) as ctx:
+                main.loads(source)
+            self.assertIn(message, str(ctx.exception))
+
+    def test_range_output(self):
+        """JSON и двоичный вывод совпадают с выводом обычного массива"""
+        value = main.loads("([ ids: {range 0 10000 3}, empty: {range 5 5}, nested: array({range 0 2}) ])")
+        expected = {"ids": list(range(0, 10000, 3)), "empty": [], "nested": [[0, 1]]}
+        for compact in (False, True):
+            out = io.StringIO()
+            main.dump_json(value, out, compact)
+            self.assertEqual(out.getvalue(), json.dumps(expected, indent=None if compact else 2,
+                                                        separators=(',', ':') if compact else None))
+        out = io.BytesIO()
+        main.dump_binary(value, out)
+        with tempfile.TemporaryDirectory() as test_dir:
+            path = os.path.join(test_dir, "value.cfgb")
+            with open(path, "wb") as f:
+                f.write(out.getvalue())
+            with main.BinaryReader(path) as reader:
+                self.assertEqual(reader.decode(), expected)
+
+
+class IncludeTests(unittest.TestCase):
+    def setUp(self):
+        test_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(test_dir.cleanup)
+        self.dir = test_dir.name
+        os.mkdir(os.path.join(self.dir, "lib"))
+        self.write("lib/base.conf", '(def HP 100);\n(include "units.conf");\n')
+        self.write("lib/units.conf", "(def UNIT 10);\n(def DOUBLE {* HP 2});\n")
+        self.write("lib/extra.conf", '(include "units.conf");\n(def EXTRA {+ UNIT 1});\n')
+        self.write("main.conf", '(include "lib/base.conf");\n(include "lib/extra.conf");\n(def HP 5);\n'
+                                "([ hp: HP, unit: UNIT, double: DOUBLE, extra: EXTRA ])")
+
+    def write(self, name, text):
+        path = os.path.join(self.dir, name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return path
+
+    def parse(self, name, modules):
+        path = os.path.join(self.dir, name)
+        return main.Parser(main.tokenize_file(path), path, modules).parse_program()
+
+    def test_included_definitions(self):
+        """Определения подключаются на месте include, каждый файл - один раз и разбирается один раз"""
+        modules = main.ModuleCache()
+        program = self.parse("main.conf", modules)
+        self.assertEqual(main.Evaluator().evaluate_program(program), {"hp": 5, "unit": 10, "double": 200, "extra": 11})
+        self.assertEqual([defn.name for defn in program.definitions], ["HP", "UNIT", "DOUBLE", "EXTRA", "HP"])
+        self.assertEqual([os.path.relpath(path, self.dir) for path in program.includes],
+                         [os.path.join("lib", name) for name in ("base.conf", "units.conf", "extra.conf")])
+        self.parse("main.conf", modules)
+        self.assertEqual(modules.misses, 3)
+        self.assertEqual(main.load(os.path.join(self.dir, "main.conf"))["extra"], 11)
+
+    def test_include_errors(self):
+        """Циклы, отсутствующие файлы и основное выражение в подключаемом файле - ошибки"""
+        self.write("a.conf", '(include "b.conf");\n([ a: 1 ])')
+        self.write("b.conf", '(include "c.conf");\n')
+        self.write("c.conf", '(def C 1);\n(include "b.conf");\n')
+        self.write("missing.conf", '(include "nope.conf");\n([ a: 1 ])')
+        self.write("bad.conf", '(include "main.conf");\n([ a: 1 ])')
+        for name, message in (("a.conf", "c.conf: Line 2, Col 2: Include cycle: b.conf -> c.conf -> b.conf"),
+                              ("missing.conf", "Cannot include nope.conf: No such file or directory"),
+                              ("bad.conf", "main.conf: Line 4, Col 1: Expected definition or include in included file")):
+            with self.assertRaises(main.ConfigError) as ctx:
+                cwd = os.getcwd()
+                os.chdir(self.dir)
+                try:
+                    self.parse(name, main.ModuleCache())
+                finally:
+                    os.chdir(cwd)
+            self.assertIn(message, str(ctx.exception))
+
+    def test_caches_follow_included_files(self):
+        """Кэш результатов и кэш сервера замечают изменение подключенного файла"""
+        path = os.path.join(self.dir, "main.conf")
+        cache = main.ResultCache(os.path.join(self.dir, "cache"))
+        programs = main.ProgramCache()
+        key = cache.key_for_file(path)
+        self.assertEqual(programs.value(path)["unit"], 10)
+        self.write("lib/units.conf", "(def UNIT 20);\n(def DOUBLE 0);\n")
+        self.assertNotEqual(cache.key_for_file(path), key)
+        self.assertEqual(programs.value(path), {"hp": 5, "unit": 20, "double": 0, "extra": 21})
+
+
+class DiffTests(unittest.TestCase):
+    def test_diff_values(self):
+        """Изменения перечисляются по путям в порядке документа"""
+        old = {"a": 1, "b": {"c": [1, 2, 3], "d": "x"}, "gone": [], "t": 1}
+        new = {"a": 1, "b": {"c": [1, 5], "d": "x"}, "t": "1", "added": {"k": 0}}
+        self.assertEqual(main.diff_values(old, new), [
+            {"path": "b.c[1]", "old": 2, "new": 5},
+            {"path": "b.c[2]", "old": 3},
+            {"path": "gone", "old": []},
+            {"path": "t", "old": 1, "new": "1"},
+            {"path": "added", "new": {"k": 0}},
+        ])
+        self.assertEqual(main.diff_values(main.loads("{range 0 100}"), main.loads("{* {range 0 100} 1}")), [])
+        self.assertEqual(main.diff_values(old, old), [])
+        self.assertEqual(main.diff_values(json.loads(json.dumps(old)), old), [])
+
+    def test_diff_files(self):
+        """--diff вычисляет оба файла и выводит только изменившиеся пути"""
+        with tempfile.TemporaryDirectory() as test_dir:
+            old = os.path.join(test_dir, "old.conf")
+            new = os.path.join(test_dir, "new.conf")
+            with open(old, "w", encoding="utf-8") as f:
+                f.write(GAME_CONF)
+            with open(new, "w", encoding="utf-8") as f:
+                f.write(GAME_CONF.replace("(def HEAL_AMOUNT 25);", "(def HEAL_AMOUNT 30);"))
+            expected = [{"path": "player.abilities[0].effect.health_restore", "old": 25, "new": 30}]
+            self.assertEqual(main.diff_files(old, new), expected)
+            self.assertEqual(main.diff_files(old, old), [])
+            result = subprocess.run([sys.executable, os.path.abspath(main.__file__), "--diff", old, new,
+                                     "--select", "player.abilities", "--compact"], capture_output=True, text=True)
+            self.assertEqual(result.returncode, 0, result.stderr)
+            self.assertEqual(json.loads(result.stdout), expected)
+
+
+class CommonSubexpressionTests(unittest.TestCase):
+    SOURCE = """
+    (def ITEMS array(1, 2, 3));
+    (def A {len ITEMS});
+    (def ITEMS array(1));
+    (def B {len ITEMS});
+    ([ a: A, b: B, c: {len ITEMS}, d: {LEN ITEMS}, e: {* SCALE 3}, f: array({* SCALE 3}, {* scale 3}),
+       g: {+ {len ITEMS} 1}, h: {+ {len ITEMS} 1} ])
+    """
+    EXPECTED = {"a": 3, "b": 1, "c": 1, "d": 1, "e": 6, "f": [6, 15], "g": 2, "h": 2}
+
+    def test_repeated_braces_evaluated_once(self):
+        """Одинаковые операции с одинаковыми определениями вычисляются один раз"""
+        program = main.optimize(main.Parser(main.tokenize(self.SOURCE)).parse_program())
+        self.assertIs(program.main_expr.pairs[2][1], program.main_expr.pairs[3][1])
+        self.assertEqual(program.main_expr.pairs[2][1].common[1], ("ITEMS",))
+        for program in (program, main.Parser(main.tokenize(self.SOURCE)).parse_program()):
+            evaluator = main.Evaluator({"SCALE": 2, "scale": 5})
+            self.assertEqual(evaluator.evaluate_program(program), self.EXPECTED)
+            # c и d берут значение B ({len ITEMS} со вторым ITEMS), f[0] - значение e,
+            # g - внутреннюю операцию, h - всю операцию g
+            self.assertEqual(evaluator.definitions.saved, 5)
+        self.assertEqual(main.compile(self.SOURCE).evaluate({"SCALE": 2, "scale": 5}), self.EXPECTED)
+
+    def test_found_while_parsing(self):
+        """Повторяющиеся операции отмечаются при разборе, без optimize()"""
+        main_expr = main.Parser(main.tokenize(self.SOURCE)).parse_program().main_expr
+        c, d, g, h = (main_expr.pairs[i][1] for i in (2, 3, 6, 7))
+        self.assertIsNot(c, d)
+        self.assertIs(c.common, d.common)
+        self.assertIs(c.common, g.args[0].common)
+        self.assertEqual(c.common[1], ("ITEMS",))
+        self.assertIs(g.common, h.common)
+        e, f = main_expr.pairs[4][1], main_expr.pairs[5][1]
+        self.assertIs(e.common, f.elements[0].common)
+        self.assertIsNone(f.elements[1].common)
+        self.assertIsNone(main.Parser(main.tokenize('([ a: {len array(1)}, b: {len array(1)} ])'))
+                          .parse_program().main_expr.pairs[0][1].common)
+
+    def test_input_tree_unchanged(self):
+        """optimize() строит общие узлы заново, не меняя разобранную программу"""
+        parsed = main.Parser(main.tokenize(self.SOURCE)).parse_program()
+        roots = [defn.value_expr for defn in parsed.definitions] + [parsed.main_expr]
+        braces = [node for root in roots for node in main._iter_nodes(root) if isinstance(node, main.BraceNode)]
+        commons = [node.common for node in braces]
+        first, second = main.optimize(parsed), main.optimize(parsed)
+        self.assertTrue(braces)
+        self.assertTrue(all(node.common is common for node, common in zip(braces, commons)))
+        self.assertIsNot(first.main_expr.pairs[2][1], second.main_expr.pairs[2][1])
+        self.assertEqual(second.main_expr.pairs[2][1].common[1], ("ITEMS",))
+
+    def test_errors_are_not_memoized(self):
+        """Ошибка в повторяющейся операции сообщается как раньше"""
+        source = '([ a: {+ X 1}, b: {+ X 1} ])'
+        for evaluate in (main.loads, lambda text, env: main.Evaluator(env).evaluate_program(
+                main.optimize(main.Parser(main.tokenize(text)).parse_program()))):
+            with self.assertRaises(main.ConfigError) as ctx:
+                evaluate(source, {"X": "a"})
+            self.assertIn("+ expects integer arguments, got types: str, int", str(ctx.exception))
+
+
+class StreamTests(unittest.TestCase):
+    def convert(self, data, **kwargs):
+        out = io.StringIO()
+        failed = main.convert_stream(io.BytesIO(data), out, **kwargs)
+        return [json.loads(line) for line in out.getvalue().splitlines()], failed
+
+    def test_record_separator(self):
+        """Документы, завершенные \\x1e, дают по строке ответа; ошибка - отдельная запись"""
+        data = '([ a: {+ 1 2} ])\x1e([ b: \x1e\n\x1e "ü"'.encode("utf-8")
+        results, failed = self.convert(data)
+        self.assertEqual(results, [{"ok": True, "value": {"a": 3}},
+                                   {"ok": False, "error": "Unexpected end of input"},
+                                   {"ok": True, "value": "ü"}])
+        self.assertEqual(failed, 1)
+
+    def test_length_prefix(self):
+        """Документы с префиксом длины; --select применяется к каждому, неверный кадр - запись с ошибкой"""
+        documents = ['([ a: array(1, "\x1e") ])', '([ a: 5 ])', '([ b: 1 ])']
+        data = b"".join(b"%d\n" % len(d.encode("utf-8")) + d.encode("utf-8") for d in documents)
+        results, failed = self.convert(data, framing="length", select="a")
+        self.assertEqual(results, [{"ok": True, "value": [1, "\x1e"]}, {"ok": True, "value": 5},
+                                   {"ok": False, "error": "Path not found: a"}])
+        results, failed = self.convert(b"7\narray()\n\n 7\narray()\nx\n5\n([ ])\n9\n1", framing="length")
+        self.assertEqual(results, [{"ok": True, "value": []}, {"ok": True, "value": []},
+                                   {"ok": False, "error": "Invalid length prefix in stream: b'x'"},
+                                   {"ok": True, "value": {}},
+                                   {"ok": False, "error": "Truncated document in stream"}])
+        self.assertEqual(failed, 2)
+
+    def test_parallel_keeps_order(self):
+        """При jobs > 1 ответы идут в порядке документов"""
+        count = main.STREAM_PARALLEL_MIN * 2
+        data = b"".join(b"([ id: {* %d 2} ])\x1e" % i for i in range(count))
+        results, failed = self.convert(data, jobs=2, chunk_size=len(data))
+        self.assertEqual([r["value"]["id"] for r in results], [i * 2 for i in range(count)])
+        self.assertEqual(failed, 0)
+
+    def test_cli(self):
+        """--stream читает stdin и пишет строки JSON в stdout"""
+        result = subprocess.run([sys.executable, os.path.abspath(main.__file__), "--stream", "--jobs", "1"],
+                                input=b'"a"\x1e{+ 1 "x"}\x1e', capture_output=True)
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(result.stdout.decode("utf-8").splitlines(), [
+            '{"ok":true,"value":"a"}',
+            '{"ok":false,"error":"+ expects integer arguments, got types: int, str"}'])
+
+
+class LimitTests(unittest.TestCase):
+    SQUARES = ("(def X 1000000007);\n(def A {* X X});\n(def B {* A A});\n(def C {* B B});\n"
+               "([ a: {+ C 1} ])")
+    SHARED = ("(def L0 array(1, 2, 3, 4, 5, 6, 7, 8, 9, 10));\n"
+              "(def L1 array(L0, L0, L0, L0, L0, L0, L0, L0, L0, L0));\n"
+              "(def L2 array(L1, L1, L1, L1, L1, L1, L1, L1, L1, L1));\n"
+              "([ data: L2, name: \"x\" ])")
+
+    def evaluate(self, source, optimized=True, **limits):
+        limits = main.Limits(**limits)
+        program = main.Parser(main.tokenize(source)).parse_program()
+        if optimized:
+            program = main.optimize(program, limits)
+        return main.Evaluator(limits=limits).evaluate_program(program)
+
+    def assertLimit(self, source, message, optimized=True, **limits):
+        with self.assertRaises(main.LimitError) as ctx:
+            self.evaluate(source, optimized, **limits)
+        self.assertEqual(str(ctx.exception), message)
+
+    def test_within_limits(self):
+        """Значение в пределах ограничений совпадает с вычисленным без них"""
+        for source in (self.SQUARES, self.SHARED, '([ r: {range 0 5}, v: {* array(1, 2) 3} ])'):
+            expected = main.Evaluator().evaluate_program(main.Parser(main.tokenize(source)).parse_program())
+            self.assertEqual(self.evaluate(source, max_int_bits=240, max_nodes=1113, max_bytes=2341,
+                                           max_depth=4, timeout=60), expected)
+
+    def test_int_bits(self):
+        """Слишком большое целое указывает на операцию при вычислении, неиспользуемое - не ошибка"""
+        for optimized in (True, False):
+            self.assertLimit(self.SQUARES, "Line 3, Col 8: Result of * has 120 bits, limit is 100",
+                             optimized, max_int_bits=100)
+        self.assertLimit('([ v: {* {range 0 100} 1000000} ])', "Line 1, Col 7: Result of * has 27 bits, limit is 20",
+                         max_int_bits=20)
+        unused = "(def UNUSED {* 4294967296 4294967296});\n([ a: 1 ])"
+        for optimized in (True, False):
+            self.assertEqual(self.evaluate(unused, optimized, max_int_bits=64), {"a": 1})
+
+    def test_output_size(self):
+        """Размножение значения через определения останавливается на построившем его массиве"""
+        self.assertLimit(self.SHARED, "Line 2, Col 9: Value has 111 nodes, limit is 100", max_nodes=100)
+        self.assertLimit(self.SHARED, "Line 3, Col 9: Value has 3 levels of nesting, limit is 2", max_depth=2)
+        self.assertLimit(self.SHARED, "Line 4, Col 1: Value takes about 2341 bytes of JSON, limit is 2340",
+                         max_bytes=2340)
+        self.assertLimit('([ ids: {range 0 1000000000000} ])',
+                         "Line 1, Col 9: Value has 1000000000001 nodes, limit is 1000000", max_nodes=1000000)
+
+    def test_library(self):
+        """loads, load и compile принимают limits; программа без них кэшируется отдельно"""
+        limits = main.Limits(max_nodes=100)
+        self.assertEqual(len(main.loads(self.SHARED)["data"]), 10)
+        with self.assertRaises(main.LimitError) as ctx:
+            main.loads(self.SHARED, limits=limits)
+        self.assertEqual(str(ctx.exception), "Line 2, Col 9: Value has 111 nodes, limit is 100")
+        with self.assertRaises(main.LimitError):
+            main.compile(self.SHARED, cache=False, limits=limits).evaluate()
+        self.assertEqual(main.loads("(def UNUSED {* 4294967296 4294967296});\n([ a: 1 ])",
+                                    limits=main.Limits(max_int_bits=64)), {"a": 1})
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "big.conf")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(self.SQUARES)
+            with self.assertRaises(main.LimitError):
+                main.load(path, limits=main.Limits(max_int_bits=100))
+
+    def test_timeout(self):
+        """Время вычисления проверяется после каждой операции"""
+        self.assertLimit(self.SHARED, "Line 1, Col 9: Evaluation time limit of 0 s exceeded", timeout=0)
+
+    def test_huge_elementwise(self):
+        """Поэлементная операция над огромным range останавливается до построения результата или по ходу"""
+        start = time.perf_counter()
+        self.assertLimit('([ n: {len {* {range 0 1000000000000} 2}} ])',
+                         "Line 1, Col 12: Evaluation time limit of 0.2 s exceeded", timeout=0.2)
+        program = main.Parser(main.tokenize('([ v: {* R 2} ])')).parse_program()
+        evaluator = main.Evaluator(env={"R": range(10 ** 12)}, limits=main.Limits(max_nodes=1000000))
+        with self.assertRaises(main.LimitError) as ctx:
+            evaluator.evaluate_program(program)
+        self.assertEqual(str(ctx.exception), "Line 1, Col 7: Value has 1000000000001 nodes, limit is 1000000")
+        self.assertLess(time.perf_counter() - start, 5)
+
+    def test_included_file(self):
+        """Место в подключенном файле указывается вместе с его именем"""
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "lib.conf"), "w", encoding="utf-8") as f:
+                f.write("(def BIG\n  {* 4294967296 4294967296});\n")
+            path = os.path.join(tmp, "main.conf")
+            with open(path, "w", encoding="utf-8") as f:
+                f.write('(include "lib.conf");\n([ big: BIG ])')
+            result = subprocess.run([sys.executable, os.path.abspath(main.__file__), "--input", path,
+                                     "--max-int-bits", "64"], capture_output=True, text=True, cwd=tmp)
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(result.stderr, "lib.conf: Line 2, Col 3: Result of * has 65 bits, limit is 64\n")
+
+    def test_stream(self):
+        """В потоковом режиме превышение - ошибка только своего документа"""
+        out = io.StringIO()
+        data = self.SHARED.encode("utf-8") + b"\x1e([ a: 1 ])\x1e"
+        failed = main.convert_stream(io.BytesIO(data), out, limits=main.Limits(max_nodes=100))
+        self.assertEqual(failed, 1)
+        self.assertEqual(out.getvalue().splitlines(), [
+            '{"ok":false,"error":"Line 2, Col 9: Value has 111 nodes, limit is 100"}',
+            '{"ok":true,"value":{"a":1}}'])
+
 
 # Ожидаемые JSON результаты (обновленные)
 WEB_SERVER_JSON = r'''